@@ -1,155 +1,290 @@
 """Calculate FX after receiving financial transactions from a Solace topic."""
 
 ## Goal: Publisher + Subscriber 
-import ast
 import os
-import time
-
-# Import Solace Python  API modules
-from solace.messaging.messaging_service import MessagingService, ReconnectionListener, ReconnectionAttemptListener, ServiceInterruptionListener, RetryStrategy, ServiceEvent
-from solace.messaging.errors.pubsubplus_client_error import PubSubPlusClientError
-from solace.messaging.publisher.direct_message_publisher import PublishFailureListener
-from solace.messaging.resources.topic_subscription import TopicSubscription
-from solace.messaging.receiver.message_receiver import MessageHandler, InboundMessage
-# from solace.messaging.core.solace_message import SolaceMessage
-from solace.messaging.resources.topic import Topic
-from jproperties import Properties
-
-# Pub topic
+
+# Import Solace Python  API modules, or their loopback stand-ins (see transport.py)
+from transport import MessagingService, MessageHandler, InboundMessage
+from publisher import SharedPublisher
+from transactions import Transaction
+import batching
+import codec
+import executor
+import fx
+import eventlog
+import latency
+import metrics
+import partitions
+import stage
+
+# Pub topic, one per partition (see partitions.py)
 TOPIC_TST = "SOLACE/CAPITALMARKETS/TRANSACTION/FRAUD_DETECT"
+PUBLISH_TOPICS = partitions.PartitionedTopics(TOPIC_TST)
 
 
 #Sub topic
 TOPIC_PREFIX = "SOLACE/CAPITALMARKETS/TRANSACTION"
+CONTROL_PREFIX = TOPIC_PREFIX + "/control/"
+FX_CONTROL_TOPIC = CONTROL_PREFIX + "fx"
+INPUT_TOPICS = partitions.PartitionedTopics(TOPIC_PREFIX)
 
 SHUTDOWN = False
 
 
-# Currency conversion from EUR to USD
+# Every transaction is converted into this currency
+REPORTING_CURRENCY = "USD"
+
+# Rates in force until the first update arrives on FX_CONTROL_TOPIC
 tx_FX = 1.2
+INITIAL_RATES = fx.RateSnapshot(0, {"EURUSD": tx_FX})
+
+# Micro-batching: with BATCH_SIZE above 1, transactions are converted and published
+# in batches of up to BATCH_SIZE, each held back at most BATCH_LINGER seconds
+BATCH_SIZE = 0
+BATCH_LINGER = 0.005
+
+# Handoff: with HANDOFF_WORKERS above 0, on_message only queues messages, at most
+# HANDOFF_CAPACITY, for that many worker threads; HANDOFF_POLICY applies when the
+# queue is full and shed messages go to SHED_TOPIC (see executor.py)
+HANDOFF_WORKERS = 0
+HANDOFF_CAPACITY = 10000
+HANDOFF_POLICY = executor.BLOCK
+SHED_TOPIC = TOPIC_PREFIX + "/shed"
+
+# Scale-out: with PARTITION_RANGE, e.g. "0-7", only those partitions of the input are
+# consumed, so instances with disjoint ranges split the load and keep each account in
+# order; with SHARE_GROUP, instances share the subscription and the broker balances
+# messages between them. FX control messages reach every instance (see partitions.py)
+PARTITION_RANGE = None
+SHARE_GROUP = None
+
+# Prometheus metrics on http://localhost:METRICS_PORT/metrics and a JSON snapshot every
+# METRICS_SNAPSHOT_INTERVAL seconds, None to disable either (see metrics.py)
+METRICS_PORT = 9102
+METRICS_SNAPSHOT_INTERVAL = None
+METRICS = metrics.StageMetrics("CalcFX")
+# Events go to the asynchronous event log (see eventlog.py); per-message ones are sampled
+LOG = eventlog.logger("CalcFX")
+# Rate updates on FX_CONTROL_TOPIC that could not be parsed; the current snapshot is kept
+REJECTED_SNAPSHOTS = metrics.REGISTRY.counter("fx_snapshots_rejected_total",
+                                              "FX rate updates rejected as malformed", stage="CalcFX")
 
 
 # Handle received messages
 class MessageHandlerImpl(MessageHandler):
-    def on_message(self, message: InboundMessage):
-        global transaction_FX
-        global tx_my
+    def __init__(self, publisher: SharedPublisher, fx_engine: fx.FxEngine,
+                 batch_size: int = BATCH_SIZE, batch_linger: float = BATCH_LINGER, downstream=None):
+        self.publisher = publisher
+        self.fx_engine = fx_engine
+        # Fused with the next stage (see runner.py): converted transactions are handed to it, not published
+        self.downstream = downstream
+        self.batcher = None
+        if batch_size > 1:
+            self.batcher = batching.MicroBatcher(self.on_batch, batch_size, batch_linger,
+                                                 self.on_batch_failed, "CalcFX-batcher")
 
-        payload_str = message.get_payload_as_string()
-        transaction = ast.literal_eval(payload_str)
+    def on_message(self, message: InboundMessage):
+        destination = message.get_destination_name() or ""
+        if destination.startswith(CONTROL_PREFIX):
+            self.on_control(destination, message)
+            return
+
+        start = METRICS.received()
+        try:
+            transaction = codec.decode_message(message)
+            if start:
+                start = METRICS.decode_time.lap(start)
+            self.convert(transaction, latency.stamps_of(message), start)
+        except Exception:
+            METRICS.messages_failed.inc()
+            raise
+
+    def on_transaction(self, transaction: Transaction, stamps: dict):
+        """Take a transaction already decoded, from a fused upstream stage."""
+        start = METRICS.received()
+        try:
+            self.convert(transaction, stamps, start)
+        except Exception:
+            METRICS.messages_failed.inc()
+            raise
+
+    def convert(self, transaction: Transaction, stamps: dict, start: int = 0):
+        if self.batcher is not None:
+            self.batcher.add((transaction, stamps))
+            return
 
         #Calculate the FX
-        transaction['amount'] = transaction['amount'] * tx_FX
-
-        publish_mesg(str(transaction))
-
-
-# Inner classes for error handling
-class ServiceEventHandler(ReconnectionListener, ReconnectionAttemptListener, ServiceInterruptionListener):
-    def on_reconnected(self, e: ServiceEvent):
-        print("\non_reconnected")
-        print(f"Error cause: {e.get_cause()}")
-        print(f"Message: {e.get_message()}")
-    
-    def on_reconnecting(self, e: "ServiceEvent"):
-        print("\non_reconnecting")
-        print(f"Error cause: {e.get_cause()}")
-        print(f"Message: {e.get_message()}")
-
-    def on_service_interrupted(self, e: "ServiceEvent"):
-        print("\non_service_interrupted")
-        print(f"Error cause: {e.get_cause()}")
-        print(f"Message: {e.get_message()}")
-
-class PublisherErrorHandling(PublishFailureListener):
-    def on_failed_publish(self, e: "FailedPublishEvent"):
-        print("on_failed_publish")
-
-# Broker Config
-solace_configs = Properties()
-with open('solace.properties', 'rb') as read_prop: 
-    solace_configs.load(read_prop)
-
-broker_props = {
-    "solace.messaging.transport.host": solace_configs.get("SOLACE_HOST").data,
-    "solace.messaging.service.vpn-name": solace_configs.get('SOLACE_VPN').data,
-    "solace.messaging.authentication.scheme.basic.username": solace_configs.get("SOLACE_USERNAME").data,
-    "solace.messaging.authentication.scheme.basic.password": solace_configs.get("SOLACE_PASSWORD").data
-    }
-
-# Build A messaging service with a reconnection strategy of 20 retries over an interval of 3 seconds
-# Note: The reconnections strategy could also be configured using the broker properties object
-messaging_service = MessagingService.builder().from_properties(broker_props)\
-                    .with_reconnection_retry_strategy(RetryStrategy.parametrized_retry(20,3))\
-                    .build()
-
-# Blocking connect thread
-messaging_service.connect()
-# print(f'Messaging Service connected? {messaging_service.is_connected}')
+        transaction.amount, transaction.fx_version = self.fx_engine.convert(
+            transaction.amount, transaction.currency, REPORTING_CURRENCY)
+        transaction.currency = REPORTING_CURRENCY
+        if start:
+            start = METRICS.process_time.lap(start)
+
+        stamps[latency.stamp_name("CalcFX")] = latency.now()
+        self.forward(transaction, stamps)
+        if start and self.downstream is None:
+            METRICS.publish_time.lap(start)
+
+    def forward(self, transaction: Transaction, stamps: dict):
+        LOG.sampled(eventlog.INFO, "converted", transaction=transaction)
+        if self.downstream is None:
+            publish_mesg(self.publisher, transaction, stamps)
+        else:
+            METRICS.messages_out.inc()
+            self.downstream(transaction, stamps)
+
+    def on_batch(self, batch: list):
+        """Convert a batch with one vectorised operation per currency pair and publish it as a burst.
+
+        Transactions in a currency the rates cannot convert are counted failed
+        and left out; the rest of the batch goes on.
+        """
+        positions = {}
+        for i, (transaction, _) in enumerate(batch):
+            positions.setdefault(transaction.currency, []).append(i)
+        start = METRICS.start()
+        # One snapshot for every pair, so the whole batch carries one rate version
+        snapshot = self.fx_engine.snapshot
+        fx_version = snapshot.version
+        unconverted = set()
+        for currency, idx in positions.items():
+            try:
+                values = snapshot.convert_many([batch[i][0].amount for i in idx], currency, REPORTING_CURRENCY)
+            except KeyError as exception:
+                unconverted.update(idx)
+                METRICS.messages_failed.inc(len(idx))
+                LOG.sampled(eventlog.ERROR, "fx_failed", currency=currency, transactions=len(idx),
+                            cause=str(exception))
+                continue
+            values = values.tolist() if hasattr(values, 'tolist') else values
+            for i, amount in zip(idx, values):
+                transaction = batch[i][0]
+                transaction.amount = amount
+                transaction.currency = REPORTING_CURRENCY
+                transaction.fx_version = fx_version
+        if unconverted:
+            batch = [item for i, item in enumerate(batch) if i not in unconverted]
+
+        if start:
+            start = METRICS.process_time.lap(start)
+        published = latency.now()
+        if self.downstream is not None:
+            for transaction, stamps in batch:
+                stamps[latency.stamp_name("CalcFX")] = published
+                self.forward(transaction, stamps)
+            return
+        messages = []
+        for transaction, stamps in batch:
+            stamps[latency.stamp_name("CalcFX")] = published
+            LOG.sampled(eventlog.INFO, "converted", transaction=transaction)
+            messages.append((codec.encode(transaction), PUBLISH_TOPICS.for_account(transaction.source), stamps))
+        self.publisher.publish_burst(messages)
+        if start:
+            METRICS.publish_time.lap(start)
+        METRICS.messages_out.inc(len(messages))
+
+    def on_batch_failed(self, batch: list, exception: Exception):
+        """A batch flushed by the batcher's timer raised: its transactions are lost."""
+        METRICS.messages_failed.inc(len(batch))
+
+    def close(self):
+        """Flush transactions still held for batching."""
+        if self.batcher is not None:
+            self.batcher.close()
+
+    def on_control(self, destination: str, message: InboundMessage):
+        if destination == FX_CONTROL_TOPIC:
+            # Published as a string, see fx.snapshot_payload
+            payload = message.get_payload_as_string()
+            try:
+                snapshot = fx.snapshot_from_payload(payload if payload is not None
+                                                    else message.get_payload_as_bytes())
+            except Exception as exception:  # a bad update must not take the receiver down
+                REJECTED_SNAPSHOTS.inc()
+                LOG.error("fx_rates_rejected", cause=repr(exception), current=self.fx_engine.snapshot.version)
+                return
+            if self.fx_engine.update(snapshot):
+                LOG.info("fx_rates_updated", version=snapshot.version, pairs=len(snapshot))
+            else:
+                LOG.warning("fx_rates_stale", version=snapshot.version, current=self.fx_engine.snapshot.version)
+
+
+def connect() -> MessagingService:
+    """Build and connect the messaging service configured in solace.properties."""
+    return stage.connect(stage.ServiceEventHandler(METRICS, LOG))
+
+
+def publish_mesg(publisher: SharedPublisher, transaction, stamps: dict = None):
+    """Publish on the partition topic of the transaction's source account."""
+    publisher.publish(codec.encode(transaction), PUBLISH_TOPICS.for_account(transaction.source), stamps)
+    METRICS.messages_out.inc()
+
+
+def subscriptions(partition_range: str = PARTITION_RANGE, share_group: str = SHARE_GROUP) -> list:
+    """Input partitions to consume, see PARTITION_RANGE and SHARE_GROUP, plus the control topics."""
+    return INPUT_TOPICS.subscriptions(partition_range, share_group) + [TOPIC_PREFIX + "/control/>"]
 
-# Error Handeling for the messaging service
-service_handler = ServiceEventHandler()
-messaging_service.add_reconnection_listener(service_handler)
-messaging_service.add_reconnection_attempt_listener(service_handler)
-messaging_service.add_service_interruption_listener(service_handler)
-
-def publish_mesg(transaction_str):
-    # Create a direct message publisher and start it
-    direct_publisher = messaging_service.create_direct_message_publisher_builder().build()
-    direct_publisher.set_publish_failure_listener(PublisherErrorHandling())
-    direct_publisher.set_publisher_readiness_listener
-
-    # Blocking Start thread
-    direct_publisher.start()
-
-    outbound_msg = messaging_service.message_builder() \
-                .with_application_message_id("sample_id") \
-                .with_property("application", "samples") \
-                .with_property("language", "Python") \
-                .build(transaction_str)
-
-    msgSeqNum = 1
-
-    print("transaction details: ", str(transaction_str))
-
-    direct_publisher.publish(destination=Topic.of(TOPIC_TST + f"/python/{msgSeqNum}"), message=outbound_msg)
-    direct_publisher.terminate()
-
-
-
-unique_name = ""
-while not unique_name:
-    unique_name = input("Enter your name: ").replace(" ", "")
 
 # Define a Topic subscriptions 
-topics = [TOPIC_PREFIX + "/python/>", TOPIC_PREFIX + "/control/>"]
-topics_sub = []
-for t in topics:
-    topics_sub.append(TopicSubscription.of(t))
-
-
-
-try:
-    print(f"Subscribed to: {topics}")
-    # Build a Receiver
-    direct_receiver = messaging_service.create_direct_message_receiver_builder().with_subscriptions(topics_sub).build()
-    direct_receiver.start()
-    # Callback for received messages
-    direct_receiver.receive_async(MessageHandlerImpl())
-    if direct_receiver.is_running():
-        print("Connected and Subscribed! Ready to publish\n")
-
-    
+topics = subscriptions()
+
+
+def start(messaging_service: MessagingService, fx_engine: fx.FxEngine = None,
+          batch_size: int = BATCH_SIZE, batch_linger: float = BATCH_LINGER,
+          handoff_workers: int = HANDOFF_WORKERS, handoff_capacity: int = HANDOFF_CAPACITY,
+          handoff_policy: str = HANDOFF_POLICY, partition_range: str = PARTITION_RANGE,
+          share_group: str = SHARE_GROUP, downstream=None, subscribe: bool = True):
+    """Subscribe the stage on a connected messaging service.
+
+    Returns the running receiver, the publisher it republishes with and the
+    message handler, which must be closed after the receiver is terminated.
+    With ``downstream``, converted transactions are handed to it instead of
+    published; with ``subscribe`` False, the stage is only fed through the
+    handler's on_transaction and the receiver returned is None (see runner.py).
+    ``partition_range`` and ``share_group`` select what it consumes (see subscriptions()).
+    """
+    fx_engine = fx_engine or fx.FxEngine(INITIAL_RATES)
+
+    # One publisher for the lifetime of the process, started before any message arrives
+    publisher = SharedPublisher(messaging_service, stage.PublisherErrorHandling(METRICS, LOG), METRICS.stage).start()
+
+    handler = MessageHandlerImpl(publisher, fx_engine, batch_size, batch_linger, downstream)
+    if not subscribe:
+        return None, publisher, handler
+    handler = executor.handoff(handler, handoff_workers, handoff_capacity, handoff_policy,
+                               executor.shed_to(publisher, SHED_TOPIC), "CalcFX")
+    return stage.subscribe(messaging_service, subscriptions(partition_range, share_group), handler), \
+        publisher, handler
+
+
+def main():
+    messaging_service = connect()
+    metrics.expose(METRICS_PORT, METRICS_SNAPSHOT_INTERVAL)
+
+    unique_name = ""
+    while not unique_name:
+        unique_name = input("Enter your name: ").replace(" ", "")
+
+    direct_receiver = publisher = handler = None
     try:
-        while not SHUTDOWN:            
-              time.sleep(0.1)
-    except KeyboardInterrupt:
-        print('\nDisconnecting Messaging Service')
-    except PubSubPlusClientError as exception:
-        print(f'Received a PubSubPlusClientException: {exception}')
-
-finally:
-    print('Terminating Publisher and Receiver')
-    direct_receiver.terminate()
-    print('Disconnecting Messaging Service')
-    messaging_service.disconnect()
+        print(f"Subscribed to: {topics}")
+        direct_receiver, publisher, handler = start(messaging_service)
+        if direct_receiver.is_running():
+            print("Connected and Subscribed! Ready to publish\n")
+
+        stage.wait(lambda: SHUTDOWN)
+
+    finally:
+        print('Terminating Publisher and Receiver')
+        if direct_receiver is not None:
+            direct_receiver.terminate()
+        if handler is not None:
+            handler.close()
+        if publisher is not None:
+            publisher.terminate()
+        print('Disconnecting Messaging Service')
+        messaging_service.disconnect()
+
+
+if __name__ == '__main__':
+    main()
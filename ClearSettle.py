@@ -1,107 +1,269 @@
 """Clearing & settlement of financial transactions from a Solace topic."""
 
-import ast
 import os
 import platform
+import threading
 import time
 
-# Import Solace Python  API modules from the solace package
-from solace.messaging.messaging_service import MessagingService, ReconnectionListener, ReconnectionAttemptListener, ServiceInterruptionListener, RetryStrategy, ServiceEvent
-from solace.messaging.resources.topic_subscription import TopicSubscription
-from solace.messaging.receiver.message_receiver import MessageHandler, InboundMessage
-from jproperties import Properties
+# Import Solace Python  API modules, or their loopback stand-ins (see transport.py)
+from transport import MessagingService, MessageHandler, InboundMessage
+import codec
+import dedup
+import executor
+import eventlog
+import latency
+import metrics
+import partitions
+import stage
+from journal import Journal
+from ledger import Ledger
+from transactions import Transaction
 
-if platform.uname().system == 'Windows': os.environ["PYTHONUNBUFFERED"] = "1" # Disable stdout buffer 
+if platform.uname().system == 'Windows': os.environ["PYTHONUNBUFFERED"] = "1" # Disable stdout buffer
 
 TOPIC_PREFIX = "SOLACE/CAPITALMARKETS/TRANSACTION/SETTLE"
+INPUT_TOPICS = partitions.PartitionedTopics(TOPIC_PREFIX)
 
+REPORT_INTERVAL = 10 # Seconds between latency reports
+SETTLEMENT_CYCLE = 60 # Seconds between netting cycles
 
-# Inner classes for error handling
-class ServiceEventHandler(ReconnectionListener, ReconnectionAttemptListener, ServiceInterruptionListener):
-    def on_reconnected(self, e: ServiceEvent):
-        print("\non_reconnected")
-        print(f"Error cause: {e.get_cause()}")
-        print(f"Message: {e.get_message()}")
-    
-    def on_reconnecting(self, e: "ServiceEvent"):
-        print("\non_reconnecting")
-        print(f"Error cause: {e.get_cause()}")
-        print(f"Message: {e.get_message()}")
+# Settled transactions are journalled to JOURNAL_DIR, None to keep the ledger in memory only.
+# Up to JOURNAL_BATCH_SIZE postings, or those settled within JOURNAL_FSYNC_INTERVAL seconds,
+# are made durable with one fsync; segment files roll over at JOURNAL_SEGMENT_SIZE bytes
+JOURNAL_DIR = "journal"
+JOURNAL_FSYNC_INTERVAL = 0.01
+JOURNAL_BATCH_SIZE = 1024
+JOURNAL_SEGMENT_SIZE = 64 << 20
 
-    def on_service_interrupted(self, e: "ServiceEvent"):
-        print("\non_service_interrupted")
-        print(f"Error cause: {e.get_cause()}")
-        print(f"Message: {e.get_message()}")
+# Idempotent settlement: a transaction whose id was already settled is not settled again.
+# Ids of the last DEDUP_WINDOW seconds are kept exactly, older ones in Bloom filters of
+# DEDUP_BUCKET seconds of id time each, for DEDUP_RETENTION seconds, sized for
+# DEDUP_IDS_PER_DAY at a false-positive rate of DEDUP_FP_RATE (see dedup.py).
+# DEDUP_RETENTION None settles without checking
+DEDUP_WINDOW = 60
+DEDUP_RETENTION = 24 * 3600
+DEDUP_BUCKET = 3600
+DEDUP_IDS_PER_DAY = 100_000_000
+DEDUP_FP_RATE = 1e-6
 
+# Handoff: with HANDOFF_WORKERS above 0, on_message only queues messages, at most
+# HANDOFF_CAPACITY, for that many worker threads; HANDOFF_POLICY applies when the
+# queue is full (see executor.py). This stage publishes nothing, so it cannot shed.
+HANDOFF_WORKERS = 0
+HANDOFF_CAPACITY = 10000
+HANDOFF_POLICY = executor.BLOCK
 
-# Broker Config. Note: Could pass other properties Look into
-solace_configs = Properties()
-with open('solace.properties', 'rb') as read_prop: 
-    solace_configs.load(read_prop)
+# Scale-out: with PARTITION_RANGE, e.g. "0-7", only those partitions of the input are
+# consumed, so instances with disjoint ranges split the load and keep each account in
+# order; with SHARE_GROUP, instances share the subscription and the broker balances
+# messages between them (see partitions.py)
+PARTITION_RANGE = None
+SHARE_GROUP = None
 
-broker_props = {
-    "solace.messaging.transport.host": solace_configs.get("SOLACE_HOST").data,
-    "solace.messaging.service.vpn-name": solace_configs.get('SOLACE_VPN').data,
-    "solace.messaging.authentication.scheme.basic.username": solace_configs.get("SOLACE_USERNAME").data,
-    "solace.messaging.authentication.scheme.basic.password": solace_configs.get("SOLACE_PASSWORD").data
-    }
+# Prometheus metrics on http://localhost:METRICS_PORT/metrics and a JSON snapshot every
+# METRICS_SNAPSHOT_INTERVAL seconds, None to disable either (see metrics.py)
+METRICS_PORT = 9104
+METRICS_SNAPSHOT_INTERVAL = None
+METRICS = metrics.StageMetrics("ClearSettle")
+# Events go to the asynchronous event log (see eventlog.py); per-message ones are sampled
+LOG = eventlog.logger("ClearSettle")
+# Transactions not settled because the duplicate index knew their id, by how sure it was
+_DUPLICATES_HELP = "Transactions not settled again, by how they were recognised"
+DUPLICATES = metrics.REGISTRY.counter("duplicates_total", _DUPLICATES_HELP, stage="ClearSettle",
+                                      kind=dedup.DUPLICATE)
+SUSPECTED_DUPLICATES = metrics.REGISTRY.counter("duplicates_total", _DUPLICATES_HELP, stage="ClearSettle",
+                                                kind=dedup.SUSPECTED)
+UNCHECKED = metrics.REGISTRY.counter("dedup_unchecked_total",
+                                     "Transactions settled unchecked: no id, or an id outside the retention",
+                                     stage="ClearSettle")
+
+
+def connect() -> MessagingService:
+    """Build and connect the messaging service configured in solace.properties."""
+    messaging_service = stage.connect(stage.ServiceEventHandler(METRICS, LOG))
+    print(f'Messaging Service connected? {messaging_service.is_connected}')
+    return messaging_service
 
 
 # Handle received messages
 class MessageHandlerImpl(MessageHandler):
+    def __init__(self, recorder: latency.LatencyRecorder, ledger: Ledger, index: dedup.DedupIndex = None):
+        self.recorder = recorder
+        self.ledger = ledger
+        # Ids already settled; None settles every transaction
+        self.index = index
+        # Histograms and the index are not thread-safe; handoff may run several workers
+        self.lock = threading.Lock()
+
     def on_message(self, message: InboundMessage):
-        payload_str = message.get_payload_as_string()
-        #print("\n" + f"Message Payload String: {payload_str} \n")
-
-        # No fraud detected, reconcile and settle transaction
-        print("Transaction details: ", payload_str, "\n")
-        print("Reconcilliation completed\n")
-
-    
-# Build A messaging service with a reconnection strategy of 20 retries over an interval of 3 seconds
-# Note: The reconnections strategy could also be configured using the broker properties object
-messaging_service = MessagingService.builder().from_properties(broker_props)\
-                    .with_reconnection_retry_strategy(RetryStrategy.parametrized_retry(20,3))\
-                    .build()
-
-# Blocking connect thread
-messaging_service.connect()
-print(f'Messaging Service connected? {messaging_service.is_connected}')
-
-# Error Handeling for the messaging service
-service_handler = ServiceEventHandler()
-messaging_service.add_reconnection_listener(service_handler)
-messaging_service.add_reconnection_attempt_listener(service_handler)
-messaging_service.add_service_interruption_listener(service_handler)
-
-# Define a Topic subscriptions 
-topics = [TOPIC_PREFIX + "/python/>", TOPIC_PREFIX + "/python/v2/>"]
+        arrival = latency.now()
+        start = METRICS.received()
+        try:
+            transaction = codec.decode_message(message)
+            if start:
+                start = METRICS.decode_time.lap(start)
+            #print("\n" + f"Message Payload String: {transaction} \n")
+            self.settle(transaction, latency.stamps_of(message), arrival, start)
+        except Exception:
+            METRICS.messages_failed.inc()
+            raise
+
+    def on_transaction(self, transaction: Transaction, stamps: dict):
+        """Take a transaction already decoded, from a fused upstream stage."""
+        arrival = latency.now()
+        start = METRICS.received()
+        try:
+            self.settle(transaction, stamps, arrival, start)
+        except Exception:
+            METRICS.messages_failed.inc()
+            raise
+
+    def admit(self, transaction: Transaction) -> bool:
+        """Check the transaction's id against the index; False if it was settled already.
+
+        The id is not recorded here: settle() records it once the posting went through.
+        """
+        result = self.index.check(transaction.id, remember=False)
+        if result == dedup.NEW:
+            return True
+        if result == dedup.DUPLICATE:
+            DUPLICATES.inc()
+            LOG.sampled(eventlog.WARNING, "duplicate", id=transaction.id)
+            return False
+        if result == dedup.SUSPECTED:
+            # Held back for reconciliation: a new transaction lands here at DEDUP_FP_RATE
+            SUSPECTED_DUPLICATES.inc()
+            LOG.warning("duplicate_suspected", transaction=transaction)
+            return False
+        UNCHECKED.inc()
+        return True
+
+    def settle(self, transaction: Transaction, stamps: dict, arrival: int = None, start: int = 0):
+        # Checked, posted and recorded in one critical section: two deliveries of an id cannot both
+        # pass, and a posting that raises leaves the id unrecorded, to be settled when redelivered
+        with self.lock:
+            if self.index is not None and not self.admit(transaction):
+                return
+            # No fraud detected, reconcile and settle transaction
+            self.ledger.post(transaction.source, transaction.target, transaction.amount, transaction.id)
+            if self.index is not None:
+                self.index.remember(transaction.id)
+            self.recorder.record(stamps, arrival)
+
+        if start:
+            METRICS.process_time.lap(start)
+        LOG.sampled(eventlog.INFO, "settled", transaction=transaction)
+
+    def close(self):
+        pass
+
+
+def subscriptions(partition_range: str = PARTITION_RANGE, share_group: str = SHARE_GROUP) -> list:
+    """Input partitions to consume, see PARTITION_RANGE and SHARE_GROUP."""
+    return INPUT_TOPICS.subscriptions(partition_range, share_group)
+
+
+# Define a Topic subscriptions
+topics = subscriptions()
 #topics = [TOPIC_PREFIX ]
 
-topics_sub = []
-for t in topics:
-    topics_sub.append(TopicSubscription.of(t))
-
-# Build a Receiver with the given topics and start it
-direct_receiver = messaging_service.create_direct_message_receiver_builder()\
-                        .with_subscriptions(topics_sub)\
-                        .build()
-
-direct_receiver.start()
-print(f'Direct Subscriber is running? {direct_receiver.is_running()}')
-
-try:
-    print(f"Subscribing to: {topics}")
-    # Callback for received messages
-    direct_receiver.receive_async(MessageHandlerImpl())
-    try: 
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
+
+def open_index(journal: Journal = None) -> dedup.DedupIndex:
+    """Duplicate index configured by the DEDUP_* settings, None if DEDUP_RETENTION is None.
+
+    With ``journal``, already recovered, the index starts with the ids settled
+    before, so a restart does not settle them again.
+    """
+    if DEDUP_RETENTION is None:
+        return None
+    index = dedup.DedupIndex(DEDUP_WINDOW, DEDUP_RETENTION, DEDUP_BUCKET,
+                             int(DEDUP_IDS_PER_DAY * DEDUP_BUCKET / 86400), DEDUP_FP_RATE)
+    if journal is not None:
+        started = time.perf_counter()
+        seeded = index.seed(journal.ids())
+        if seeded:
+            print(f"Recovered {seeded} settled ids into the duplicate index in {time.perf_counter() - started:.2f}s\n")
+    metrics.REGISTRY.gauge("dedup_index_bytes", "Bytes held by the duplicate index's Bloom filters",
+                           lambda: index.nbytes, stage="ClearSettle")
+    return index
+
+
+def start(messaging_service: MessagingService, recorder: latency.LatencyRecorder, ledger: Ledger,
+          index: dedup.DedupIndex = None, handoff_workers: int = HANDOFF_WORKERS,
+          handoff_capacity: int = HANDOFF_CAPACITY, handoff_policy: str = HANDOFF_POLICY, partition_range: str = PARTITION_RANGE,
+          share_group: str = SHARE_GROUP, subscribe: bool = True):
+    """Subscribe the stage on a connected messaging service.
+
+    Latency of every settled transaction is recorded into ``recorder`` and the
+    transaction is posted to ``ledger``, unless ``index``, open_index() of the
+    ledger's journal by default, says it was settled already. Returns the running receiver and the
+    message handler, which must be closed after the receiver is terminated. With ``subscribe`` False, the stage is only fed
+    through the handler's on_transaction and the receiver returned is None
+    (see runner.py). ``partition_range`` and ``share_group`` select what it
+    consumes (see subscriptions()).
+    """
+    handler = MessageHandlerImpl(recorder, ledger, index if index is not None else open_index(ledger.journal))
+    if not subscribe:
+        return None, handler
+    handler = executor.handoff(handler, handoff_workers, handoff_capacity, handoff_policy, name="ClearSettle")
+    return stage.subscribe(messaging_service, subscriptions(partition_range, share_group), handler), handler
+
+
+def open_ledger(directory: str = JOURNAL_DIR) -> Ledger:
+    """Ledger journalled to ``directory``, rebuilt from what is already there; in memory if None."""
+    if directory is None:
+        return Ledger()
+    journal = Journal(directory, JOURNAL_FSYNC_INTERVAL, JOURNAL_BATCH_SIZE, JOURNAL_SEGMENT_SIZE)
+    ledger = Ledger(journal)
+    started = time.perf_counter()
+    replayed = journal.recover(ledger)
+    if replayed:
+        print(f"Recovered {replayed} postings, {len(ledger.balances)} accounts "
+              f"in {time.perf_counter() - started:.2f}s\n")
+    return ledger
+
+
+def print_cycle(cycle):
+    payers = sum(1 for n in cycle.nets.values() if n < 0)
+    print(f"Settlement cycle {cycle.number}: {cycle.transactions} transactions, "
+          f"gross {codec.from_minor(cycle.gross):,.2f}, net {codec.from_minor(cycle.net):,.2f}, "
+          f"{payers} payers, {len(cycle.nets) - payers} receivers\n")
+
+
+def main():
+    messaging_service = connect()
+    metrics.expose(METRICS_PORT, METRICS_SNAPSHOT_INTERVAL)
+
+    recorder = latency.LatencyRecorder()
+    ledger = open_ledger()
+    direct_receiver = handler = None
+    try:
+        print(f"Subscribing to: {topics}")
+        direct_receiver, handler = start(messaging_service, recorder, ledger)
+        print(f'Direct Subscriber is running? {direct_receiver.is_running()}')
+        try:
+            next_cycle = time.monotonic() + SETTLEMENT_CYCLE
+            while True:
+                time.sleep(REPORT_INTERVAL)
+                print(recorder.report(), "\n")
+                if time.monotonic() >= next_cycle:
+                    next_cycle += SETTLEMENT_CYCLE
+                    print_cycle(ledger.close_cycle())
+        except KeyboardInterrupt:
+            print('\nDisconnecting Messaging Service')
+            print(recorder.report())
+            print_cycle(ledger.close_cycle())
+    finally:
+        print('\nTerminating receiver')
+        if direct_receiver is not None:
+            direct_receiver.terminate()
+        if handler is not None:
+            handler.close()
+        if ledger.journal is not None:
+            ledger.journal.close()
         print('\nDisconnecting Messaging Service')
-finally:
-    print('\nTerminating receiver')
-    direct_receiver.terminate()
-    print('\nDisconnecting Messaging Service')
-    messaging_service.disconnect()
+        messaging_service.disconnect()
+
 
+if __name__ == '__main__':
+    main()
@@ -2,153 +2,282 @@
 
 
 ## Goal: Publisher + Subscriber 
-import ast
 import os
-import time
-
-# Import Solace Python  API modules
-from solace.messaging.messaging_service import MessagingService, ReconnectionListener, ReconnectionAttemptListener, ServiceInterruptionListener, RetryStrategy, ServiceEvent
-from solace.messaging.errors.pubsubplus_client_error import PubSubPlusClientError
-from solace.messaging.publisher.direct_message_publisher import PublishFailureListener
-from solace.messaging.resources.topic_subscription import TopicSubscription
-from solace.messaging.receiver.message_receiver import MessageHandler, InboundMessage
-# from solace.messaging.core.solace_message import SolaceMessage
-from solace.messaging.resources.topic import Topic
-from jproperties import Properties
-
-# Pub topic
+import threading
+
+# Import Solace Python  API modules, or their loopback stand-ins (see transport.py)
+from transport import MessagingService, MessageHandler, InboundMessage
+from publisher import SharedPublisher
+from transactions import Transaction
+import codec
+import executor
+import eventlog
+import latency
+import metrics
+import partitions
+import stage
+import fraud_features
+import watchlist
+from fraud_features import FeatureEngine
+from sharding import ShardedFraudDetector
+from watchlist import Watchlist
+
+# Pub topic, one per partition (see partitions.py)
 TOPIC_TST = "SOLACE/CAPITALMARKETS/TRANSACTION/SETTLE"
+PUBLISH_TOPICS = partitions.PartitionedTopics(TOPIC_TST)
 
 
 #Sub topic
 TOPIC_PREFIX = "SOLACE/CAPITALMARKETS/TRANSACTION/FRAUD_DETECT"
+INPUT_TOPICS = partitions.PartitionedTopics(TOPIC_PREFIX)
 
 SHUTDOWN = False
 
+# Accounts whose velocity features are kept, least recently seen are evicted beyond this
+MAX_TRACKED_ACCOUNTS = 1_000_000
+
+# Screening: with WATCHLIST_PATH, the source and target of every transaction are looked up
+# in that watchlist index and transactions of listed accounts are held. The index is mapped,
+# not loaded, by every process checking transactions; replacing the file swaps the new
+# lists in within watchlist.RELOAD_INTERVAL seconds (see watchlist.py)
+WATCHLIST_PATH = None
+
+# With WORKERS above 0, transactions are checked by that many worker processes,
+# sharded by source account (see sharding.py), instead of on the receiver thread
+WORKERS = 0
+
+# Handoff: with HANDOFF_WORKERS above 0, on_message only queues messages, at most
+# HANDOFF_CAPACITY, for that many worker threads; HANDOFF_POLICY applies when the
+# queue is full and shed messages go to SHED_TOPIC (see executor.py)
+HANDOFF_WORKERS = 0
+HANDOFF_CAPACITY = 10000
+HANDOFF_POLICY = executor.BLOCK
+SHED_TOPIC = TOPIC_PREFIX + "/shed"
+
+# Scale-out: with PARTITION_RANGE, e.g. "0-7", only those partitions of the input are
+# consumed, so instances with disjoint ranges split the load and each keeps the velocity
+# features of its own accounts; with SHARE_GROUP, instances share the subscription and
+# the broker balances messages between them, splitting each account's features across
+# instances (see partitions.py)
+PARTITION_RANGE = None
+SHARE_GROUP = None
+
+# Prometheus metrics on http://localhost:METRICS_PORT/metrics and a JSON snapshot every
+# METRICS_SNAPSHOT_INTERVAL seconds, None to disable either (see metrics.py)
+METRICS_PORT = 9103
+METRICS_SNAPSHOT_INTERVAL = None
+METRICS = metrics.StageMetrics("FraudDetect")
+# Events go to the asynchronous event log (see eventlog.py); per-message ones are sampled
+LOG = eventlog.logger("FraudDetect")
+
 
 # Handle received messages
 class MessageHandlerImpl(MessageHandler):
-    def on_message(self, message: InboundMessage):
-        global transaction_FX
-        global tx_my
+    def __init__(self, publisher: SharedPublisher, features: FeatureEngine = None, downstream=None,
+                 screening: Watchlist = None):
+        self.publisher = publisher
+        self.features = features or FeatureEngine(MAX_TRACKED_ACCOUNTS)
+        self.screening = screening
+        # Fused with the next stage (see runner.py): clean transactions are handed to it, not published
+        self.downstream = downstream
+        # The feature engine is not thread-safe; handoff may run several workers
+        self.lock = threading.Lock()
 
-        payload_str = message.get_payload_as_string()
-        transaction = ast.literal_eval(payload_str)
+    def on_message(self, message: InboundMessage):
+        start = METRICS.received()
+        try:
+            transaction = codec.decode_message(message)
+            if start:
+                start = METRICS.decode_time.lap(start)
+            self.check(transaction, latency.stamps_of(message), start)
+        except Exception:
+            METRICS.messages_failed.inc()
+            raise
+
+    def on_transaction(self, transaction: Transaction, stamps: dict):
+        """Take a transaction already decoded, from a fused upstream stage."""
+        start = METRICS.received()
+        try:
+            self.check(transaction, stamps, start)
+        except Exception:
+            METRICS.messages_failed.inc()
+            raise
+
+    def check(self, transaction: Transaction, stamps: dict, start: int = 0):
+        if self.screening is not None:
+            lists = self.screening.screen(transaction.source, transaction.target)
+            if lists:
+                LOG.warning("watchlist_hit", lists=watchlist.list_names(lists), transaction=transaction)
+                return
+        amount = transaction.amount
+        with self.lock:
+            features = self.features.update(transaction.source, transaction.target, amount)
 
         #Receive the FX
-        if transaction['amount'] >= 900:
-            print("Fraud detected, sent to Compliance officer\n")
+        reason = fraud_features.check_fraud(amount, features)
+        if start:
+            start = METRICS.process_time.lap(start)
+        if reason is not None:
+            LOG.sampled(eventlog.WARNING, "fraud_detected", reason=reason, transaction=transaction)
+            return
+        stamps[latency.stamp_name("FraudDetect")] = latency.now()
+        forward(self.publisher, self.downstream, transaction, stamps)
+        if start and self.downstream is None:
+            METRICS.publish_time.lap(start)
+
+    def close(self):
+        pass
+
+
+class ShardedMessageHandlerImpl(MessageHandler):
+    """Hands transactions to worker processes; verdicts are acted on from the detector's collector thread."""
+
+    def __init__(self, publisher: SharedPublisher, workers: int, downstream=None, watchlist_path: str = None):
+        self.publisher = publisher
+        self.downstream = downstream
+        self.detector = ShardedFraudDetector(workers, self.on_result, MAX_TRACKED_ACCOUNTS,
+                                             watchlist_path=watchlist_path, on_error=self.on_error).start()
+        # The detector's rings take one producer at a time
+        self.lock = threading.Lock()
+
+    @property
+    def depth(self) -> int:
+        """Transactions handed to the workers and awaiting their verdict."""
+        return self.detector.submitted - self.detector.completed
+
+    def on_message(self, message: InboundMessage):
+        METRICS.received()
+        try:
+            stamps = latency.stamps_of(message)
+            with self.lock:
+                self.detector.submit(codec.message_payload(message), stamps)
+        except Exception:
+            METRICS.messages_failed.inc()
+            raise
+
+    def on_transaction(self, transaction: Transaction, stamps: dict):
+        """Take a transaction from a fused upstream stage; it is encoded again for the worker processes."""
+        METRICS.received()
+        try:
+            payload = codec.encode(transaction)
+            with self.lock:
+                self.detector.submit(payload, stamps)
+        except Exception:
+            METRICS.messages_failed.inc()
+            raise
+
+    def on_error(self, payload, stamps: dict):
+        """A worker could not decode or check the transaction."""
+        METRICS.messages_failed.inc()
+        LOG.sampled(eventlog.ERROR, "check_failed", payload=bytes(payload))
+
+    def on_result(self, payload, stamps: dict, reason):
+        if reason == watchlist.REASON:
+            LOG.warning("watchlist_hit", transaction=codec.decode(payload))
+        elif reason is not None:
+            LOG.sampled(eventlog.WARNING, "fraud_detected", reason=reason, transaction=codec.decode(payload))
         else:
-            print("No fraud\n")
-            publish_mesg(str(transaction))
-
-
-# Inner classes for error handling
-class ServiceEventHandler(ReconnectionListener, ReconnectionAttemptListener, ServiceInterruptionListener):
-    def on_reconnected(self, e: ServiceEvent):
-        print("\non_reconnected")
-        print(f"Error cause: {e.get_cause()}")
-        print(f"Message: {e.get_message()}")
-    
-    def on_reconnecting(self, e: "ServiceEvent"):
-        print("\non_reconnecting")
-        print(f"Error cause: {e.get_cause()}")
-        print(f"Message: {e.get_message()}")
-
-    def on_service_interrupted(self, e: "ServiceEvent"):
-        print("\non_service_interrupted")
-        print(f"Error cause: {e.get_cause()}")
-        print(f"Message: {e.get_message()}")
-
-class PublisherErrorHandling(PublishFailureListener):
-    def on_failed_publish(self, e: "FailedPublishEvent"):
-        print("on_failed_publish")
-
-# Broker Config
-solace_configs = Properties()
-with open('solace.properties', 'rb') as read_prop: 
-    solace_configs.load(read_prop)
-
-broker_props = {
-    "solace.messaging.transport.host": solace_configs.get("SOLACE_HOST").data,
-    "solace.messaging.service.vpn-name": solace_configs.get('SOLACE_VPN').data,
-    "solace.messaging.authentication.scheme.basic.username": solace_configs.get("SOLACE_USERNAME").data,
-    "solace.messaging.authentication.scheme.basic.password": solace_configs.get("SOLACE_PASSWORD").data
-    }
-
-# Build A messaging service with a reconnection strategy of 20 retries over an interval of 3 seconds
-# Note: The reconnections strategy could also be configured using the broker properties object
-messaging_service = MessagingService.builder().from_properties(broker_props)\
-                    .with_reconnection_retry_strategy(RetryStrategy.parametrized_retry(20,3))\
-                    .build()
-
-# Blocking connect thread
-messaging_service.connect()
-# print(f'Messaging Service connected? {messaging_service.is_connected}')
-
-# Error Handeling for the messaging service
-service_handler = ServiceEventHandler()
-messaging_service.add_reconnection_listener(service_handler)
-messaging_service.add_reconnection_attempt_listener(service_handler)
-messaging_service.add_service_interruption_listener(service_handler)
-
-def publish_mesg(transaction_str):
-    # Create a direct message publisher and start it
-    direct_publisher = messaging_service.create_direct_message_publisher_builder().build()
-    direct_publisher.set_publish_failure_listener(PublisherErrorHandling())
-    direct_publisher.set_publisher_readiness_listener
-
-    # Blocking Start thread
-    direct_publisher.start()
-
-    outbound_msg = messaging_service.message_builder() \
-                .with_application_message_id("sample_id") \
-                .with_property("application", "samples") \
-                .with_property("language", "Python") \
-                .build(transaction_str)
-
-    msgSeqNum = 1
-
-    print("transaction details: ", str(transaction_str))
-
-    direct_publisher.publish(destination=Topic.of(TOPIC_TST + f"/python/{msgSeqNum}"), message=outbound_msg)
-    direct_publisher.terminate()
-
-
-
-unique_name = ""
-while not unique_name:
-    unique_name = input("Enter your name: ").replace(" ", "")
+            start = METRICS.start()
+            # Stamped once checked, as on the receiver thread, so the stage's latency includes the workers
+            stamps[latency.stamp_name("FraudDetect")] = latency.now()
+            forward(self.publisher, self.downstream, codec.decode(payload), stamps)
+            if start and self.downstream is None:
+                METRICS.publish_time.lap(start)
+
+    def close(self):
+        """Wait for the verdicts still in the workers, then stop them."""
+        self.detector.close()
 
-# Define a Topic subscriptions 
-topics = [TOPIC_PREFIX + "/python/>", TOPIC_PREFIX + "/control/>"]
-topics_sub = []
-for t in topics:
-    topics_sub.append(TopicSubscription.of(t))
 
+def connect() -> MessagingService:
+    """Build and connect the messaging service configured in solace.properties."""
+    return stage.connect(stage.ServiceEventHandler(METRICS, LOG))
 
 
-try:
-    print(f"Subscribed to: {topics}")
-    # Build a Receiver
-    direct_receiver = messaging_service.create_direct_message_receiver_builder().with_subscriptions(topics_sub).build()
-    direct_receiver.start()
-    # Callback for received messages
-    direct_receiver.receive_async(MessageHandlerImpl())
-    if direct_receiver.is_running():
-        print("Connected and Subscribed! Ready to publish\n")
+def publish_mesg(publisher: SharedPublisher, transaction, stamps: dict = None):
+    """Publish on the partition topic of the transaction's source account."""
+    publisher.publish(codec.encode(transaction), PUBLISH_TOPICS.for_account(transaction.source), stamps)
+    METRICS.messages_out.inc()
 
-    
+
+def forward(publisher: SharedPublisher, downstream, transaction, stamps: dict):
+    """Pass a transaction that passed the checks on: to ``downstream`` if fused, else to TOPIC_TST."""
+    LOG.sampled(eventlog.INFO, "no_fraud", transaction=transaction)
+    if downstream is None:
+        publish_mesg(publisher, transaction, stamps)
+    else:
+        METRICS.messages_out.inc()
+        downstream(transaction, stamps)
+
+
+def subscriptions(partition_range: str = PARTITION_RANGE, share_group: str = SHARE_GROUP) -> list:
+    """Input partitions to consume, see PARTITION_RANGE and SHARE_GROUP, plus the control topics."""
+    return INPUT_TOPICS.subscriptions(partition_range, share_group) + [TOPIC_PREFIX + "/control/>"]
+
+
+# Define a Topic subscriptions 
+topics = subscriptions()
+
+
+def start(messaging_service: MessagingService, workers: int = WORKERS,
+          handoff_workers: int = HANDOFF_WORKERS, handoff_capacity: int = HANDOFF_CAPACITY,
+          handoff_policy: str = HANDOFF_POLICY, partition_range: str = PARTITION_RANGE,
+          share_group: str = SHARE_GROUP, downstream=None, subscribe: bool = True,
+          watchlist_path: str = WATCHLIST_PATH):
+    """Subscribe the stage on a connected messaging service.
+
+    Returns the running receiver, the publisher it republishes with and the
+    message handler, which must be closed after the receiver is terminated.
+    With ``downstream``, clean transactions are handed to it instead of
+    published; with ``subscribe`` False, the stage is only fed through the
+    handler's on_transaction and the receiver returned is None (see runner.py).
+    ``partition_range`` and ``share_group`` select what it consumes (see subscriptions()).
+    ``watchlist_path`` is the index accounts are screened against, None for no screening.
+    """
+    # One publisher for the lifetime of the process, started before any message arrives
+    publisher = SharedPublisher(messaging_service, stage.PublisherErrorHandling(METRICS, LOG), METRICS.stage).start()
+
+    if workers > 0:
+        handler = ShardedMessageHandlerImpl(publisher, workers, downstream, watchlist_path)
+    else:
+        screening = Watchlist(watchlist_path) if watchlist_path else None
+        handler = MessageHandlerImpl(publisher, downstream=downstream, screening=screening)
+    if not subscribe:
+        return None, publisher, handler
+    handler = executor.handoff(handler, handoff_workers, handoff_capacity, handoff_policy,
+                               executor.shed_to(publisher, SHED_TOPIC), "FraudDetect")
+    return stage.subscribe(messaging_service, subscriptions(partition_range, share_group), handler), \
+        publisher, handler
+
+
+def main():
+    messaging_service = connect()
+    metrics.expose(METRICS_PORT, METRICS_SNAPSHOT_INTERVAL)
+
+    unique_name = ""
+    while not unique_name:
+        unique_name = input("Enter your name: ").replace(" ", "")
+
+    direct_receiver = publisher = handler = None
     try:
-        while not SHUTDOWN:            
-              time.sleep(0.1)
-    except KeyboardInterrupt:
-        print('\nDisconnecting Messaging Service')
-    except PubSubPlusClientError as exception:
-        print(f'Received a PubSubPlusClientException: {exception}')
-
-finally:
-    print('Terminating Publisher and Receiver')
-    direct_receiver.terminate()
-    print('Disconnecting Messaging Service')
-    messaging_service.disconnect()
+        print(f"Subscribed to: {topics}")
+        direct_receiver, publisher, handler = start(messaging_service)
+        if direct_receiver.is_running():
+            print("Connected and Subscribed! Ready to publish\n")
+
+        stage.wait(lambda: SHUTDOWN)
+
+    finally:
+        print('Terminating Publisher and Receiver')
+        if direct_receiver is not None:
+            direct_receiver.terminate()
+        if handler is not None:
+            handler.close()
+        if publisher is not None:
+            publisher.terminate()
+        print('Disconnecting Messaging Service')
+        messaging_service.disconnect()
+
+
+if __name__ == '__main__':
+    main()
@@ -4,115 +4,163 @@ import os
 import platform
 import time
 
-# Import Solace Python  API modules from the solace package
-from solace.messaging.messaging_service import MessagingService, ReconnectionListener, ReconnectionAttemptListener, ServiceInterruptionListener, RetryStrategy, ServiceEvent
-from solace.messaging.resources.topic import Topic
-from solace.messaging.publisher.direct_message_publisher import PublishFailureListener
-from transactions import create_random_transaction
-from jproperties import Properties
+# Import Solace Python  API modules, or their loopback stand-ins (see transport.py)
+from transport import MessagingService, Topic
+from publisher import FlowControlledPublisher
+from transactions import IdGenerator, iter_encoded_transactions, make_rng
+import eventlog
+import latency
+import loadgen
+import metrics
+import partitions
+import stage
 
 
 if platform.uname().system == 'Windows': os.environ["PYTHONUNBUFFERED"] = "1" # Disable stdout buffer 
 
 MSG_COUNT = 5
+SEED = None # Set to an int for a reproducible transaction stream
+# Number (0-1023) in the ids of this instance's transactions, so that instances
+# generating at the same time never give out the same id; random if None
+GENERATOR_ID = None
 #TOPIC_PREFIX = "samples/hello"
 TOPIC_PREFIX = "SOLACE/CAPITALMARKETS/TRANSACTION"
-
-# Inner classes for error handling
-class ServiceEventHandler(ReconnectionListener, ReconnectionAttemptListener, ServiceInterruptionListener):
-    def on_reconnected(self, e: ServiceEvent):
-        print("\non_reconnected")
-        print(f"Error cause: {e.get_cause()}")
-        print(f"Message: {e.get_message()}")
-    
-    def on_reconnecting(self, e: "ServiceEvent"):
-        print("\non_reconnecting")
-        print(f"Error cause: {e.get_cause()}")
-        print(f"Message: {e.get_message()}")
-
-    def on_service_interrupted(self, e: "ServiceEvent"):
-        print("\non_service_interrupted")
-        print(f"Error cause: {e.get_cause()}")
-        print(f"Message: {e.get_message()}")
-
- 
-class PublisherErrorHandling(PublishFailureListener):
-    def on_failed_publish(self, e: "FailedPublishEvent"):
-        print("on_failed_publish")
-
-# Broker Config. Note: Could pass other properties Look into
-solace_configs = Properties()
-with open('solace.properties', 'rb') as read_prop: 
-    solace_configs.load(read_prop)
-
-broker_props = {
-    "solace.messaging.transport.host": solace_configs.get("SOLACE_HOST").data,
-    "solace.messaging.service.vpn-name": solace_configs.get('SOLACE_VPN').data,
-    "solace.messaging.authentication.scheme.basic.username": solace_configs.get("SOLACE_USERNAME").data,
-    "solace.messaging.authentication.scheme.basic.password": solace_configs.get("SOLACE_PASSWORD").data
-    }
-
-# Build A messaging service with a reconnection strategy of 20 retries over an interval of 3 seconds
-# Note: The reconnections strategy could also be configured using the broker properties object
-messaging_service = MessagingService.builder().from_properties(broker_props)\
-                    .with_reconnection_retry_strategy(RetryStrategy.parametrized_retry(20,3))\
-                    .build()
-
-# Blocking connect thread
-messaging_service.connect()
-print(f'Messaging Service connected? {messaging_service.is_connected}')
-
-# Event Handling for the messaging service
-service_handler = ServiceEventHandler()
-messaging_service.add_reconnection_listener(service_handler)
-messaging_service.add_reconnection_attempt_listener(service_handler)
-messaging_service.add_service_interruption_listener(service_handler)
-
-# Create a direct message publisher and start it
-direct_publisher = messaging_service.create_direct_message_publisher_builder().build()
-direct_publisher.set_publish_failure_listener(PublisherErrorHandling())
-
-# Blocking Start thread
-direct_publisher.start()
-print(f'Direct Publisher ready? {direct_publisher.is_ready()}')
-
-# Prepare outbound message payload and body
-# message_body = "this is the body of the msg"
-
-outbound_msg_builder = messaging_service.message_builder() \
-                .with_application_message_id("sample_id") \
-                .with_property("application", "samples") \
-                .with_property("language", "Python") \
-
-count = 1
-print("\nSend a KeyboardInterrupt to stop publishing\n")
-try: 
-    while True:
-        while count <= MSG_COUNT:
-            topic = Topic.of(TOPIC_PREFIX + f'/python/{count}')
-            #topic = Topic.of(TOPIC_PREFIX )
-
-            transaction: dict = create_random_transaction()
-            message_body = str(transaction)
-
-            # Direct publish the message with dynamic headers and payload
-            outbound_msg = outbound_msg_builder \
-                            .with_application_message_id(f'NEW {count}')\
-                            .build(f'{message_body}')
-            direct_publisher.publish(destination=topic, message=outbound_msg)
-
-            print(f'Published message on {topic}')
-            count += 1
-            time.sleep(0.1)
-        print("\n")
-        count = 1
-        time.sleep(1)
-
-except KeyboardInterrupt:
-    print('\nTerminating Publisher')
-    direct_publisher.terminate()
-    print('\nDisconnecting Messaging Service')
-    messaging_service.disconnect()
-
-
-
+# One topic per partition of the source account (see partitions.py)
+TOPICS = partitions.PartitionedTopics(TOPIC_PREFIX)
+
+# Load generation: with LOAD_SCHEDULE, e.g. "2000" or "1000:30,1000-20000:60", transactions
+# are published open loop at that many per second, on LOAD_THREADS threads with
+# LOAD_PROCESS arrivals, instead of MSG_COUNT at a time (see loadgen.py)
+LOAD_SCHEDULE = None
+LOAD_PROCESS = loadgen.CONSTANT
+LOAD_THREADS = 1
+
+# Prometheus metrics on http://localhost:METRICS_PORT/metrics and a JSON snapshot every
+# METRICS_SNAPSHOT_INTERVAL seconds, None to disable either (see metrics.py)
+METRICS_PORT = 9101
+METRICS_SNAPSHOT_INTERVAL = None
+METRICS = metrics.StageMetrics("GenFinTX")
+# Events go to the asynchronous event log (see eventlog.py); per-message ones are sampled
+LOG = eventlog.logger("GenFinTX")
+
+
+def connect() -> MessagingService:
+    """Build and connect the messaging service configured in solace.properties."""
+    messaging_service = stage.connect(stage.ServiceEventHandler(METRICS, LOG))
+    print(f'Messaging Service connected? {messaging_service.is_connected}')
+    return messaging_service
+
+
+def start(messaging_service: MessagingService):
+    """Start a direct publisher and return it with the outbound message builder.
+
+    The publisher waits out back-pressure and retries failed publishes (see
+    publisher.FlowControlledPublisher).
+    """
+    direct_publisher = FlowControlledPublisher(messaging_service, stage.PublisherErrorHandling(METRICS, LOG),
+                                               METRICS.stage).start()
+
+    return direct_publisher, message_builder(messaging_service)
+
+
+def message_builder(messaging_service: MessagingService):
+    """Outbound message builder; not thread-safe, so every publishing thread needs its own."""
+    # Prepare outbound message payload and body
+    # message_body = "this is the body of the msg"
+
+    return messaging_service.message_builder() \
+                    .with_application_message_id("sample_id") \
+                    .with_property("application", "samples") \
+                    .with_property("language", "Python") \
+
+
+def load_publisher(messaging_service: MessagingService, direct_publisher):
+    """The ``publisher`` of a loadgen.LoadGenerator: each thread publishes with its own message builder."""
+    def publisher(thread: int):
+        outbound_msg_builder = message_builder(messaging_service)
+        sequence = iter(range(1, 1 << 62))
+
+        def publish(payload, stamps: dict):
+            publish_transaction(direct_publisher, outbound_msg_builder, payload, next(sequence), stamps)
+        return publish
+    return publisher
+
+
+def publish_transaction(direct_publisher, outbound_msg_builder, message_body, count: int, stamps: dict = None):
+    """Publish one encoded transaction on its account's partition topic and return the topic.
+
+    The message carries ``stamps`` (see latency.py) plus this stage's publish time.
+    """
+    topic = TOPICS.for_payload(message_body)
+
+    publish_to(direct_publisher, outbound_msg_builder, message_body, topic, f'NEW {count}', stamps)
+    return topic
+
+
+def publish_to(direct_publisher, outbound_msg_builder, message_body, topic: Topic, message_id: str,
+               stamps: dict = None):
+    """Publish one payload on ``topic``, stamped like publish_transaction(); used by replays too."""
+    start = METRICS.start()
+    properties = dict(stamps) if stamps else {}
+    properties[latency.stamp_name("GenFinTX")] = latency.now()
+
+    # Direct publish the message with dynamic headers and payload
+    try:
+        outbound_msg = outbound_msg_builder \
+                        .with_application_message_id(message_id)\
+                        .build(message_body, additional_message_properties=properties)
+        direct_publisher.publish(destination=topic, message=outbound_msg)
+    except Exception:
+        METRICS.messages_failed.inc()
+        raise
+    if start:
+        METRICS.publish_time.lap(start)
+    METRICS.messages_out.inc()
+
+
+def main():
+    messaging_service = connect()
+    metrics.expose(METRICS_PORT, METRICS_SNAPSHOT_INTERVAL)
+    direct_publisher, outbound_msg_builder = start(messaging_service)
+    print(f'Direct Publisher ready? {direct_publisher.is_ready()}')
+
+    if LOAD_SCHEDULE:
+        generator = loadgen.LoadGenerator(loadgen.Schedule.parse(LOAD_SCHEDULE),
+                                          load_publisher(messaging_service, direct_publisher),
+                                          LOAD_PROCESS, LOAD_THREADS, seed=SEED, ids=IdGenerator(GENERATOR_ID))
+        print(f"\nPublishing {LOAD_SCHEDULE}/s, send a KeyboardInterrupt to stop\n")
+        try:
+            print(generator.run())
+        except KeyboardInterrupt:
+            print(generator.report)
+        direct_publisher.terminate()
+        messaging_service.disconnect()
+        return
+
+    # Transactions are generated in bulk, already encoded for the wire
+    payloads = iter_encoded_transactions(rng=make_rng(SEED) if SEED is not None else None,
+                                         ids=IdGenerator(GENERATOR_ID))
+
+    count = 1
+    print("\nSend a KeyboardInterrupt to stop publishing\n")
+    try:
+        while True:
+            while count <= MSG_COUNT:
+                topic = publish_transaction(direct_publisher, outbound_msg_builder, next(payloads), count)
+
+                LOG.sampled(eventlog.INFO, "published", topic=topic.get_name())
+                count += 1
+                time.sleep(0.1)
+            print("\n")
+            count = 1
+            time.sleep(1)
+
+    except KeyboardInterrupt:
+        print('\nTerminating Publisher')
+        direct_publisher.terminate()
+        print('\nDisconnecting Messaging Service')
+        messaging_service.disconnect()
+
+
+if __name__ == '__main__':
+    main()
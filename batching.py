@@ -0,0 +1,109 @@
+"""Size- and time-bounded micro-batching of inbound messages."""
+
+import threading
+import time
+
+import eventlog
+
+LOG = eventlog.logger("batching")
+
+
+class MicroBatcher:
+    """Collects items and hands them to ``flush`` in batches.
+
+    A batch is flushed when it reaches ``max_size`` items, on the thread that
+    added the last item, or ``max_linger`` seconds after its first item arrived,
+    on the batcher's timer thread, whichever comes first. An item therefore waits
+    at most ``max_linger`` plus the time of one flush. Only one flush runs at a
+    time, so batches are handed over in arrival order.
+
+    A flush that raises on the thread adding or flushing raises there. One that
+    raises on the timer thread is logged, counted in ``failed`` and handed to
+    ``on_error(batch, exception)`` if given, and the timer carries on.
+    """
+
+    def __init__(self, flush, max_size: int = 256, max_linger: float = 0.005, on_error=None,
+                 name: str = "micro-batcher"):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self._flush = flush
+        self._on_error = on_error
+        self.name = name
+        self.max_size = max_size
+        self.max_linger = max_linger
+        self._items = []
+        self._deadline = None
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._running = True
+        self.batches = 0
+        self.items = 0
+        self.failed = 0
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def add(self, item):
+        with self._cond:
+            items = self._items
+            items.append(item)
+            if len(items) == 1:
+                self._deadline = time.monotonic() + self.max_linger
+                self._cond.notify()
+            if len(items) < self.max_size:
+                return
+            batch = self._take()
+        self._hand_over(batch)
+
+    def _take(self) -> list:
+        """Detach the buffered batch; called with the condition held.
+
+        The flush lock is taken before the condition is released, so batches are
+        flushed in the order they were taken.
+        """
+        batch, self._items = self._items, []
+        self._deadline = None
+        self._flush_lock.acquire()
+        return batch
+
+    def _hand_over(self, batch: list):
+        try:
+            if batch:
+                self.batches += 1
+                self.items += len(batch)
+                self._flush(batch)
+        finally:
+            self._flush_lock.release()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and self._deadline is None:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                delay = self._deadline - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                batch = self._take()
+            try:
+                self._hand_over(batch)
+            except Exception as exception:  # one bad batch must not stop the timer
+                self.failed += 1
+                LOG.error("batch_failed", batcher=self.name, items=len(batch), cause=repr(exception))
+                if self._on_error is not None:
+                    self._on_error(batch, exception)
+
+    def flush(self):
+        """Flush whatever is buffered now."""
+        with self._cond:
+            batch = self._take()
+        self._hand_over(batch)
+
+    def close(self):
+        """Flush the remaining items and stop the timer thread."""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
+        self.flush()
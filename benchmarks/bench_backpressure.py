@@ -0,0 +1,149 @@
+"""Publishing through a broker slowdown: back-pressure, retries and spilling against an elastic buffer.
+
+Transactions are published open loop by loadgen.py at --rate msg/s on the
+loopback broker. After --at seconds the broker takes messages at only
+--slow-factor of that rate for --slowdown seconds, and reports --fail-rate of
+the publishes failed meanwhile. Each publishing mode gets a fresh broker:
+
+* elastic: the API buffers without bound and failed publishes are lost, as
+  before publisher.FlowControlledPublisher;
+* reject: the API buffers --buffer messages, then publishes wait for the
+  publisher to be ready again; failed publishes are still lost;
+* retry: as reject, and failed publishes go to the retry buffer (see
+  retry.py), as do publishes made from when one waited over --stall-timeout
+  until the publisher is ready again;
+* spill: as retry with a retry buffer of --spill-capacity messages, beyond
+  which they spill to a file.
+
+For each mode this prints the messages sent and delivered, those lost, the
+stall time and stall count, the messages retried and spilled, the send lag of
+the generator and the delay from a message's due time to its delivery.
+
+Run from the repository root:
+    python -m benchmarks.bench_backpressure [--rate N] [--duration S] [--slowdown S]
+"""
+
+import argparse
+import contextlib
+import os
+import tempfile
+import threading
+import time
+
+os.environ["SOLACE_TRANSPORT"] = "loopback"
+
+from publisher import FlowControlledPublisher
+import GenFinTX
+import eventlog
+import latency
+import loadgen
+import loopback
+import retry
+
+MODES = ("elastic", "reject", "retry", "spill")
+
+
+class Tap:
+    """Counts the transactions delivered and their delay from due time."""
+
+    def __init__(self):
+        self.count = 0
+        self.delay = latency.Histogram()
+
+    def on_message(self, message):
+        self.delay.record(latency.now() - message.get_property(latency.INTENDED))
+        self.count += 1
+
+
+def slow_down(broker: loopback.LoopbackBroker, rate: float, fail_rate: float, seconds: float):
+    """Throttle ``broker`` to ``rate`` msg/s failing ``fail_rate`` of publishes, then restore it after ``seconds``."""
+    broker.rate, broker.fail_rate = rate, fail_rate
+    time.sleep(seconds)
+    broker.rate, broker.fail_rate = None, 0.0
+
+
+def run(mode: str, args, spill_dir: str) -> dict:
+    broker = loopback.LoopbackBroker()
+    service = loopback.MessagingService.builder().with_broker(broker).build().connect()
+    tap = Tap()
+    receiver = service.create_direct_message_receiver_builder()\
+        .with_subscriptions([loopback.TopicSubscription.of(GenFinTX.TOPIC_PREFIX + "/>")]).build()
+    receiver.start()
+    receiver.receive_async(tap)
+    options = {
+        "elastic": dict(buffer=0, retry_capacity=0),
+        "reject": dict(buffer=args.buffer, retry_capacity=0),
+        "retry": dict(buffer=args.buffer, stall_timeout=args.stall_timeout),
+        "spill": dict(buffer=args.buffer, stall_timeout=args.stall_timeout, retry_capacity=args.spill_capacity,
+                      spill_dir=spill_dir),
+    }[mode]
+    publisher = FlowControlledPublisher(service, name=f"bench-{mode}", **options).start()
+
+    slowdown = threading.Timer(args.at, slow_down,
+                               (broker, args.rate * args.slow_factor, args.fail_rate, args.slowdown))
+    slowdown.daemon = True
+    slowdown.start()
+    report = loadgen.LoadGenerator(loadgen.Schedule([loadgen.Step(args.rate, args.rate, args.duration)]),
+                                   GenFinTX.load_publisher(service, publisher), seed=1).run()
+    slowdown.join()
+
+    # Until every delivery is in and the retry buffer is empty
+    deadline = time.monotonic() + args.drain
+    last = -1
+    while time.monotonic() < deadline:
+        retrying = publisher.retry is not None and len(publisher.retry)
+        if tap.count == last and not retrying:
+            break
+        last = tap.count
+        time.sleep(0.2)
+    result = publisher.metrics()
+    publisher.terminate(0)
+    receiver.terminate(0)
+    service.disconnect()
+
+    lag = loadgen.StepReport(None)
+    for step in report.steps:
+        lag.merge(step)
+    result.update(sent=report.sent, delivered=tap.count, lag=lag.lag.summary(), delay=tap.delay.summary())
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Publishing modes through a broker slowdown")
+    parser.add_argument("--rate", type=int, default=5000, help="offered rate, msg/s")
+    parser.add_argument("--duration", type=float, default=6.0, help="seconds of publishing")
+    parser.add_argument("--at", type=float, default=1.0, help="seconds into the run the slowdown starts")
+    parser.add_argument("--slowdown", type=float, default=2.0, help="seconds the slowdown lasts")
+    parser.add_argument("--slow-factor", type=float, default=0.25, help="broker rate during it, as part of --rate")
+    parser.add_argument("--fail-rate", type=float, default=0.01, help="publishes reported failed during it")
+    parser.add_argument("--buffer", type=int, default=1000, help="API buffer of the rejecting publishers")
+    parser.add_argument("--stall-timeout", type=float, default=0.2,
+                        help="seconds a publish waits before going to the retry buffer")
+    parser.add_argument("--spill-capacity", type=int, default=500, help="retry buffer of the spill mode")
+    parser.add_argument("--drain", type=float, default=30.0, help="seconds to wait for retries to finish")
+    parser.add_argument("--modes", default=",".join(MODES), help="comma separated modes to run")
+    args = parser.parse_args()
+
+    # Every failed publish is logged at error level
+    eventlog.LOG.configure("off")
+    print(f"{args.rate:,} msg/s for {args.duration:g}s; from {args.at:g}s the broker takes "
+          f"{args.rate * args.slow_factor:,.0f} msg/s for {args.slowdown:g}s and fails {args.fail_rate:.1%}\n")
+    print(f"{'mode':<8}{'sent':>8}{'delivered':>10}{'lost':>7}{'stalls':>8}{'stall s':>9}{'deferred':>9}{'retried':>8}"
+          f"{'spilled':>8}{'lag p99 ms':>11}{'lag max ms':>11}{'delay p50 ms':>13}{'delay p99 ms':>13}"
+          f"{'delay max ms':>13}")
+    with tempfile.TemporaryDirectory() as spill_dir:
+        for mode in args.modes.split(","):
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                result = run(mode, args, spill_dir)
+            lag, delay = result['lag'], result['delay']
+            print(f"{mode:<8}{result['sent']:>8,}{result['delivered']:>10,}"
+                  f"{result['sent'] - result['delivered']:>7,}{result['stalls']:>8,}{result['stall_seconds']:>9.2f}"
+                  f"{result['deferred']:>9,}{result.get('retried', 0):>8,}{result.get('spilled', 0):>8,}"
+                  f"{lag['p99'] / 1e6:>11,.1f}{lag['max'] / 1e6:>11,.1f}{delay['p50'] / 1e6:>13,.1f}"
+                  f"{delay['p99'] / 1e6:>13,.1f}{delay['max'] / 1e6:>13,.1f}")
+    print(f"\nretry buffer: up to {retry.MAX_ATTEMPTS} attempts, backoff {retry.BASE_DELAY * 1000:g} ms "
+          f"doubling to {retry.MAX_DELAY:g} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""CalcFX micro-batching: throughput gained versus latency added, per batch size and linger.
+
+For each setting, CalcFX runs alone on a loopback broker and a tap counts what it
+publishes. Throughput is measured by pushing a burst through it, latency (from
+GenFinTX publish to arrival at the tap) at a fixed, moderate offered rate.
+
+Run from the repository root: python -m benchmarks.bench_batching [--count N] [--rate R]
+"""
+
+import argparse
+import contextlib
+import os
+import time
+
+os.environ["SOLACE_TRANSPORT"] = "loopback"
+
+import CalcFX
+import eventlog
+import GenFinTX
+import latency
+import loopback
+from transactions import iter_encoded_transactions
+
+SETTINGS = [(0, 0.0), (8, 0.001), (32, 0.001), (32, 0.005), (128, 0.005), (512, 0.005), (512, 0.02)]
+
+
+class Tap(loopback.MessageHandler):
+    def __init__(self):
+        self.count = 0
+        self.histogram = latency.Histogram()
+
+    def on_message(self, message):
+        sent = message.get_property(latency.stamp_name("GenFinTX"))
+        self.histogram.record(latency.now() - sent)
+        self.count += 1
+
+
+def run(batch_size: int, linger: float, count: int, rate: int):
+    service = loopback.MessagingService.builder().with_broker(loopback.LoopbackBroker()).build().connect()
+    receiver, publisher, handler = CalcFX.start(service, batch_size=batch_size, batch_linger=linger)
+    tap = Tap()
+    tap_receiver = service.create_direct_message_receiver_builder()\
+        .with_subscriptions([loopback.TopicSubscription.of(CalcFX.TOPIC_TST + "/>")]).build()
+    tap_receiver.start()
+    tap_receiver.receive_async(tap)
+    direct_publisher, builder = GenFinTX.start(service)
+
+    def wait_for(n):
+        while tap.count < n:
+            time.sleep(0.0005)
+
+    # Saturation throughput: publish a burst, time until the last message comes out
+    start = time.perf_counter()
+    for payload in iter_encoded_transactions(count):
+        GenFinTX.publish_transaction(direct_publisher, builder, payload, 1)
+    wait_for(count)
+    throughput = count / (time.perf_counter() - start)
+
+    # Latency at a fixed offered rate
+    tap.histogram.reset()
+    interval = 1_000_000_000 // rate
+    paced = count // 4
+    begin = latency.now()
+    for i, payload in enumerate(iter_encoded_transactions(paced)):
+        delay = begin + i * interval - latency.now()
+        if delay > 0:
+            time.sleep(delay / 1e9)
+        GenFinTX.publish_transaction(direct_publisher, builder, payload, 1)
+    wait_for(count + paced)
+
+    direct_publisher.terminate()
+    receiver.terminate()
+    handler.close()
+    publisher.terminate()
+    tap_receiver.terminate()
+    return throughput, tap.histogram.summary()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CalcFX batch size / linger trade-off")
+    parser.add_argument("--count", type=int, default=20000)
+    parser.add_argument("--rate", type=int, default=2000, help="offered rate for the latency run")
+    args = parser.parse_args()
+
+    print(f"{'batch':>6} {'linger ms':>9} {'msg/s':>10} {'p50 us':>9} {'p99 us':>9} {'max us':>9}")
+    for batch_size, linger in SETTINGS:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            throughput, summary = run(batch_size, linger, args.count, args.rate)
+            eventlog.LOG.flush()
+        print(f"{batch_size or 'off':>6} {linger * 1000:>9.1f} {throughput:>10,.0f} {summary['p50'] / 1000:>9.0f}"
+              f" {summary['p99'] / 1000:>9.0f} {summary['max'] / 1000:>9.0f}")
+
+
+if __name__ == '__main__':
+    main()
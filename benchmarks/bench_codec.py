@@ -0,0 +1,40 @@
+"""Per-message encode/decode cost of the binary codec versus str(dict)/literal_eval.
+
+Run from the repository root: python -m benchmarks.bench_codec [count]
+"""
+
+import sys
+import time
+
+import codec
+from transactions import create_random_transaction
+
+
+def per_message_ns(fn, items) -> float:
+    start = time.perf_counter_ns()
+    for item in items:
+        fn(item)
+    return (time.perf_counter_ns() - start) / len(items)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    transactions = [create_random_transaction() for _ in range(count)]
+
+    legacy_payloads = [codec.encode_legacy(t).encode('utf-8') for t in transactions]
+    binary_payloads = [codec.encode(t) for t in transactions]
+
+    rows = [
+        ("str(dict)", codec.encode_legacy, codec.decode_legacy, legacy_payloads),
+        ("binary v%d" % codec.VERSION, codec.encode, codec.decode_binary, binary_payloads),
+        ("binary auto", codec.encode, codec.decode, binary_payloads),
+    ]
+    print(f"{'format':>12} {'bytes':>6} {'encode ns':>10} {'decode ns':>10}")
+    for name, encode, decode, payloads in rows:
+        encode_ns = per_message_ns(encode, transactions)
+        decode_ns = per_message_ns(decode, payloads)
+        print(f"{name:>12} {len(payloads[0]):>6} {encode_ns:>10.0f} {decode_ns:>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
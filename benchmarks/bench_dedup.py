@@ -0,0 +1,98 @@
+"""Duplicate index: memory and lookup cost at 100 million transaction ids a day.
+
+The index ClearSettle uses by default (see dedup.py) is sized for --per-day
+ids in hourly Bloom filters kept for a day, plus the exact ids of the last
+minute. For a few false-positive budgets this prints the bits per id and the
+memory of an hourly filter, of a whole day of filters and of the exact window.
+
+One hourly filter at the default budget is then filled with a full hour of
+ids, and the cost of ``check`` is measured for a new id, a redelivery caught
+by the exact window and an older duplicate only the Bloom filter knows. Fresh
+ids are looked up in the full filter to measure its false-positive rate. A
+smaller filter with a looser budget is filled the same way, so that enough
+false positives are seen to compare with the budget.
+
+Run from the repository root:
+    python -m benchmarks.bench_dedup [--per-day N] [--fp-rate P] [--lookups N]
+"""
+
+import argparse
+import sys
+import time
+
+import dedup
+from transactions import IdGenerator
+
+BUCKET = 3600
+RETENTION = 86400
+WINDOW = 60
+
+
+def exact_window_bytes(ids: int) -> int:
+    """Memory of ``ids`` ids split over the two generations of the exact window."""
+    values = IdGenerator(1).next_ids(ids).tolist()
+    half = ids // 2
+    sets = (set(values[:half]), set(values[half:]))
+    return sum(sys.getsizeof(s) for s in sets) + sum(sys.getsizeof(v) for v in values)
+
+
+def per_check(index: dedup.DedupIndex, ids: list) -> float:
+    """Nanoseconds per ``index.check`` over ``ids``."""
+    started = time.perf_counter_ns()
+    for transaction_id in ids:
+        index.check(transaction_id)
+    return (time.perf_counter_ns() - started) / len(ids)
+
+
+def false_positives(bloom: dedup.BlockedBloomFilter, lookups: int) -> int:
+    """Fresh ids, from a generator that filled nothing, that ``bloom`` claims to hold."""
+    return sum(1 for i in IdGenerator(1023).next_ids(lookups).tolist() if i in bloom)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Duplicate index memory and lookup cost")
+    parser.add_argument("--per-day", type=int, default=100_000_000, help="transaction ids a day")
+    parser.add_argument("--fp-rate", type=float, default=1e-6, help="false-positive budget of the filled filter")
+    parser.add_argument("--lookups", type=int, default=1_000_000, help="fresh ids looked up for the rate")
+    args = parser.parse_args()
+
+    per_bucket = args.per_day * BUCKET // RETENTION
+    window_ids = args.per_day * WINDOW * 2 // RETENTION
+    print(f"{args.per_day:,} ids a day, {per_bucket:,} per hourly filter, "
+          f"exact window {window_ids:,} ids ({exact_window_bytes(window_ids) / 2**20:,.1f} MiB)\n")
+    print(f"{'fp budget':>10} {'bits/id':>8} {'hour MiB':>9} {'day MiB':>9}")
+    for fp_rate in (1e-4, 1e-6, 1e-8):
+        bits = dedup.bits_per_id(fp_rate)
+        hour = dedup.BlockedBloomFilter(per_bucket, fp_rate).nbytes
+        filters = RETENTION // BUCKET + 1
+        print(f"{fp_rate:>10.0e} {bits:>8.1f} {hour / 2**20:>9,.1f} {hour * filters / 2**20:>9,.1f}")
+
+    index = dedup.DedupIndex(WINDOW, RETENTION, BUCKET, per_bucket, args.fp_rate)
+    ids = IdGenerator(1).next_ids(per_bucket).tolist()
+    new = per_check(index, ids)
+    recent = ids[-args.lookups:]
+    duplicate = per_check(index, recent)
+    # Forget the exact window, so the same ids are only found by the Bloom filter
+    index._recent.clear()
+    index._previous.clear()
+    suspected = per_check(index, recent)
+    bloom, = index.filters.values()
+    print(f"\nhourly filter of {bloom.count:,} ids at {args.fp_rate:.0e}: check() new {new:,.0f} ns, "
+          f"exact duplicate {duplicate:,.0f} ns, Bloom-only duplicate {suspected:,.0f} ns")
+    print(f"at {args.per_day / 86400:,.0f} ids/s on average, checking takes "
+          f"{new * args.per_day / 86400 / 1e9:.2%} of a core")
+    found = false_positives(bloom, args.lookups)
+    print(f"false positives: {found} in {args.lookups:,} fresh ids, "
+          f"{args.fp_rate * args.lookups:.1f} expected at the budget")
+
+    loose = 1e-4
+    check = dedup.BlockedBloomFilter(args.lookups, loose)
+    for i in IdGenerator(2).next_ids(args.lookups).tolist():
+        check.add(i)
+    found = false_positives(check, args.lookups)
+    print(f"false positives at a {loose:.0e} budget: {found / args.lookups:.2e} "
+          f"({found} in {args.lookups:,} fresh ids)")
+
+
+if __name__ == '__main__':
+    main()
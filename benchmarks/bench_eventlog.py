@@ -0,0 +1,82 @@
+"""Event log: pipeline throughput with logging off and on, and the cost of one event to the caller.
+
+The loopback pipeline is run flat out with the event log off, at INFO with
+per-message events sampled 1 in --sample, and at INFO with every event
+logged, written to /dev/null by the background writer. The throughput with
+logging on should be within a few percent of the throughput with it off.
+The caller's cost of one event is then measured on its own, with the writer
+keeping up and with a ring too small for the burst, where events are dropped
+and counted instead of blocking.
+
+Run from the repository root: python -m benchmarks.bench_eventlog [--count N] [--sample N] [--rounds N]
+"""
+
+import argparse
+import os
+import time
+
+os.environ["SOLACE_TRANSPORT"] = "loopback"
+
+import eventlog
+from pipeline import Pipeline
+from transactions import Transaction, iter_encoded_transactions
+
+
+def throughput(count: int) -> float:
+    """Transactions settled per second, publishing ``count`` as fast as possible."""
+    pipeline = Pipeline().start()
+    try:
+        started = time.perf_counter()
+        pipeline.publish(iter_encoded_transactions(count))
+        pipeline.drain()
+        eventlog.LOG.flush()
+    finally:
+        pipeline.stop()
+    return pipeline.settled.count / (pipeline.settled.last_arrival - started)
+
+
+def emit_cost(capacity: int, count: int, stream) -> tuple:
+    """Nanoseconds per ``Logger.info`` call, and how many of ``count`` events were dropped."""
+    log = eventlog.EventLog(capacity, eventlog.INFO, stream=stream)
+    logger = eventlog.Logger("bench", log)
+    transaction = Transaction("AAAAAAAAAAAA", "BBBBBBBBBBBB", 12345, "EUR")
+    started = time.perf_counter_ns()
+    for _ in range(count):
+        logger.info("settled", transaction=transaction)
+    elapsed = time.perf_counter_ns() - started
+    log.close()
+    return elapsed / count, log.dropped
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Event log overhead")
+    parser.add_argument("--count", type=int, default=20_000, help="transactions through the pipeline")
+    parser.add_argument("--sample", type=int, default=100, help="per-message sample rate for the sampled run")
+    parser.add_argument("--rounds", type=int, default=3, help="pipeline runs per setting, best kept")
+    parser.add_argument("--events", type=int, default=200_000, help="events for the caller cost")
+    args = parser.parse_args()
+
+    with open(os.devnull, "w") as devnull:
+        eventlog.LOG.stream = devnull
+        throughput(min(args.count, 2000))  # warm up
+        settings = (("off", eventlog.OFF, 1), (f"info 1/{args.sample}", eventlog.INFO, args.sample),
+                    ("info all", eventlog.INFO, 1))
+        # Interleaved rounds, best of each, so drift on the host hits every setting alike
+        best = {}
+        for _ in range(args.rounds):
+            for label, level, sample in settings:
+                eventlog.LOG.configure(level, sample)
+                best[label] = max(best.get(label, 0), throughput(args.count))
+        eventlog.LOG.stream = None
+        print(f"{'log':>14} {'settled/s':>10} {'vs off':>8}")
+        for label, _, _ in settings:
+            print(f"{label:>14} {best[label]:>10,.0f} {best[label] / best['off'] - 1:>+8.1%}")
+
+        print(f"\n{'ring':>14} {'ns/event':>10} {'dropped':>8}")
+        for capacity in (eventlog.CAPACITY, 1024):
+            cost, dropped = emit_cost(capacity, args.events, devnull)
+            print(f"{capacity:>14,} {cost:>10,.0f} {dropped:>8,}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""FraudDetect feature engine: update cost per message and memory per tracked account.
+
+Accounts are drawn from a fixed population, so once the engine is warm every
+update touches two known accounts; with --accounts above --max-accounts the
+LRU eviction path is exercised too. Memory is the preallocated array state
+plus the account index, measured with tracemalloc on a second, untimed run.
+
+Run from the repository root: python -m benchmarks.bench_fraud_features [--count N] [--accounts A]
+"""
+
+import argparse
+import random
+import time
+import tracemalloc
+
+from fraud_features import FeatureEngine
+from transactions import _random_account_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fraud feature engine benchmark")
+    parser.add_argument("--count", type=int, default=500_000, help="transactions to update")
+    parser.add_argument("--accounts", type=int, default=100_000, help="distinct accounts in the stream")
+    parser.add_argument("--max-accounts", type=int, default=100_000, help="engine capacity")
+    args = parser.parse_args()
+
+    population = [_random_account_id() for _ in range(args.accounts)]
+    rng = random.Random(1)
+    pairs = [(rng.choice(population), rng.choice(population), rng.randint(100, 100000))
+             for _ in range(args.count)]
+
+    def run(engine):
+        # Simulated clock: 1,000 transactions per second
+        update = engine.update
+        for i, (source, target, amount) in enumerate(pairs):
+            update(source, target, amount, i / 1000)
+
+    engine = FeatureEngine(args.max_accounts)
+    start = time.perf_counter()
+    run(engine)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    measured = FeatureEngine(args.max_accounts)
+    arrays = tracemalloc.get_traced_memory()[0] - before
+    run(measured)
+    total = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    tracked = len(engine)
+    print(f"updates     {args.count:,} in {elapsed:.2f}s "
+          f"({args.count / elapsed:,.0f}/s, {elapsed / args.count * 1e6:.2f} us each)")
+    print(f"tracked     {tracked:,} accounts, {engine.evicted:,} evicted")
+    print(f"arrays      {arrays / args.max_accounts:,.0f} bytes/slot "
+          f"({engine.array_bytes_per_account()} bytes of feature state)")
+    if tracked:
+        print(f"index       {(total - arrays) / tracked:,.0f} bytes/tracked account")
+        print(f"total       {total / 2 ** 20:,.1f} MiB, {total / tracked:,.0f} bytes/tracked account")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Stage fusion: per-hop latency with CalcFX, FraudDetect and ClearSettle fused in memory versus through the broker.
+
+The loopback pipeline is offered --rate transactions/s, open loop, for
+--duration seconds, first with every stage connected through the broker and
+then fused (see runner.py), where only GenFinTX -> CalcFX remains a broker
+hop. --broker-latency adds a fixed delay to every broker delivery, standing
+in for the network round trip of a real broker. Reported: p50 and p99 of each
+hop and end to end, and the saving per fused hop.
+
+Run from the repository root:
+    python -m benchmarks.bench_fusion [--rate R] [--duration SECONDS] [--broker-latency SECONDS]
+"""
+
+import argparse
+import contextlib
+import os
+import time
+
+os.environ["SOLACE_TRANSPORT"] = "loopback"
+
+import eventlog
+import latency
+import loopback
+from pipeline import Pipeline
+from transactions import iter_encoded_transactions
+
+
+def run(fuse: bool, rate: int, duration: float, broker_latency: float) -> latency.LatencyRecorder:
+    pipeline = Pipeline(loopback.LoopbackBroker(latency=broker_latency)).start(fuse=fuse)
+    total = int(rate * duration)
+    interval = 1_000_000_000 // rate
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            start = latency.now()
+            for i, payload in enumerate(iter_encoded_transactions(total)):
+                intended = start + i * interval
+                delay = intended - latency.now()
+                if delay > 0:
+                    time.sleep(delay / 1e9)
+                pipeline.publish_one(payload, i, {latency.INTENDED: intended})
+            pipeline.drain(idle=0.1)
+            eventlog.LOG.flush()
+    finally:
+        pipeline.stop()
+    return pipeline.latency
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fused versus broker-connected stages")
+    parser.add_argument("--rate", type=int, default=1000, help="offered transactions/s")
+    parser.add_argument("--duration", type=float, default=3.0, help="seconds per run")
+    parser.add_argument("--broker-latency", type=float, default=0.0005,
+                        help="delay added to every broker delivery, seconds")
+    args = parser.parse_args()
+
+    results = {fuse: run(fuse, args.rate, args.duration, args.broker_latency) for fuse in (False, True)}
+    print(f"{'hop (us)':<26}{'broker p50':>12}{'broker p99':>12}{'fused p50':>12}{'fused p99':>12}"
+          f"{'saved p50':>12}")
+    names = list(results[False].hops) + ["end to end"]
+    for name in names:
+        broker, fused = ((r.hops[name] if name in r.hops else r.end_to_end).summary() for r in
+                         (results[False], results[True]))
+        print(f"{name:<26}{broker['p50'] / 1000:>12.1f}{broker['p99'] / 1000:>12.1f}"
+              f"{fused['p50'] / 1000:>12.1f}{fused['p99'] / 1000:>12.1f}"
+              f"{(broker['p50'] - fused['p50']) / 1000:>12.1f}")
+    print(f"settled: broker {results[False].count}, fused {results[True].count}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Stage handoff: how long the dispatch thread is held per message, and what each overflow policy costs.
+
+A handler taking --cost microseconds per message is fed at --rate messages/s,
+above what it can sustain, first inline (processing on the calling thread, as
+the stages do without handoff) and then behind a StageExecutor with each
+overflow policy. Reported: p99 and max time spent in on_message, i.e. how long
+the API's dispatch thread would be stalled, messages processed, dropped and
+shed, and p99 time spent waiting in the queue.
+
+Run from the repository root: python -m benchmarks.bench_handoff [--count N] [--rate R] [--cost US]
+"""
+
+import argparse
+import os
+import time
+
+os.environ["SOLACE_TRANSPORT"] = "loopback"
+
+import executor
+import latency
+
+
+class SlowHandler:
+    def __init__(self, cost_us: float):
+        self.cost = cost_us / 1e6
+
+    def on_message(self, message):
+        time.sleep(self.cost)
+
+
+def feed(handler, count: int, rate: int) -> latency.Histogram:
+    """Call ``handler.on_message`` ``count`` times at ``rate``/s; return the time spent per call."""
+    held = latency.Histogram()
+    interval = 1_000_000_000 // rate
+    begin = latency.now()
+    for i in range(count):
+        delay = begin + i * interval - latency.now()
+        if delay > 0:
+            time.sleep(delay / 1e9)
+        start = latency.now()
+        handler.on_message(i)
+        held.record(latency.now() - start)
+    return held
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stage handoff policies")
+    parser.add_argument("--count", type=int, default=5000)
+    parser.add_argument("--rate", type=int, default=5000, help="offered messages/s")
+    parser.add_argument("--cost", type=float, default=300.0, help="handler time per message in us")
+    parser.add_argument("--capacity", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{'mode':>12} {'held p99 us':>12} {'held max us':>12} {'processed':>10} {'dropped':>8}"
+          f" {'shed':>8} {'wait p99 us':>12}")
+
+    held = feed(SlowHandler(args.cost), args.count, args.rate)
+    print(f"{'inline':>12} {held.value_at_percentile(99) / 1000:>12,.0f} {held.max / 1000:>12,.0f}"
+          f" {args.count:>10} {0:>8} {0:>8} {'-':>12}")
+
+    shed = []
+    for policy in executor.POLICIES:
+        stage = executor.StageExecutor(SlowHandler(args.cost), args.workers, args.capacity, policy,
+                                       shed=shed.append, name=policy)
+        held = feed(stage, args.count, args.rate)
+        stage.close()
+        metrics = stage.metrics()
+        print(f"{policy:>12} {held.value_at_percentile(99) / 1000:>12,.0f} {held.max / 1000:>12,.0f}"
+              f" {metrics['processed']:>10} {metrics['dropped']:>8} {metrics['shed']:>8}"
+              f" {metrics['wait_p99'] / 1000:>12,.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Settlement journal: append throughput per group-commit setting, and recovery time.
+
+Appends go through Ledger.post with the journal attached, as in ClearSettle;
+each setting ends with a close() so every posting is durable before the clock
+stops. Recovery replays a journal of --recover-count postings into an empty
+ledger.
+
+Run from the repository root: python -m benchmarks.bench_journal [--count N] [--recover-count N] [--dir DIR]
+"""
+
+import argparse
+import random
+import shutil
+import tempfile
+import time
+
+from journal import Journal
+from ledger import Ledger
+
+# (batch size, fsync interval in seconds, fsync)
+SETTINGS = [(1, 0.0, True), (64, 0.001, True), (1024, 0.01, True), (1024, 0.01, False)]
+
+
+def postings(count: int, accounts: int, seed: int = 1):
+    rng = random.Random(seed)
+    population = [f"ACC{i:09d}" for i in range(accounts)]
+    return [(rng.choice(population), rng.choice(population), rng.randint(100, 100000)) for _ in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Journal append and recovery benchmark")
+    parser.add_argument("--count", type=int, default=100_000, help="postings per append run")
+    parser.add_argument("--recover-count", type=int, default=10_000_000, help="postings in the recovered journal")
+    parser.add_argument("--accounts", type=int, default=1_000_000)
+    parser.add_argument("--dir", help="where to write journals (default: a temporary directory)")
+    args = parser.parse_args()
+
+    base = tempfile.mkdtemp(dir=args.dir)
+    try:
+        sample = postings(args.count, args.accounts)
+        print(f"{'batch':>6} {'interval ms':>11} {'fsync':>6} {'postings/s':>11} {'commits':>8}")
+        for i, (batch_size, interval, fsync) in enumerate(SETTINGS):
+            journal = Journal(f"{base}/append-{i}", interval, batch_size, fsync=fsync)
+            ledger = Ledger(journal)
+            start = time.perf_counter()
+            for source, target, amount in sample:
+                ledger.post(source, target, amount)
+            journal.close()
+            elapsed = time.perf_counter() - start
+            print(f"{batch_size:>6} {interval * 1000:>11.1f} {str(fsync):>6} {args.count / elapsed:>11,.0f}"
+                  f" {journal.commits:>8,}")
+
+        directory = f"{base}/recover"
+        journal = Journal(directory, batch_size=65536, fsync=False)
+        written = 0
+        start = time.perf_counter()
+        while written < args.recover_count:
+            n = min(1_000_000, args.recover_count - written)
+            journal.append_many(postings(n, args.accounts, seed=written))
+            written += n
+        journal.close()
+        print(f"\nwrote {written:,} postings in {time.perf_counter() - start:.1f}s")
+
+        ledger = Ledger()
+        journal = Journal(directory)
+        start = time.perf_counter()
+        replayed = journal.recover(ledger)
+        elapsed = time.perf_counter() - start
+        journal.close()
+        print(f"recovered {replayed:,} postings, {len(ledger.balances):,} accounts in {elapsed:.2f}s "
+              f"({replayed / elapsed:,.0f} postings/s)")
+    finally:
+        shutil.rmtree(base)
+
+
+if __name__ == '__main__':
+    main()
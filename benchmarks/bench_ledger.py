@@ -0,0 +1,52 @@
+"""Settlement ledger: postings per second and the cost of closing a netting cycle.
+
+Transactions move random amounts between accounts drawn from a fixed
+population, so every account both pays and receives and netting compresses
+the gross volume. Closing a cycle walks only the accounts active in it.
+
+Run from the repository root: python -m benchmarks.bench_ledger [--count N] [--accounts A]
+"""
+
+import argparse
+import random
+import time
+
+from ledger import Ledger
+from transactions import _random_account_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ledger posting and netting benchmark")
+    parser.add_argument("--count", type=int, default=1_000_000, help="postings per run")
+    parser.add_argument("--accounts", type=int, default=100_000, help="distinct accounts")
+    args = parser.parse_args()
+
+    population = [_random_account_id() for _ in range(args.accounts)]
+    rng = random.Random(1)
+    postings = [(rng.choice(population), rng.choice(population), rng.randint(100, 100000))
+                for _ in range(args.count)]
+
+    ledger = Ledger()
+    post = ledger.post
+    start = time.perf_counter()
+    for source, target, amount in postings:
+        post(source, target, amount)
+    elapsed = time.perf_counter() - start
+    print(f"post        {args.count / elapsed:>12,.0f} postings/s")
+
+    start = time.perf_counter()
+    cycle = ledger.close_cycle()
+    closed = time.perf_counter() - start
+    print(f"close cycle {closed * 1000:>12,.1f} ms for {len(cycle.nets):,} accounts "
+          f"({cycle.transactions:,} transactions)")
+    print(f"netting     gross {cycle.gross:,} -> net {cycle.net:,} ({cycle.net / cycle.gross:.1%})")
+
+    start = time.perf_counter()
+    for offset in range(0, args.count, 1000):
+        ledger.post_many(postings[offset:offset + 1000])
+    elapsed = time.perf_counter() - start
+    print(f"post_many   {args.count / elapsed:>12,.0f} postings/s (batches of 1,000)")
+
+
+if __name__ == '__main__':
+    main()
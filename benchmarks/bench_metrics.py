@@ -0,0 +1,84 @@
+"""Stage metrics: what the hot-path instrumentation costs per message, against the pipeline at peak rate.
+
+A stage counts a message in and takes its sampled start time, laps the
+decode, process and publish timings and counts a message out. That sequence
+is first run on its own, with timings off, sampled 1 in --sample and on every
+message. The loopback pipeline is then run flat out, and the instrumentation
+of its four stages is compared with the time it spends per settled message.
+The target is to stay under about 1%.
+
+Run from the repository root: python -m benchmarks.bench_metrics [--count N] [--transactions N]
+"""
+
+import argparse
+import contextlib
+import os
+import time
+
+os.environ["SOLACE_TRANSPORT"] = "loopback"
+
+import eventlog
+import metrics
+from pipeline import Pipeline
+from transactions import iter_encoded_transactions
+
+STAGES = 4
+
+
+def instrument(stage: metrics.StageMetrics, count: int) -> float:
+    """Seconds per message for the instrumentation of one stage, loop overhead included."""
+    start_time = time.perf_counter()
+    for _ in range(count):
+        start = stage.received()
+        if start:
+            start = stage.decode_time.lap(start)
+        if start:
+            start = stage.process_time.lap(start)
+        if start:
+            stage.publish_time.lap(start)
+        stage.messages_out.inc()
+    return (time.perf_counter() - start_time) / count
+
+
+def baseline(count: int) -> float:
+    """Seconds per message for an empty loop, subtracted from the instrumented one."""
+    start_time = time.perf_counter()
+    for _ in range(count):
+        pass
+    return (time.perf_counter() - start_time) / count
+
+
+def pipeline_cost(count: int) -> float:
+    """Seconds of pipeline time per settled transaction, publishing as fast as possible."""
+    pipeline = Pipeline().start()
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            started = time.perf_counter()
+            pipeline.publish(iter_encoded_transactions(count))
+            pipeline.drain()
+            eventlog.LOG.flush()
+    finally:
+        pipeline.stop()
+    return (pipeline.settled.last_arrival - started) / pipeline.settled.count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stage metrics overhead")
+    parser.add_argument("--count", type=int, default=1_000_000, help="instrumented messages")
+    parser.add_argument("--transactions", type=int, default=20_000, help="transactions through the pipeline")
+    parser.add_argument("--sample", type=int, default=metrics.TIMING_SAMPLE, help="timing sample rate")
+    args = parser.parse_args()
+
+    per_message = pipeline_cost(args.transactions)
+    empty = baseline(args.count)
+    print(f"pipeline   {per_message * 1e6:>8,.1f} us per settled transaction ({1 / per_message:,.0f}/s)")
+    print(f"{'timings':>10} {'ns/stage':>10} {'x stages':>10} {'of pipeline':>12}")
+    for sample in (0, args.sample, 1):
+        stage = metrics.StageMetrics("bench", metrics.Registry(), sample)
+        cost = max(instrument(stage, args.count) - empty, 0.0)
+        label = "off" if not sample else f"1/{sample}"
+        print(f"{label:>10} {cost * 1e9:>10,.0f} {cost * STAGES * 1e9:>10,.0f} {cost * STAGES / per_message:>12.2%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Transaction model: memory and field access of dicts and Transaction objects.
+
+--count transactions between --accounts accounts are encoded, then decoded
+two ways and kept in memory, as a fraud window or a micro-batch would hold
+them:
+
+* dicts with float amounts, as codec.decode returned them before the
+  Transaction model, each with its own account strings;
+* Transaction objects (see transactions.py), amounts in cents and account
+  ids interned, so an account's transactions share one string.
+
+Memory is what tracemalloc sees allocated while each is built, per million
+transactions; decoding is timed separately, without tracemalloc. Access cost
+is the time to read the amount in cents of every transaction, and its source
+account and amount together, as the fraud features are updated.
+
+Run from the repository root:
+    python -m benchmarks.bench_model [--count N] [--accounts N]
+"""
+
+import argparse
+import time
+import tracemalloc
+
+import codec
+from transactions import Transaction, create_random_transactions, make_rng
+
+_LAYOUT = codec.LAYOUTS[codec.VERSION]
+
+
+def decode_dict(payload) -> dict:
+    """The dict codec.decode returned before the Transaction model."""
+    fields = _LAYOUT.unpack_from(payload)
+    return {
+        'source': fields[3].decode('ascii'),
+        'target': fields[4].decode('ascii'),
+        'amount': codec.from_minor(fields[6]),
+        'currency': fields[5].decode('ascii'),
+        'fx_version': fields[7],
+        'id': fields[8],
+    }
+
+
+def payloads(count: int, accounts: int) -> list:
+    rng = make_rng(7)
+    pool = [a.decode('ascii') for a in create_random_transactions(accounts, rng)['source']]
+    sources = rng.integers(0, accounts, size=count).tolist()
+    targets = rng.integers(0, accounts, size=count).tolist()
+    amounts = rng.integers(100, 100001, size=count).tolist()
+    return [codec.encode(Transaction(pool[s], pool[t], a, "EUR", i + 1))
+            for i, (s, t, a) in enumerate(zip(sources, targets, amounts))]
+
+
+def measure(build):
+    """Build with ``build``; returns the result, the bytes it holds and the seconds building took untraced."""
+    started = time.perf_counter()
+    build()
+    elapsed = time.perf_counter() - started
+    tracemalloc.start()
+    built = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return built, size, elapsed
+
+
+def per_item(fn, count: int) -> float:
+    """Best of three runs of ``fn``, in nanoseconds per transaction."""
+    best = None
+    for _ in range(3):
+        started = time.perf_counter_ns()
+        fn()
+        elapsed = time.perf_counter_ns() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transaction model memory and field access")
+    parser.add_argument("--count", type=int, default=1_000_000, help="transactions held")
+    parser.add_argument("--accounts", type=int, default=100_000, help="distinct accounts")
+    args = parser.parse_args()
+    count = args.count
+    messages = payloads(count, args.accounts)
+    per_million = 1_000_000 / count
+
+    dicts, dict_bytes, dict_time = measure(lambda: [decode_dict(p) for p in messages])
+    objects, object_bytes, object_time = measure(lambda: [codec.decode(p) for p in messages])
+
+    print(f"{count:,} transactions, {args.accounts:,} accounts\n")
+    print(f"{'model':<18} {'MiB per 1M':>11} {'bytes/tx':>9} {'decode ns/tx':>13}")
+    for label, size, elapsed in (("dict", dict_bytes, dict_time), ("Transaction", object_bytes, object_time)):
+        print(f"{label:<18} {size * per_million / 2**20:>11,.1f} {size / count:>9,.0f} {elapsed / count * 1e9:>13,.0f}")
+
+    costs = (
+        ("dict", per_item(lambda: [codec.to_minor(t['amount']) for t in dicts], count),
+         per_item(lambda: [(t['source'], codec.to_minor(t['amount'])) for t in dicts], count)),
+        ("Transaction", per_item(lambda: [t.amount for t in objects], count),
+         per_item(lambda: [(t.source, t.amount) for t in objects], count)),
+    )
+    print(f"\n{'access':<18} {'amount ns':>11} {'source+amount ns':>17}")
+    for label, amount, pair in costs:
+        print(f"{label:<18} {amount:>11,.1f} {pair:>17,.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""Partitioned topics: the cost of picking a topic per message, and scale-out by partition range or shared subscription.
+
+First, the topic of every message is chosen as the stages used to, building a
+Topic with Topic.of, and from the cached partition topics (see partitions.py),
+which also hashes the account out of the payload.
+
+Then --instances copies of the fused CalcFX -> FraudDetect -> ClearSettle
+chain (see runner.py) consume the loopback pipeline's input, split by
+partition range and then through a shared subscription. Transactions come
+from a pool of --accounts accounts, and each one's amount is its sequence
+number, so an account's postings must reach the ledgers in increasing order.
+Reported per mode: transactions settled by each instance, accounts settled by
+more than one instance and postings that arrived out of order.
+
+Run from the repository root:
+    python -m benchmarks.bench_partitions [--count N] [--instances N] [--accounts N]
+"""
+
+import argparse
+import contextlib
+import itertools
+import os
+import time
+
+os.environ["SOLACE_TRANSPORT"] = "loopback"
+
+import codec
+import eventlog
+import GenFinTX
+import loopback
+import partitions
+import runner
+from ledger import Ledger
+from transactions import Transaction, create_encoded_transactions, make_rng
+from transport import Topic
+
+
+class RecordingLedger(Ledger):
+    """Ledger noting each posting's source and amount, in one sequence shared by every instance."""
+
+    def __init__(self, postings: list, sequence):
+        super().__init__()
+        self.postings = postings
+        self.sequence = sequence
+        self.count = 0
+
+    def post(self, source: str, target: str, amount: int):
+        super().post(source, target, amount)
+        self.postings.append((next(self.sequence), source, amount, id(self)))
+        self.count += 1
+
+
+def payloads(count: int, accounts: int, seed: int = 1) -> list:
+    rng = make_rng(seed)
+    pool = [a.decode('ascii') for a in create_encoded_transactions(accounts, rng)['source']]
+    targets = rng.integers(0, accounts, size=count)
+    sources = rng.integers(0, accounts, size=count)
+    return [codec.encode(Transaction(pool[s], pool[t], 100 + i, "EUR"))
+            for i, (s, t) in enumerate(zip(sources.tolist(), targets.tolist()))]
+
+
+def topic_cost(messages: list) -> tuple:
+    """Nanoseconds per message choosing the topic with Topic.of, and from the cached partition topics."""
+    prefix = GenFinTX.TOPIC_PREFIX
+    started = time.perf_counter_ns()
+    for i, _ in enumerate(messages):
+        Topic.of(prefix + f'/python/{i % 5 + 1}')
+    built = (time.perf_counter_ns() - started) / len(messages)
+    topics = partitions.PartitionedTopics(prefix)
+    started = time.perf_counter_ns()
+    for payload in messages:
+        topics.for_payload(payload)
+    cached = (time.perf_counter_ns() - started) / len(messages)
+    return built, cached
+
+
+def scale_out(messages: list, instances: int, shared: bool) -> tuple:
+    """Run ``instances`` fused chains on one broker; returns their ledgers and the shared posting log."""
+    broker = loopback.LoopbackBroker()
+    messaging_service = loopback.MessagingService.builder().with_broker(broker).build().connect()
+    postings, sequence = [], itertools.count()
+    ranges = partitions.split(instances)
+    runners = []
+    for i in range(instances):
+        scale = {"share_group": "calcfx"} if shared else {"partition_range": ranges[i]}
+        runners.append(runner.Runner(messaging_service, runner.STAGES, True,
+                                     ledger=RecordingLedger(postings, sequence),
+                                     options={"CalcFX": scale}).start())
+    direct_publisher, outbound_msg_builder = GenFinTX.start(messaging_service)
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            for i, payload in enumerate(messages):
+                GenFinTX.publish_transaction(direct_publisher, outbound_msg_builder, payload, i)
+            last = -1
+            while len(postings) != last or not all(r._queue.empty() for rn in runners for r in rn.receivers):
+                last = len(postings)
+                time.sleep(0.2)
+            eventlog.LOG.flush()
+    finally:
+        direct_publisher.terminate()
+        for rn in runners:
+            rn.stop()
+        messaging_service.disconnect()
+    return [rn.ledger for rn in runners], postings
+
+
+def report(label: str, ledgers: list, postings: list):
+    owners, last, out_of_order = {}, {}, 0
+    for _, source, amount, ledger in sorted(postings):
+        owners.setdefault(source, set()).add(ledger)
+        if amount < last.get(source, 0):
+            out_of_order += 1
+        last[source] = max(amount, last.get(source, 0))
+    split_accounts = sum(1 for o in owners.values() if len(o) > 1)
+    per_instance = ", ".join(f"{ledger.count:,}" for ledger in ledgers)
+    print(f"{label:<18} {per_instance:>24} {split_accounts:>14,} {out_of_order:>14,}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Partitioned topics and scale-out")
+    parser.add_argument("--count", type=int, default=20_000, help="transactions")
+    parser.add_argument("--instances", type=int, default=2, help="instances of the fused chain")
+    parser.add_argument("--accounts", type=int, default=2_000, help="distinct source and target accounts")
+    args = parser.parse_args()
+
+    messages = payloads(args.count, args.accounts)
+    built, cached = topic_cost(messages)
+    print(f"topic per message: Topic.of {built:,.0f} ns, partition topics {cached:,.0f} ns "
+          f"(crc32 of the account included)\n")
+
+    print(f"{'scale-out':<18} {'settled per instance':>24} {'split accounts':>14} {'out of order':>14}")
+    for label, shared in ((f"ranges {'|'.join(partitions.split(args.instances))}", False),
+                          ("shared group", True)):
+        ledgers, postings = scale_out(messages, args.instances, shared)
+        report(label, ledgers, postings)
+
+
+if __name__ == '__main__':
+    main()
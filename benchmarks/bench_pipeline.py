@@ -0,0 +1,72 @@
+"""End-to-end pipeline latency at fixed offered rates, on the loopback broker.
+
+Transactions are published open loop by loadgen.py: message ``i`` of a step is
+due at ``start + i / rate`` and carries that instant as ``ts.intended``, so a
+generator that falls behind shows up as latency (coordinated omission
+corrected) rather than as a quietly lower rate. The saturation point is the first offered rate the
+pipeline no longer keeps up with: either the rate cannot be published or the
+p99 end-to-end latency exceeds the budget given with ``--slo-us``.
+
+Run from the repository root:
+    python -m benchmarks.bench_pipeline [--rates 500,1000,...] [--duration SECONDS]
+"""
+
+import argparse
+import contextlib
+import os
+
+from pipeline import Pipeline
+import eventlog
+import loadgen
+
+DEFAULT_RATES = "500,1000,2000,5000,10000,20000,40000"
+
+
+def run_step(pipeline: Pipeline, rate: int, duration: float):
+    """Offer ``rate`` msg/s for ``duration`` seconds.
+
+    Returns the rate actually published, the number of transactions settled and
+    the end-to-end latency summary.
+    """
+    pipeline.latency.reset()
+    settled_before = pipeline.settled.count
+    report = pipeline.load(loadgen.Schedule([loadgen.Step(rate, rate, duration)]))
+    achieved = report.sent / report.elapsed
+    pipeline.drain(idle=0.1)
+
+    settled = pipeline.settled.count - settled_before
+    return achieved, settled, pipeline.latency.end_to_end.summary()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offered-rate sweep of the loopback pipeline")
+    parser.add_argument("--rates", default=DEFAULT_RATES, help="comma separated offered rates, msg/s")
+    parser.add_argument("--duration", type=float, default=2.0, help="seconds per rate step")
+    parser.add_argument("--slo-us", type=float, default=50_000, help="p99 end-to-end latency budget, us")
+    args = parser.parse_args()
+
+    pipeline = Pipeline().start()
+    saturation = None
+    print(f"{'offered':>9} {'achieved':>10} {'settled':>9} {'p50 us':>10} {'p99 us':>10} {'p99.9 us':>10} {'max us':>10}")
+    try:
+        for rate in (int(r) for r in args.rates.split(",")):
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                achieved, settled, summary = run_step(pipeline, rate, args.duration)
+                eventlog.LOG.flush()
+            print(f"{rate:>9} {achieved:>10,.0f} {settled:>9} {summary['p50'] / 1000:>10.1f} {summary['p99'] / 1000:>10.1f}"
+                  f" {summary['p99.9'] / 1000:>10.1f} {summary['max'] / 1000:>10.1f}")
+            # Saturated once the generator cannot hold the rate or queues blow the latency budget
+            if saturation is None and (achieved < 0.95 * rate or summary['p99'] / 1000 > args.slo_us):
+                saturation = rate
+        print(pipeline.latency.report())
+    finally:
+        pipeline.stop()
+
+    if saturation is None:
+        print("No saturation within the offered rates")
+    else:
+        print(f"Saturated at {saturation} msg/s offered (rate not held or p99 over {args.slo_us:,.0f} us)")
+
+
+if __name__ == '__main__':
+    main()
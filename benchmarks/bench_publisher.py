@@ -0,0 +1,79 @@
+"""Throughput of one-publisher-per-message versus the long-lived SharedPublisher.
+
+Run from the repository root: python -m benchmarks.bench_publisher [count]
+Uses the transport selected in solace.properties; SOLACE_TRANSPORT=loopback
+measures the client-side cost alone.
+"""
+
+import sys
+import time
+
+from transport import MessagingService, RetryStrategy, Topic
+from jproperties import Properties
+
+from publisher import SharedPublisher
+from transactions import create_random_transaction
+
+TOPIC = Topic.of("SOLACE/CAPITALMARKETS/BENCH/python/1")
+
+
+def connect() -> MessagingService:
+    solace_configs = Properties()
+    with open('solace.properties', 'rb') as read_prop:
+        solace_configs.load(read_prop)
+
+    broker_props = {
+        "solace.messaging.transport.host": solace_configs.get("SOLACE_HOST").data,
+        "solace.messaging.service.vpn-name": solace_configs.get('SOLACE_VPN').data,
+        "solace.messaging.authentication.scheme.basic.username": solace_configs.get("SOLACE_USERNAME").data,
+        "solace.messaging.authentication.scheme.basic.password": solace_configs.get("SOLACE_PASSWORD").data
+        }
+    messaging_service = MessagingService.builder().from_properties(broker_props)\
+                        .with_reconnection_retry_strategy(RetryStrategy.parametrized_retry(20,3))\
+                        .build()
+    messaging_service.connect()
+    return messaging_service
+
+
+def per_message(messaging_service, payloads):
+    """The original publish_mesg(): build, start, publish and terminate per message."""
+    for payload in payloads:
+        direct_publisher = messaging_service.create_direct_message_publisher_builder().build()
+        direct_publisher.start()
+        outbound_msg = messaging_service.message_builder() \
+                    .with_application_message_id("sample_id") \
+                    .with_property("application", "samples") \
+                    .with_property("language", "Python") \
+                    .build(payload)
+        direct_publisher.publish(destination=TOPIC, message=outbound_msg)
+        direct_publisher.terminate()
+
+
+def shared(messaging_service, payloads):
+    with SharedPublisher(messaging_service) as publisher:
+        for payload in payloads:
+            publisher.publish(payload, TOPIC)
+
+
+def run(name, fn, messaging_service, payloads):
+    start = time.perf_counter()
+    fn(messaging_service, payloads)
+    elapsed = time.perf_counter() - start
+    print(f"{name:>12}: {len(payloads):>7} msgs in {elapsed:8.3f}s  {len(payloads) / elapsed:12,.0f} msg/s")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    payloads = [str(create_random_transaction()) for _ in range(count)]
+
+    messaging_service = connect()
+    try:
+        # The per-message path is orders of magnitude slower, keep its sample small
+        run("per-message", per_message, messaging_service, payloads[:max(1, count // 20)])
+        run("shared", shared, messaging_service, payloads)
+    finally:
+        messaging_service.disconnect()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""FraudDetect scaling: transactions checked per second by 1..N sharded worker processes.
+
+The baseline checks on the calling thread, like FraudDetect without workers.
+--rule-cost adds that many microseconds of CPU work to every check, standing
+in for a heavier rule set; scaling is only visible with at least as many free
+cores as workers.
+
+Run from the repository root: python -m benchmarks.bench_sharding [--count N] [--workers W] [--rule-cost US]
+"""
+
+import argparse
+import functools
+import os
+import time
+
+import codec
+import fraud_features
+from sharding import ShardedFraudDetector
+from transactions import iter_encoded_transactions
+
+
+def heavy_check(cost_us: float, amount: int, features: dict):
+    deadline = time.perf_counter() + cost_us / 1e6
+    while time.perf_counter() < deadline:
+        pass
+    return fraud_features.check_fraud(amount, features)
+
+
+def run_inline(payloads, check) -> float:
+    features = fraud_features.FeatureEngine(1_000_000)
+    start = time.perf_counter()
+    for payload in payloads:
+        transaction = codec.decode(payload)
+        amount = transaction.amount
+        check(amount, features.update(transaction.source, transaction.target, amount))
+    return len(payloads) / (time.perf_counter() - start)
+
+
+def run_sharded(payloads, check, workers: int) -> float:
+    detector = ShardedFraudDetector(workers, lambda payload, context, reason: None, check=check).start()
+    start = time.perf_counter()
+    for payload in payloads:
+        detector.submit(payload)
+    detector.close()
+    return len(payloads) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded FraudDetect scaling")
+    parser.add_argument("--count", type=int, default=100_000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="largest worker count")
+    parser.add_argument("--rule-cost", type=float, default=50.0, help="extra CPU microseconds per check")
+    args = parser.parse_args()
+
+    payloads = list(iter_encoded_transactions(args.count))
+    check = functools.partial(heavy_check, args.rule_cost)
+    print(f"{os.cpu_count()} cores, {args.rule_cost:g} us extra per check")
+
+    baseline = run_inline(payloads, check)
+    print(f"{'workers':>8} {'tx/s':>10} {'speedup':>8}")
+    print(f"{'inline':>8} {baseline:>10,.0f} {1:>8.2f}")
+    for workers in range(1, args.workers + 1):
+        rate = run_sharded(payloads, check, workers)
+        print(f"{workers:>8} {rate:>10,.0f} {rate / baseline:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
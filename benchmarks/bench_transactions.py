@@ -0,0 +1,33 @@
+"""Transaction generation rate: per-record Transaction objects versus vectorised batches.
+
+Run from the repository root: python -m benchmarks.bench_transactions [count]
+"""
+
+import sys
+import time
+
+import codec
+from transactions import (create_encoded_transactions, create_random_transaction,
+                          create_random_transactions, iter_encoded_transactions, make_rng)
+
+
+def rate(name, fn, count):
+    start = time.perf_counter()
+    fn(count)
+    elapsed = time.perf_counter() - start
+    print(f"{name:>28}: {count / elapsed:14,.0f} tx/s")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    rng = make_rng(42)
+
+    rate("create_random_transaction", lambda n: [create_random_transaction() for _ in range(n)], count // 20)
+    rate("  + codec.encode", lambda n: [codec.encode(create_random_transaction()) for _ in range(n)], count // 20)
+    rate("create_random_transactions", lambda n: create_random_transactions(n, rng), count)
+    rate("create_encoded_transactions", lambda n: create_encoded_transactions(n, rng).tobytes(), count)
+    rate("iter_encoded_transactions", lambda n: sum(1 for _ in iter_encoded_transactions(n, rng)), count)
+
+
+if __name__ == '__main__':
+    main()
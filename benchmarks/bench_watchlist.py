@@ -0,0 +1,168 @@
+"""Watchlist screening: opening, lookup and hot-swap cost of the memory-mapped index against a Python set.
+
+An index of --entries random account ids is built (see watchlist.py). This
+prints how long it takes to open, to look up a listed and an unlisted account
+and to screen a transaction, next to what a set of the same ids costs to
+load, in memory and per lookup.
+
+A thread then screens continuously while the index file is replaced
+--swaps times by indexes built beforehand; the longest gap between two
+screens shows whether a swap pauses intake. Last, two processes map the index and touch every page, and
+each reports how much of the mapping it holds privately and its proportional
+share of it, from /proc (Linux only).
+
+Run from the repository root:
+    python -m benchmarks.bench_watchlist [--entries N] [--lookups N] [--swaps N]
+"""
+
+import argparse
+import mmap
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import eventlog
+import watchlist
+from transactions import _random_account_ids, make_rng
+
+
+def per_call(fn, values) -> float:
+    """Nanoseconds per ``fn(value)`` over ``values``."""
+    started = time.perf_counter_ns()
+    for value in values:
+        fn(value)
+    return (time.perf_counter_ns() - started) / len(values)
+
+
+def mapping_memory(path: str) -> dict:
+    """Rss, Pss and private kB of this process's mapping of ``path``, from /proc/self/smaps."""
+    memory = {}
+    inside = False
+    with open("/proc/self/smaps") as smaps:
+        for line in smaps:
+            fields = line.split()
+            if '-' in fields[0] and not fields[0].endswith(':'):
+                inside = fields[-1] == path
+            elif inside and fields[0] in ("Rss:", "Pss:", "Private_Clean:", "Private_Dirty:"):
+                memory[fields[0][:-1]] = memory.get(fields[0][:-1], 0) + int(fields[1])
+    return memory
+
+
+def touch(path: str, ready, results):
+    """Child process: map the index, read every page, and report the mapping's memory once all have."""
+    index = watchlist.WatchlistIndex(path)
+    mm = index._mm
+    for offset in range(0, len(mm), mmap.PAGESIZE):
+        mm[offset]
+    ready.wait()
+    results.put(mapping_memory(os.path.realpath(path)))
+    ready.wait()
+    index.close()
+
+
+def hot_swap(path: str, ids, swaps: int, accounts: list) -> tuple:
+    """Longest gap between screens, in us, while the index is replaced ``swaps`` times, and the swaps seen."""
+    # Built first: building holds the interpreter, which would show up as a gap
+    versions = []
+    for version in range(2, swaps + 2):
+        versions.append(f"{path}.{version}")
+        watchlist.build(versions[-1], ids, version=version)
+    screening = watchlist.Watchlist(path, reload_interval=0.0)
+    stop = threading.Event()
+    longest = [0]
+
+    def screen():
+        last = time.perf_counter_ns()
+        i = 0
+        while not stop.is_set():
+            screening.screen(accounts[i % len(accounts)], accounts[(i + 1) % len(accounts)])
+            now = time.perf_counter_ns()
+            longest[0] = max(longest[0], now - last)
+            last = now
+            i += 1
+
+    screener = threading.Thread(target=screen)
+    screener.start()
+    try:
+        for replacement in versions:
+            time.sleep(0.05)
+            os.replace(replacement, path)
+        time.sleep(0.05)
+    finally:
+        stop.set()
+        screener.join()
+    return longest[0] / 1000, screening.reloads
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Watchlist index cost against a Python set")
+    parser.add_argument("--entries", type=int, default=5_000_000, help="listed accounts")
+    parser.add_argument("--lookups", type=int, default=200_000, help="accounts looked up per measurement")
+    parser.add_argument("--swaps", type=int, default=3, help="index replacements while screening")
+    args = parser.parse_args()
+
+    # A line per index installed
+    eventlog.LOG.configure("warning")
+
+    ids = _random_account_ids(make_rng(1), args.entries)
+    listed = [i.decode('ascii') for i in ids[:args.lookups].tolist()]
+    unlisted = [i.decode('ascii') for i in _random_account_ids(make_rng(2), args.lookups).tolist()]
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "watchlist.idx")
+        started = time.perf_counter()
+        entries = watchlist.build(path, ids)
+        built = time.perf_counter() - started
+        size = os.path.getsize(path)
+        print(f"{entries:,} accounts: index built in {built:.1f}s, {size / 2**20:,.1f} MiB "
+              f"({size / entries:.1f} bytes per account)")
+
+        opens = 100
+        started = time.perf_counter()
+        for _ in range(opens):
+            watchlist.WatchlistIndex(path).close()
+        opened = (time.perf_counter() - started) / opens
+        screening = watchlist.Watchlist(path)
+        index = screening.index
+        for account in listed[:1000]:
+            assert index.lookup(account), account
+        pairs = list(zip(listed, unlisted))
+        print(f"index: open {opened * 1000:.3f} ms, lookup listed {per_call(index.lookup, listed):,.0f} ns, "
+              f"unlisted {per_call(index.lookup, unlisted):,.0f} ns, "
+              f"screen a transaction {per_call(lambda p: screening.screen(*p), pairs):,.0f} ns")
+
+        started = time.perf_counter()
+        accounts = set(i.decode('ascii') for i in ids.tolist())
+        loaded = time.perf_counter() - started
+        held = sys.getsizeof(accounts) + sum(sys.getsizeof(a) for a in accounts)
+        print(f"set:   load {loaded * 1000:,.0f} ms, {held / 2**20:,.1f} MiB in every process, "
+              f"lookup listed {per_call(accounts.__contains__, listed):,.0f} ns, "
+              f"unlisted {per_call(accounts.__contains__, unlisted):,.0f} ns")
+        del accounts
+
+        longest, reloads = hot_swap(path, ids, args.swaps, listed)
+        print(f"hot swap: {reloads} of {args.swaps} replacements installed while screening, "
+              f"longest gap between screens {longest:,.0f} us")
+
+        if not os.path.exists("/proc/self/smaps"):
+            print("per-process memory: needs /proc/self/smaps")
+            return
+        processes = 2
+        ready = multiprocessing.Barrier(processes)
+        results = multiprocessing.Queue()
+        children = [multiprocessing.Process(target=touch, args=(path, ready, results)) for _ in range(processes)]
+        for child in children:
+            child.start()
+        memory = [results.get() for _ in children]
+        for child in children:
+            child.join()
+        for i, m in enumerate(memory):
+            print(f"process {i}: mapping resident {m['Rss'] / 1024:,.1f} MiB, proportional share "
+                  f"{m['Pss'] / 1024:,.1f} MiB, private {(m['Private_Clean'] + m['Private_Dirty']) / 1024:,.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+"""Capture the transaction message stream to disk and replay it at real time, N times faster, or flat out.
+
+A capture file is a header, the records, then an index, little endian::
+
+    header  4s magic b'SCAP', H version, 2x, Q index offset, Q record count
+    record  q wall-clock arrival (ns since the epoch), q monotonic arrival (ns),
+            H topic length, I payload length, then the topic (UTF-8) and the payload
+    index   Q offset of every record, in arrival order, 8-byte aligned
+
+The index offset and count are written when the capture is closed; a capture
+cut short by a crash has a zero index offset, and its records are found by
+scanning instead. Reading maps the file and casts the index in place, so a
+multi-gigabyte capture is never loaded into memory: each record is read when
+it is replayed.
+
+Replays keep the relative timing of the capture, divided by ``speed``. Each
+message is due at a time computed from the start of the replay, not from the
+previous message, so pacing errors do not accumulate; the due time is sent as
+the ``ts.intended`` latency stamp.
+
+The default capture topic covers every stage, republished messages included.
+To capture only the pipeline's input, for replaying into it, record
+``SOLACE/CAPITALMARKETS/TRANSACTION/python/>``.
+
+Usage:
+    python capture.py record FILE [--topic TOPIC] [--duration SECONDS]
+    python capture.py replay FILE [--speed N | --max]
+    python capture.py info FILE
+To replay into the in-process pipeline instead: python pipeline.py --replay FILE [--speed N]
+"""
+
+import argparse
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+
+# Import Solace Python  API modules, or their loopback stand-ins (see transport.py)
+from transport import MessageHandler, InboundMessage, TopicSubscription, Topic
+import codec
+import latency
+
+MAGIC = b'SCAP'
+VERSION = 1
+HEADER = struct.Struct('<4sHxxQQ')
+RECORD = struct.Struct('<qqHI')
+
+CAPTURE_TOPIC = "SOLACE/CAPITALMARKETS/TRANSACTION/>"
+
+
+class CaptureWriter(MessageHandler):
+    """Appends every message it receives, or is given, to a capture file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'wb', buffering=1 << 20)
+        self._file.write(HEADER.pack(MAGIC, VERSION, 0, 0))
+        self._offset = HEADER.size
+        self._index = array('Q')
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._index)
+
+    def on_message(self, message: InboundMessage):
+        # String payloads, legacy transactions and FX updates, as their text rather than the SDT-framed bytes
+        self.write(message.get_destination_name(), codec.message_payload(message))
+
+    def write(self, topic: str, payload, wall: int = None, monotonic: int = None):
+        """Append one record; a str ``payload`` is stored as UTF-8."""
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        topic = topic.encode('utf-8')
+        wall = time.time_ns() if wall is None else wall
+        monotonic = latency.now() if monotonic is None else monotonic
+        with self._lock:
+            self._file.write(RECORD.pack(wall, monotonic, len(topic), len(payload)))
+            self._file.write(topic)
+            self._file.write(payload)
+            self._index.append(self._offset)
+            self._offset += RECORD.size + len(topic) + len(payload)
+
+    def close(self):
+        """Write the index and the final header."""
+        with self._lock:
+            # 8-byte aligned, so readers can cast the index in place
+            padding = -self._offset % 8
+            self._file.write(bytes(padding))
+            index_offset = self._offset + padding
+            self._file.write(self._index.tobytes())
+            self._file.seek(0)
+            self._file.write(HEADER.pack(MAGIC, VERSION, index_offset, len(self._index)))
+            self._file.close()
+
+
+class Capture:
+    """Read-only, memory-mapped view of a capture file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, index_offset, count = HEADER.unpack_from(self._mm)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        if version != VERSION:
+            raise ValueError(f"unsupported capture version {version}")
+        if index_offset:
+            self._index = memoryview(self._mm)[index_offset:index_offset + 8 * count].cast('Q')
+        else:
+            self._index = self._scan()
+
+    def _scan(self) -> array:
+        """Index of a capture that was never closed; a torn last record is left out."""
+        index = array('Q')
+        offset = HEADER.size
+        size = len(self._mm)
+        while offset + RECORD.size <= size:
+            _, _, topic_length, payload_length = RECORD.unpack_from(self._mm, offset)
+            end = offset + RECORD.size + topic_length + payload_length
+            if end > size:
+                break
+            index.append(offset)
+            offset = end
+        return index
+
+    def __len__(self):
+        return len(self._index)
+
+    def record(self, i: int):
+        """Return ``(wall_ns, monotonic_ns, topic, payload)`` of record ``i``; the payload is a bytearray."""
+        offset = self._index[i]
+        wall, monotonic, topic_length, payload_length = RECORD.unpack_from(self._mm, offset)
+        start = offset + RECORD.size
+        topic = self._mm[start:start + topic_length].decode('utf-8')
+        start += topic_length
+        return wall, monotonic, topic, bytearray(self._mm[start:start + payload_length])
+
+    def timestamp(self, i: int) -> int:
+        """Monotonic arrival time of record ``i``, without reading the rest of it."""
+        return RECORD.unpack_from(self._mm, self._index[i])[1]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.record(i)
+
+    @property
+    def duration(self) -> float:
+        """Seconds between the first and last record."""
+        if not len(self):
+            return 0.0
+        return (self.timestamp(len(self) - 1) - self.timestamp(0)) / 1e9
+
+    def close(self):
+        if isinstance(self._index, memoryview):
+            self._index.release()
+        self._mm.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def replay(capture: Capture, publish, speed: float = 1.0) -> int:
+    """Hand every record to ``publish(topic, payload, stamps)`` and return how many were replayed.
+
+    Records are due at their captured offset from the first one, divided by
+    ``speed``; a ``speed`` of None or 0 replays as fast as possible.
+    """
+    count = len(capture)
+    if not count:
+        return 0
+    paced = bool(speed)
+    first = capture.timestamp(0)
+    begin = latency.now()
+    for i in range(count):
+        _, monotonic, topic, payload = capture.record(i)
+        stamps = None
+        if paced:
+            due = begin + int((monotonic - first) / speed)
+            delay = due - latency.now()
+            if delay > 0:
+                time.sleep(delay / 1e9)
+            stamps = {latency.INTENDED: due}
+        publish(topic, payload, stamps)
+    return count
+
+
+class TopicCache:
+    """Topic objects by name, so a replay builds each destination once."""
+
+    def __init__(self):
+        self._topics = {}
+
+    def __call__(self, name: str) -> Topic:
+        topic = self._topics.get(name)
+        if topic is None:
+            topic = self._topics[name] = Topic.of(name)
+        return topic
+
+
+def record(messaging_service, writer: CaptureWriter, topic: str = CAPTURE_TOPIC):
+    """Subscribe ``writer`` to ``topic`` and return the running receiver."""
+    direct_receiver = messaging_service.create_direct_message_receiver_builder()\
+                            .with_subscriptions([TopicSubscription.of(topic)])\
+                            .build()
+    direct_receiver.start()
+    direct_receiver.receive_async(writer)
+    return direct_receiver
+
+
+def main():
+    import GenFinTX
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    recording = commands.add_parser("record", help="capture messages to FILE")
+    recording.add_argument("file")
+    recording.add_argument("--topic", default=CAPTURE_TOPIC)
+    recording.add_argument("--duration", type=float, help="seconds to record, until interrupted if omitted")
+    replaying = commands.add_parser("replay", help="publish the messages captured in FILE")
+    replaying.add_argument("file")
+    replaying.add_argument("--speed", type=float, default=1.0, help="1 for real time, N for N times faster")
+    replaying.add_argument("--max", action="store_true", help="replay as fast as possible")
+    info = commands.add_parser("info", help="describe FILE")
+    info.add_argument("file")
+    args = parser.parse_args()
+
+    if args.command == "info":
+        with Capture(args.file) as capture:
+            size = os.path.getsize(args.file)
+            print(f"{len(capture)} messages over {capture.duration:.3f}s, {size:,} bytes")
+        return
+
+    messaging_service = GenFinTX.connect()
+    try:
+        if args.command == "record":
+            writer = CaptureWriter(args.file)
+            direct_receiver = record(messaging_service, writer, args.topic)
+            print(f"Recording {args.topic} to {args.file}, send a KeyboardInterrupt to stop")
+            try:
+                if args.duration:
+                    time.sleep(args.duration)
+                else:
+                    threading.Event().wait()
+            except KeyboardInterrupt:
+                pass
+            direct_receiver.terminate()
+            writer.close()
+            print(f"Recorded {len(writer)} messages")
+        else:
+            direct_publisher, outbound_msg_builder = GenFinTX.start(messaging_service)
+            topics = TopicCache()
+            sequence = iter(range(1, 1 << 62))
+
+            def publish(topic, payload, stamps):
+                GenFinTX.publish_to(direct_publisher, outbound_msg_builder, payload, topics(topic),
+                                    f'REPLAY {next(sequence)}', stamps)
+
+            with Capture(args.file) as capture:
+                started = time.perf_counter()
+                count = replay(capture, publish, None if args.max else args.speed)
+                elapsed = time.perf_counter() - started
+            print(f"Replayed {count} messages in {elapsed:.3f}s")
+            direct_publisher.terminate()
+    finally:
+        messaging_service.disconnect()
+
+
+if __name__ == '__main__':
+    main()
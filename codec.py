@@ -0,0 +1,129 @@
+"""Wire encoding of transactions exchanged between the pipeline stages.
+
+Binary records have a fixed layout per schema version, little endian::
+
+    magic    2s   b'TX'
+    version  B    schema version of the body
+    flags    B    reserved, 0
+    source   12s  account id, ASCII
+    target   12s  account id, ASCII
+    currency 3s   ISO 4217 code, ASCII
+    pad      x
+    amount   q    signed amount in minor units (cents)
+    fx_version I  version of the FX rates the amount was converted with,
+                  0 when not converted (version 2 and later)
+    id       Q    unique id given to the transaction when it was generated,
+                  0 when it has none (version 3 and later)
+
+The header lets a stage read any version it knows about, so producers and
+consumers can be upgraded independently. Payloads that do not start with the
+magic are treated as the original ``str(dict)`` format and parsed with
+``ast.literal_eval``. Both decode to a transactions.Transaction.
+"""
+
+import ast
+import struct
+
+import transactions
+
+MAGIC = b'TX'
+VERSION = 3
+
+HEADER = struct.Struct('<2sBB')
+
+# Body layout of every schema version this module can read, header included
+LAYOUTS = {
+    1: struct.Struct('<2sBB12s12s3sxq'),
+    2: struct.Struct('<2sBB12s12s3sxqI'),
+    3: struct.Struct('<2sBB12s12s3sxqIQ'),
+}
+
+RECORD = LAYOUTS[VERSION]
+RECORD_SIZE = RECORD.size
+
+
+def to_minor(amount) -> int:
+    """Amount in currency units to integer minor units."""
+    return round(amount * 100)
+
+
+def from_minor(amount: int) -> float:
+    return amount / 100
+
+
+def encode(transaction) -> bytearray:
+    """Encode a Transaction as a binary record of the current version."""
+    return bytearray(RECORD.pack(
+        MAGIC, VERSION, 0,
+        transaction.source.encode('ascii'),
+        transaction.target.encode('ascii'),
+        transaction.currency.encode('ascii'),
+        transaction.amount,
+        transaction.fx_version,
+        transaction.id,
+    ))
+
+
+def encode_legacy(transaction) -> str:
+    """Encode a Transaction in the original ``str(dict)`` format."""
+    return str(transaction.to_dict())
+
+
+def is_binary(payload) -> bool:
+    return payload[:2] == MAGIC
+
+
+def decode_binary(payload):
+    """Decode a binary record straight from the inbound buffer.
+
+    ``payload`` may be bytes, bytearray or memoryview; fields are unpacked in
+    place so the payload is never sliced or copied.
+    """
+    magic, version, _flags = HEADER.unpack_from(payload)
+    if magic != MAGIC:
+        raise ValueError("payload is not a binary transaction record")
+    layout = LAYOUTS.get(version)
+    if layout is None:
+        raise ValueError(f"unsupported transaction schema version {version}")
+    fields = layout.unpack_from(payload)
+    return transactions.Transaction(
+        fields[3].decode('ascii'),
+        fields[4].decode('ascii'),
+        fields[6],
+        fields[5].decode('ascii'),
+        fields[8] if version >= 3 else 0,
+        fields[7] if version >= 2 else 0,
+    )
+
+
+def decode_legacy(payload):
+    """Decode the original ``str(dict)`` format, given as str or bytes."""
+    if not isinstance(payload, str):
+        payload = bytes(payload).decode('utf-8')
+    return transactions.Transaction.from_dict(ast.literal_eval(payload.rstrip('\0')))
+
+
+def decode(payload):
+    """Decode either wire format, picking the decoder from the payload header."""
+    if is_binary(payload):
+        return decode_binary(payload)
+    return decode_legacy(payload)
+
+
+def message_payload(message):
+    """The transaction payload of an inbound message: the binary record as bytes, a legacy one as str.
+
+    Legacy payloads were published as strings, which the broker delivers as an
+    SDT string, header included, to ``get_payload_as_bytes()``; only
+    ``get_payload_as_string()`` gives back the text.
+    """
+    payload = message.get_payload_as_bytes()
+    if payload is not None and is_binary(payload):
+        return payload
+    text = message.get_payload_as_string()
+    return text if text is not None else payload
+
+
+def decode_message(message):
+    """Decode the transaction of an inbound message, in either wire format."""
+    return decode(message_payload(message))
@@ -0,0 +1,268 @@
+"""Bounded index of the transaction ids already settled, so a redelivered transaction is not settled twice.
+
+The index keeps two structures:
+
+* the exact ids seen in the last ``window`` seconds, as two sets that take
+  turns every ``window`` seconds. Redeliveries after a reconnect and quick
+  replays land here and are duplicates for certain;
+* Bloom filters, one per ``bucket`` seconds of id time, for the last
+  ``retention`` seconds. An id carries the time it was assigned (see
+  transactions.py), so a lookup probes only the filter of that time. Each
+  filter is sized for ``capacity`` ids at a false-positive rate of
+  ``fp_rate``, and filters older than the retention are dropped whole.
+
+A filter is blocked: all the bits of an id are in one 512-bit block, a single
+cache line, so a lookup touches one line of memory however large the filter
+is, and one Python int operation tests or sets all of the id's bits. Blocks
+fill unevenly, so a blocked filter needs more bits per id than a classic one
+for the same rate; ``bits_per_id`` sizes it for the actual rate.
+
+``check`` records the id and returns one of:
+
+* NEW: never seen, settle it;
+* DUPLICATE: in the exact window;
+* SUSPECTED: only the Bloom filter knows it. It is most likely a duplicate
+  older than the window, but a new id is reported this way at the
+  false-positive rate;
+* UNCHECKED: no id (0, from an older producer), or its time is outside the
+  retention, so the index cannot tell.
+
+The index lives in memory. After a restart, ``seed`` refills it with the ids
+already settled, read back from the settlement journal (see journal.py). Ids
+whose time is within the window go into the exact sets as well, so quick
+redeliveries across the restart are still certain duplicates.
+"""
+
+import math
+import mmap
+import time
+
+import transactions
+
+NEW = "new"
+DUPLICATE = "duplicate"
+SUSPECTED = "suspected"
+UNCHECKED = "unchecked"
+
+BLOCK_BITS = 512
+_BLOCK_BYTES = BLOCK_BITS // 8
+_WORDS = BLOCK_BITS // 64
+_MASK64 = (1 << 64) - 1
+_ID_TIME_SHIFT = transactions.ID_GENERATOR_BITS + transactions.ID_SEQUENCE_BITS
+
+
+def _mix(x: int) -> int:
+    """splitmix64 finaliser: ids that differ in a few low bits get unrelated hashes."""
+    x = (x ^ (x >> 30)) * 0xbf58476d1ce4e5b9 & _MASK64
+    x = (x ^ (x >> 27)) * 0x94d049bb133111eb & _MASK64
+    return x ^ (x >> 31)
+
+
+def _word_masks() -> list:
+    """Per word of a block, the mask of every ordered pair of its bits, as block-wide ints.
+
+    12 bits of an id's hash pick its two bits in a word, independently and
+    uniformly, so the eight lookups of an id's mask set bits exactly as the
+    false-positive model assumes.
+    """
+    return [[1 << (64 * w + (pair >> 6)) | 1 << (64 * w + (pair & 63)) for pair in range(4096)]
+            for w in range(_WORDS)]
+
+
+_masks = None
+
+
+def blocked_fp_rate(bits_per_id: float) -> float:
+    """False-positive rate of a filter of ``bits_per_id`` bits per id, for the bits an id sets here.
+
+    Ids land in blocks as a Poisson process. In a block holding ``j`` ids,
+    each word has taken ``2j`` uniform bits; a fresh id is a false positive if
+    both of its bits, which are the same bit one time in 64, are set in each
+    of the eight words.
+    """
+    load = BLOCK_BITS / bits_per_id
+    term = math.exp(-load)
+    rate = 0.0
+    for j in range(int(load * 4) + 60):
+        unset = (63 / 64) ** (2 * j)
+        one = 1 - unset
+        both = 1 - 2 * unset + (62 / 64) ** (2 * j)
+        rate += term * (one / 64 + both * 63 / 64) ** _WORDS
+        term *= load / (j + 1)
+    return rate
+
+
+def bits_per_id(fp_rate: float) -> float:
+    """Fewest bits per id keeping a blocked filter at ``fp_rate``."""
+    low, high = 1.0, 512.0
+    if blocked_fp_rate(high) > fp_rate:
+        raise ValueError(f"false-positive rate {fp_rate} is too low")
+    for _ in range(30):
+        middle = (low + high) / 2
+        if blocked_fp_rate(middle) > fp_rate:
+            low = middle
+        else:
+            high = middle
+    return high
+
+
+class BlockedBloomFilter:
+    """Bloom filter of ``capacity`` ids at ``fp_rate``, every id's bits in one 512-bit block, two per word."""
+
+    def __init__(self, capacity: int, fp_rate: float):
+        self.capacity = capacity
+        self.blocks = max(1, math.ceil(capacity * bits_per_id(fp_rate) / BLOCK_BITS))
+        # Anonymous memory starts as shared zero pages: a page is only committed once a block in it is written
+        self._bits = mmap.mmap(-1, self.blocks * _BLOCK_BYTES)
+        self.count = 0
+        global _masks
+        if _masks is None:
+            _masks = _word_masks()
+        self._masks = _masks
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._bits)
+
+    def add(self, transaction_id: int) -> bool:
+        """Set the bits of ``transaction_id``; True if they were all set already."""
+        offset, mask = self._locate(transaction_id)
+        end = offset + _BLOCK_BYTES
+        block = int.from_bytes(self._bits[offset:end], 'little')
+        if block & mask == mask:
+            return True
+        self._bits[offset:end] = (block | mask).to_bytes(_BLOCK_BYTES, 'little')
+        self.count += 1
+        return False
+
+    def __contains__(self, transaction_id: int) -> bool:
+        offset, mask = self._locate(transaction_id)
+        return int.from_bytes(self._bits[offset:offset + _BLOCK_BYTES], 'little') & mask == mask
+
+    def _locate(self, transaction_id: int) -> tuple:
+        """Offset of the id's block and the id's mask over the block."""
+        # Two rounds of _mix, inlined: this runs for every transaction settled
+        h = (transaction_id ^ (transaction_id >> 30)) * 0xbf58476d1ce4e5b9 & _MASK64
+        h = (h ^ (h >> 27)) * 0x94d049bb133111eb & _MASK64
+        h ^= h >> 31
+        g = h ^ 0x9e3779b97f4a7c15
+        g = (g ^ (g >> 30)) * 0xbf58476d1ce4e5b9 & _MASK64
+        g = (g ^ (g >> 27)) * 0x94d049bb133111eb & _MASK64
+        g ^= g >> 31
+        m0, m1, m2, m3, m4, m5, m6, m7 = self._masks
+        mask = m0[h & 4095] | m1[h >> 12 & 4095] | m2[h >> 24 & 4095] | m3[h >> 36 & 4095] \
+            | m4[h >> 48 & 4095] | m5[g & 4095] | m6[g >> 12 & 4095] | m7[g >> 24 & 4095]
+        # The block from the top bits of the second hash, unused by the mask
+        return ((g >> 36) * self.blocks >> 28) * _BLOCK_BYTES, mask
+
+
+class DedupIndex:
+    """Exact recent ids plus time-bucketed Bloom filters; not thread-safe, callers serialise ``check``.
+
+    ``capacity`` is the number of ids expected per bucket; the default is 100
+    million a day in hourly buckets. At most ``retention / bucket`` filters,
+    plus one for producers whose clock runs ahead, are kept.
+    """
+
+    def __init__(self, window: float = 60.0, retention: float = 86400.0, bucket: float = 3600.0,
+                 capacity: int = 4_200_000, fp_rate: float = 1e-6, clock=time.time):
+        if not 0 < bucket <= retention:
+            raise ValueError("bucket must be positive and at most the retention")
+        self.window = window
+        self.bucket_ms = int(bucket * 1000)
+        self.buckets = math.ceil(retention / bucket)
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self._clock = clock
+        self._recent = set()
+        self._previous = set()
+        self._rotate_at = clock() + window
+        # Bucket number (id time // bucket) -> filter
+        self.filters = {}
+        self._last_bucket = self._last_filter = None
+        self._last_until = 0.0
+        self.counts = {NEW: 0, DUPLICATE: 0, SUSPECTED: 0, UNCHECKED: 0}
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes held by the Bloom filters, the bulk of the index."""
+        return sum(f.nbytes for f in self.filters.values())
+
+    def __len__(self):
+        """Ids in the exact window."""
+        return len(self._recent) + len(self._previous)
+
+    def _filter(self, bucket: int, now: float):
+        """The filter of ``bucket``, created if it is within the retention; None if it is not."""
+        if bucket == self._last_bucket and now < self._last_until:
+            return self._last_filter
+        current = int(now * 1000) // self.bucket_ms
+        # One bucket of slack for producers whose clock is ahead
+        if not current - self.buckets < bucket <= current + 1:
+            return None
+        bloom = self.filters.get(bucket)
+        if bloom is None:
+            for old in [b for b in self.filters if b <= current - self.buckets]:
+                del self.filters[old]
+            bloom = self.filters[bucket] = BlockedBloomFilter(self.capacity, self.fp_rate)
+        # Most ids are of the current bucket: remember its filter until the bucket ends
+        self._last_bucket, self._last_filter = bucket, bloom
+        self._last_until = (current + 1) * self.bucket_ms / 1000
+        return bloom
+
+    def seed(self, ids) -> int:
+        """Remember ``ids`` as seen without counting them, e.g. after a restart; returns how many were kept."""
+        now = self._clock()
+        recent_ms = int((now - self.window) * 1000)
+        recent = self._recent
+        kept = 0
+        for transaction_id in ids:
+            if not transaction_id:
+                continue
+            at = (transaction_id >> _ID_TIME_SHIFT) + transactions.ID_EPOCH_MS
+            bloom = self._filter(at // self.bucket_ms, now)
+            if bloom is None:
+                continue
+            bloom.add(transaction_id)
+            if at >= recent_ms:
+                recent.add(transaction_id)
+            kept += 1
+        return kept
+
+    def check(self, transaction_id: int, remember: bool = True) -> str:
+        """Classify ``transaction_id`` and remember it; see the module docstring.
+
+        With ``remember`` False the id is only classified, and ``remember()``
+        records it once the transaction is settled, so a settlement that fails
+        leaves the id free for a redelivery.
+        """
+        counts = self.counts
+        if not transaction_id:
+            counts[UNCHECKED] += 1
+            return UNCHECKED
+        now = self._clock()
+        if now >= self._rotate_at:
+            self._previous, self._recent = self._recent, set()
+            self._rotate_at = now + self.window
+        if transaction_id in self._recent or transaction_id in self._previous:
+            counts[DUPLICATE] += 1
+            return DUPLICATE
+        bloom = self._filter(((transaction_id >> _ID_TIME_SHIFT) + transactions.ID_EPOCH_MS) // self.bucket_ms, now)
+        if remember:
+            self._recent.add(transaction_id)
+            seen = bloom is not None and bloom.add(transaction_id)
+        else:
+            seen = bloom is not None and transaction_id in bloom
+        result = UNCHECKED if bloom is None else SUSPECTED if seen else NEW
+        counts[result] += 1
+        return result
+
+    def remember(self, transaction_id: int):
+        """Record ``transaction_id`` as settled after ``check(transaction_id, remember=False)``."""
+        if not transaction_id:
+            return
+        self._recent.add(transaction_id)
+        bloom = self._filter(((transaction_id >> _ID_TIME_SHIFT) + transactions.ID_EPOCH_MS) // self.bucket_ms,
+                             self._clock())
+        if bloom is not None:
+            bloom.add(transaction_id)
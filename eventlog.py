@@ -0,0 +1,228 @@
+"""Asynchronous structured event log, so the stages never write to the console from a message callback.
+
+An event is a level, the stage, an event name and keyword fields. Logging one
+only stores a tuple in a preallocated ring buffer; a background writer drains
+the ring a batch at a time, formats each event as a JSON line and writes the
+batch with one call. Formatting, and any wait on a slow terminal or log pipe,
+is the writer's, never the caller's.
+
+When the ring is full, new events are dropped and counted instead of blocking
+the caller; the count is written as a ``log.dropped`` event once there is room
+again, and exported as the ``log_events_dropped`` metric.
+
+Events below the log level cost a comparison. Per-message events go through
+``Logger.sampled``, which keeps one event in ``sample`` of each name and
+stage. The level and sample rate are read from the ``SOLACE_LOG_LEVEL`` and
+``SOLACE_LOG_SAMPLE`` environment variables, and can be changed at run time
+with ``configure``.
+"""
+
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+
+import metrics
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+OFF = 100
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR, 'off': OFF}
+_NAMES = {level: name.upper() for name, level in LEVELS.items()}
+
+CAPACITY = 65536
+FLUSH_INTERVAL = 0.05
+# Per-message events logged, one in SAMPLE; 1 logs every message
+SAMPLE = 100
+
+
+def _field(value):
+    """JSON form of a field json cannot encode: records such as Transaction by their to_dict()."""
+    to_dict = getattr(value, 'to_dict', None)
+    return to_dict() if to_dict is not None else str(value)
+
+
+def parse_level(level) -> int:
+    """A level number from a number or a name such as ``"info"``."""
+    if isinstance(level, int):
+        return level
+    try:
+        return LEVELS[level.strip().lower()]
+    except KeyError:
+        raise ValueError(f"log level must be one of {tuple(LEVELS)}, got {level!r}") from None
+
+
+class EventLog:
+    def __init__(self, capacity: int = CAPACITY, level=INFO, sample: int = 1, stream=None,
+                 flush_interval: float = FLUSH_INTERVAL):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self.level = parse_level(level)
+        self.sample = max(sample, 1)
+        # None writes to whatever sys.stdout is when a batch is written
+        self.stream = stream
+        self.flush_interval = flush_interval
+        self._slots = [None] * capacity
+        self._head = 0
+        self._size = 0
+        self._lock = threading.Lock()
+        # Serialises writes between the writer thread and flush()
+        self._write_lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self._reported = 0
+        self._writer = None
+        self._running = False
+
+    def configure(self, level=None, sample: int = None):
+        if level is not None:
+            self.level = parse_level(level)
+        if sample is not None:
+            self.sample = max(sample, 1)
+
+    def emit(self, level: int, stage: str, event: str, fields: dict):
+        """Queue an event; if the ring is full, drop it and count it."""
+        record = (time.time_ns(), level, stage, event, fields)
+        with self._lock:
+            if self._size == self.capacity:
+                self.dropped += 1
+                return
+            head = self._head
+            self._slots[head] = record
+            self._head = head + 1 if head + 1 < self.capacity else 0
+            self._size += 1
+        if self._writer is None:
+            self.start()
+
+    def _take(self) -> list:
+        """Remove and return every queued event, oldest first."""
+        with self._lock:
+            size = self._size
+            if not size:
+                return []
+            slots = self._slots
+            tail = self._head - size
+            if tail >= 0:
+                batch = slots[tail:self._head]
+                slots[tail:self._head] = [None] * size
+            else:
+                batch = slots[tail:] + slots[:self._head]
+                slots[tail:] = [None] * -tail
+                slots[:self._head] = [None] * self._head
+            self._size = 0
+            return batch
+
+    def _write(self, batch: list):
+        lines = []
+        dumps = json.dumps
+        for ns, level, stage, event, fields in batch:
+            entry = {'time': ns / 1e9, 'level': _NAMES.get(level, level), 'stage': stage, 'event': event}
+            entry.update(fields)
+            lines.append(dumps(entry, default=_field))
+        dropped = self.dropped
+        if dropped != self._reported:
+            lines.append(dumps({'time': time.time(), 'level': "WARNING", 'stage': "log", 'event': "log.dropped",
+                                'dropped': dropped - self._reported, 'total': dropped}))
+            self._reported = dropped
+        if not lines:
+            return
+        stream = self.stream or sys.stdout
+        try:
+            stream.write("\n".join(lines) + "\n")
+            stream.flush()
+        except (OSError, ValueError):  # closed or broken stream: the events are lost, not the stage
+            return
+        self.written += len(batch)
+
+    def flush(self):
+        """Write everything queued now, on the calling thread."""
+        with self._write_lock:
+            self._write(self._take())
+
+    def _run(self):
+        while self._running:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def start(self):
+        """Start the background writer; done by the first event if not called."""
+        with self._write_lock:
+            if self._writer is not None:
+                return
+            self._running = True
+            self._writer = threading.Thread(target=self._run, name="event-log-writer", daemon=True)
+            self._writer.start()
+
+    def close(self):
+        """Stop the writer and write what is left."""
+        self._running = False
+        writer = self._writer
+        if writer is not None:
+            writer.join()
+            self._writer = None
+        self.flush()
+
+
+class Logger:
+    """Events of one stage, logged to an EventLog."""
+
+    __slots__ = ('stage', 'log', '_ticks')
+
+    def __init__(self, stage: str, log: EventLog = None):
+        self.stage = stage
+        self.log = log or LOG
+        # Events seen since the last one logged, by name
+        self._ticks = {}
+
+    def enabled(self, level: int) -> bool:
+        return level >= self.log.level
+
+    def event(self, level: int, event: str, **fields):
+        if level >= self.log.level:
+            self.log.emit(level, self.stage, event, fields)
+
+    def sampled(self, level: int, event: str, **fields):
+        """Log one in ``sample`` of the per-message events named ``event``."""
+        log = self.log
+        if level < log.level:
+            return
+        ticks = self._ticks
+        tick = ticks.get(event, 0) + 1
+        if tick < log.sample:
+            ticks[event] = tick
+            return
+        ticks[event] = 0
+        log.emit(level, self.stage, event, fields)
+
+    def debug(self, event: str, **fields):
+        if DEBUG >= self.log.level:
+            self.log.emit(DEBUG, self.stage, event, fields)
+
+    def info(self, event: str, **fields):
+        if INFO >= self.log.level:
+            self.log.emit(INFO, self.stage, event, fields)
+
+    def warning(self, event: str, **fields):
+        if WARNING >= self.log.level:
+            self.log.emit(WARNING, self.stage, event, fields)
+
+    def error(self, event: str, **fields):
+        if ERROR >= self.log.level:
+            self.log.emit(ERROR, self.stage, event, fields)
+
+
+LOG = EventLog(level=os.environ.get("SOLACE_LOG_LEVEL", "info"),
+               sample=int(os.environ.get("SOLACE_LOG_SAMPLE", SAMPLE)))
+atexit.register(LOG.close)
+metrics.REGISTRY.gauge("log_events_dropped", "Events dropped because the event log ring was full",
+                       lambda: LOG.dropped)
+
+
+def logger(stage: str) -> Logger:
+    """Logger for ``stage`` on the process-wide event log."""
+    return Logger(stage, LOG)
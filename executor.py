@@ -0,0 +1,182 @@
+"""Bounded handoff between the messaging API's dispatch thread and a stage's logic.
+
+A StageExecutor wraps a stage's message handler. Its ``on_message`` only puts
+the message on a bounded queue and returns, so the dispatch thread is never
+held up by printing, republishing or slow rules; a pool of worker threads
+takes messages off the queue and runs the wrapped handler.
+
+When the queue is full the overflow policy decides what happens:
+
+* ``block``: the dispatch thread waits for room. Nothing is lost here, but the
+  API's own buffers fill up instead;
+* ``drop-oldest``: the longest waiting message is discarded to make room;
+* ``shed``: the new message is handed to a shed function instead, typically
+  republishing it on an overflow topic (see ``shed_to``).
+
+With more than one worker, messages are processed concurrently and may
+complete out of order; the wrapped handler must then be thread-safe.
+"""
+
+import threading
+from collections import deque
+
+from transport import MessageHandler, Topic
+import eventlog
+import latency
+import metrics
+
+BLOCK = "block"
+DROP_OLDEST = "drop-oldest"
+SHED = "shed"
+POLICIES = (BLOCK, DROP_OLDEST, SHED)
+
+
+def shed_to(publisher, topic: str):
+    """Shed function republishing the message, properties included, on ``topic``."""
+    destination = Topic.of(topic)
+
+    def shed(message):
+        publisher.publish(message.get_payload_as_bytes(), destination, message.get_properties())
+    return shed
+
+
+class StageExecutor(MessageHandler):
+    def __init__(self, handler, workers: int = 1, capacity: int = 10000, policy: str = BLOCK,
+                 shed=None, name: str = "stage"):
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        if policy not in POLICIES:
+            raise ValueError(f"policy must be one of {POLICIES}, got {policy!r}")
+        if policy == SHED and shed is None:
+            raise ValueError("the shed policy needs a shed function")
+        self.handler = handler
+        self.name = name
+        self.capacity = capacity
+        self.policy = policy
+        self._shed = shed
+        # (enqueued at, message)
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._running = True
+
+        # Metrics, updated under the lock
+        self.wait_time = latency.Histogram()
+        # Time from enqueue to dequeue, exported as a summary; a new executor of the stage starts afresh
+        metrics.REGISTRY.timing("handoff_wait_seconds", "Time messages wait in the handoff queue",
+                                stage=name).histogram = self.wait_time
+        self.enqueued = 0
+        self.processed = 0
+        self.dropped = 0
+        self.shed = 0
+        self.blocked = 0
+        self.errors = 0
+        self.max_depth = 0
+        metrics.REGISTRY.gauge("handoff_queue_depth", "Messages waiting in the handoff queue",
+                               lambda: len(self._queue), stage=name)
+        # Shared by the executors of a stage, so they keep counting across restarts
+        counter = metrics.REGISTRY.counter
+        self._dropped_total = counter("handoff_dropped_total", "Messages dropped by the handoff queue", stage=name)
+        self._shed_total = counter("handoff_shed_total", "Messages shed by the handoff queue", stage=name)
+        self._errors_total = counter("handoff_errors_total", "Messages whose handler raised on a handoff worker",
+                                     stage=name)
+        self._log = eventlog.logger(name)
+
+        self._threads = [threading.Thread(target=self._run, name=f"{name}-worker-{i}", daemon=True)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    def on_message(self, message):
+        queue = self._queue
+        overflow = None
+        with self._lock:
+            if len(queue) >= self.capacity:
+                if self.policy == BLOCK:
+                    self.blocked += 1
+                    while len(queue) >= self.capacity and self._running:
+                        self._not_full.wait()
+                elif self.policy == DROP_OLDEST:
+                    queue.popleft()
+                    self.dropped += 1
+                    self._dropped_total.inc()
+                else:
+                    self.shed += 1
+                    self._shed_total.inc()
+                    overflow = message
+            if overflow is None:
+                queue.append((latency.now(), message))
+                self.enqueued += 1
+                if len(queue) > self.max_depth:
+                    self.max_depth = len(queue)
+                self._not_empty.notify()
+        if overflow is not None:
+            self._shed(overflow)
+
+    def _run(self):
+        queue = self._queue
+        handler = self.handler
+        while True:
+            with self._lock:
+                while not queue and self._running:
+                    self._not_empty.wait()
+                if not queue:
+                    return
+                enqueued_at, message = queue.popleft()
+                self.wait_time.record(latency.now() - enqueued_at)
+                self._not_full.notify()
+            try:
+                handler.on_message(message)
+            except Exception as exception:  # one bad message must not kill the worker
+                with self._lock:
+                    self.errors += 1
+                    self._errors_total.inc()
+                self._log.sampled(eventlog.ERROR, "handler_failed", cause=repr(exception))
+            with self._lock:
+                self.processed += 1
+
+    def metrics(self) -> dict:
+        """Queue depth, wait time in the queue (ns) and overflow counts."""
+        with self._lock:
+            wait = self.wait_time.summary()
+            return {
+                'depth': len(self._queue),
+                'max_depth': self.max_depth,
+                'capacity': self.capacity,
+                'enqueued': self.enqueued,
+                'processed': self.processed,
+                'dropped': self.dropped,
+                'shed': self.shed,
+                'blocked': self.blocked,
+                'errors': self.errors,
+                'wait_p50': wait['p50'],
+                'wait_p99': wait['p99'],
+                'wait_max': wait['max'],
+            }
+
+    def close(self):
+        """Process what is queued, stop the workers, then close the wrapped handler."""
+        with self._lock:
+            self._running = False
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+        for thread in self._threads:
+            thread.join()
+        close = getattr(self.handler, 'close', None)
+        if close is not None:
+            close()
+
+
+def handoff(handler, workers: int, capacity: int = 10000, policy: str = BLOCK, shed=None,
+            name: str = "stage"):
+    """Wrap ``handler`` in a StageExecutor, or return it as is when ``workers`` is 0."""
+    if workers <= 0:
+        return handler
+    return StageExecutor(handler, workers, capacity, policy, shed, name)
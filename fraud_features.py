@@ -0,0 +1,222 @@
+"""Per-account velocity and aggregate features for fraud detection, in bounded memory.
+
+Every tracked account owns one slot in a set of flat, preallocated arrays:
+
+* for each window (1 minute, 1 hour, 24 hours by default) a ring of time
+  buckets holding a transaction count and an amount sum, plus running totals of
+  the ring, so reading a window is O(1);
+* the last few counterparties, as CRC-32 hashes, for new-counterparty detection;
+* the time the account was last seen.
+
+An account's windows cover every transaction it took part in, as source or target.
+
+Windows slide incrementally: when an account is updated, only the buckets that
+went out of its window since its previous update are subtracted from the
+totals and cleared. Memory is fixed by ``max_accounts``. The least recently
+seen account is evicted to make room for a new one, and accounts idle for
+longer than ``idle_ttl`` are evicted as updates pass by.
+"""
+
+import time
+import zlib
+from array import array
+from collections import OrderedDict
+
+# (name, bucket width in seconds, number of buckets)
+DEFAULT_WINDOWS = (
+    ("1m", 10, 6),
+    ("1h", 600, 6),
+    ("24h", 3 * 3600, 8),
+)
+
+_NEVER = -2 ** 62
+
+
+def _account_hash(account: str) -> int:
+    # 0 marks an empty counterparty entry
+    return zlib.crc32(account.encode('ascii')) or 1
+
+
+# Fraud rules, amounts in minor units
+MAX_AMOUNT = 900_00
+MAX_COUNT_1M = 20
+MAX_SUM_1H = 10_000_00
+MAX_NEW_COUNTERPARTIES_1H = 10
+
+
+# Every reason check_fraud can give, None (no fraud) first, then watchlist screening's (see watchlist.py)
+REASONS = (None, "amount", "velocity", "hourly volume", "new counterparty burst", "watchlist")
+
+
+def check_fraud(amount: int, features: dict):
+    """Return the reason the transaction looks fraudulent, or None."""
+    if amount >= MAX_AMOUNT:
+        return "amount"
+    if features['source_count_1m'] > MAX_COUNT_1M or features['target_count_1m'] > MAX_COUNT_1M:
+        return "velocity"
+    if features['source_sum_1h'] > MAX_SUM_1H:
+        return "hourly volume"
+    # Many payments in a short time, to someone not paid before
+    if features['new_counterparty'] and features['source_count_1h'] > MAX_NEW_COUNTERPARTIES_1H:
+        return "new counterparty burst"
+    return None
+
+
+class FeatureEngine:
+    def __init__(self, max_accounts: int = 1_000_000, windows=DEFAULT_WINDOWS,
+                 counterparties: int = 8, idle_ttl: float = None):
+        if max_accounts < 2:
+            raise ValueError("max_accounts must hold at least a source and a target")
+        self.max_accounts = max_accounts
+        self.windows = tuple(windows)
+        self.idle_ttl = idle_ttl if idle_ttl is not None else max(w * n for _, w, n in self.windows)
+        self._n_windows = len(self.windows)
+        # Offset of each window's buckets inside an account's bucket block
+        # (window index, bucket width, number of buckets, offset, zeroed buckets)
+        self._layout = []
+        buckets = 0
+        for w, (_, width, n) in enumerate(self.windows):
+            self._layout.append((w, width, n, buckets, array('i', bytes(4 * n)), array('q', bytes(8 * n))))
+            buckets += n
+        self._n_buckets = buckets
+        self._n_counterparties = counterparties
+        self._feature_names = [(f'{role}_count_{name}', f'{role}_sum_{name}')
+                               for role in ('source', 'target') for name, _, _ in self.windows]
+
+        n = max_accounts
+        self._bucket_counts = array('i', bytes(4 * n * buckets))
+        self._bucket_sums = array('q', bytes(8 * n * buckets))
+        self._total_counts = array('i', bytes(4 * n * self._n_windows))
+        self._total_sums = array('q', bytes(8 * n * self._n_windows))
+        self._epochs = array('q', bytes(8 * n * self._n_windows))
+        self._counterparties = array('I', bytes(4 * n * counterparties))
+        self._counterparty_next = array('B', bytes(n))
+        self._last_seen = array('d', bytes(8 * n))
+
+        self._slots = OrderedDict()
+        self._free = list(range(n - 1, -1, -1))
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._slots)
+
+    def array_bytes_per_account(self) -> int:
+        """Bytes of preallocated array state per account slot (excludes the id index)."""
+        arrays = (self._bucket_counts, self._bucket_sums, self._total_counts, self._total_sums,
+                  self._epochs, self._counterparties, self._counterparty_next, self._last_seen)
+        return sum(len(a) * a.itemsize for a in arrays) // self.max_accounts
+
+    # Slot management
+
+    def _evict(self, account: str):
+        slot = self._slots.pop(account)
+        self._free.append(slot)
+        self.evicted += 1
+
+    def _slot(self, account: str, now: float) -> int:
+        slots = self._slots
+        slot = slots.get(account)
+        if slot is not None:
+            slots.move_to_end(account)
+            self._last_seen[slot] = now
+            return slot
+
+        # Expire idle accounts from the cold end, then make room if still full
+        cutoff = now - self.idle_ttl
+        while slots:
+            oldest = next(iter(slots))
+            if self._last_seen[slots[oldest]] >= cutoff:
+                break
+            self._evict(oldest)
+        if not self._free:
+            self._evict(next(iter(slots)))
+
+        slot = self._free.pop()
+        self._clear(slot)
+        self._last_seen[slot] = now
+        slots[account] = slot
+        return slot
+
+    def _clear(self, slot: int):
+        # An epoch far in the past makes the next _advance expire every bucket
+        w = slot * self._n_windows
+        for i in range(w, w + self._n_windows):
+            self._epochs[i] = _NEVER
+        c = slot * self._n_counterparties
+        for i in range(c, c + self._n_counterparties):
+            self._counterparties[i] = 0
+        self._counterparty_next[slot] = 0
+
+    # Windows
+
+    def _advance(self, slot: int, now: float, amount: int):
+        """Slide every window of ``slot`` to ``now``, add one transaction, return the totals."""
+        counts, sums = self._bucket_counts, self._bucket_sums
+        total_counts, total_sums, epochs = self._total_counts, self._total_sums, self._epochs
+        base = slot * self._n_buckets
+        window_base = slot * self._n_windows
+        result = []
+        for w, width, n, offset, zero_counts, zero_sums in self._layout:
+            t = window_base + w
+            epoch = int(now // width)
+            first = base + offset
+            last = epochs[t]
+            if epoch - last >= n:
+                # Idle for the whole window: everything expired
+                counts[first:first + n] = zero_counts
+                sums[first:first + n] = zero_sums
+                total_count = 0
+                total_sum = 0
+                epochs[t] = epoch
+            else:
+                total_count = total_counts[t]
+                total_sum = total_sums[t]
+                if epoch > last:
+                    for e in range(last + 1, epoch + 1):
+                        i = first + e % n
+                        total_count -= counts[i]
+                        total_sum -= sums[i]
+                        counts[i] = 0
+                        sums[i] = 0
+                    epochs[t] = epoch
+            i = first + epoch % n
+            counts[i] += 1
+            sums[i] += amount
+            total_counts[t] = total_count = total_count + 1
+            total_sums[t] = total_sum = total_sum + amount
+            result.append(total_count)
+            result.append(total_sum)
+        return result
+
+    def _seen_counterparty(self, slot: int, counterparty: int) -> bool:
+        """True if ``counterparty`` is among the slot's recent ones; remembers it if not."""
+        k = self._n_counterparties
+        first = slot * k
+        recent = self._counterparties
+        for i in range(first, first + k):
+            if recent[i] == counterparty:
+                return True
+        nxt = self._counterparty_next[slot]
+        recent[first + nxt] = counterparty
+        self._counterparty_next[slot] = (nxt + 1) % k
+        return False
+
+    def update(self, source: str, target: str, amount: int, now: float = None) -> dict:
+        """Account for one transaction and return the features of both accounts.
+
+        ``amount`` is in integer minor units. Windows count every transaction an
+        account took part in, sent or received, this one included. Features, for
+        each window name ``<w>``: ``source_count_<w>``, ``source_sum_<w>``,
+        ``target_count_<w>`` and ``target_sum_<w>``, plus ``new_counterparty``,
+        True when ``source`` has not paid ``target`` recently.
+        """
+        now = time.time() if now is None else now
+        source_slot = self._slot(source, now)
+        target_slot = self._slot(target, now)
+
+        features = {'new_counterparty': not self._seen_counterparty(source_slot, _account_hash(target))}
+        totals = self._advance(source_slot, now, amount) + self._advance(target_slot, now, amount)
+        for i, (count_name, sum_name) in enumerate(self._feature_names):
+            features[count_name] = totals[2 * i]
+            features[sum_name] = totals[2 * i + 1]
+        return features
@@ -0,0 +1,175 @@
+"""Multi-currency FX conversion from immutable, versioned rate snapshots.
+
+A RateSnapshot holds every convertible pair as a fixed-point integer factor:
+quoted rates, their inverses and the cross rates derived through a pivot
+currency are all computed once when the snapshot is built, so a conversion is
+one dict lookup and integer arithmetic. Amounts are integer minor units
+(hundredths, as carried on the wire by codec.py).
+
+FxEngine publishes a snapshot by replacing one attribute. Readers take the
+current snapshot once per conversion and never lock; a rate update builds a
+complete new snapshot on the control thread and swaps it in. Updates, which
+may come from several handoff workers, compare versions and swap under a lock,
+so an older snapshot never replaces a newer one.
+
+Rate updates are sent on the ``/control/fx`` topic as ``str(dict)``, e.g.
+``{'version': 3, 'rates': {'EURUSD': 1.2, 'GBPUSD': 1.27}}``.
+"""
+
+import ast
+import threading
+
+try:
+    import numpy as np
+except ImportError:  # convert_many falls back to a Python loop
+    np = None
+
+PIVOT = "USD"
+
+# Rates are held as integers scaled by 10 ** RATE_DIGITS
+RATE_DIGITS = 10
+RATE_SCALE = 10 ** RATE_DIGITS
+_HALF = RATE_SCALE // 2
+
+
+def _scaled(rate: float) -> int:
+    return round(rate * RATE_SCALE)
+
+
+def parse_pair(pair: str):
+    """Split a 6-letter pair such as ``EURUSD`` into ``('EUR', 'USD')``."""
+    pair = pair.replace("/", "").upper()
+    if len(pair) != 6:
+        raise ValueError(f"currency pair must be 6 letters, got {pair!r}")
+    return pair[:3], pair[3:]
+
+
+class RateSnapshot:
+    """Immutable table of conversion factors for one version of the rates."""
+
+    __slots__ = ('version', 'pivot', '_factors')
+
+    def __init__(self, version: int, rates: dict, pivot: str = PIVOT):
+        """``rates`` maps ``(base, quote)`` or ``'BASEQUOTE'`` to units of quote per base."""
+        factors = {}
+        quoted = {}
+        for pair, rate in rates.items():
+            base, quote = parse_pair(pair) if isinstance(pair, str) else pair
+            if rate <= 0:
+                raise ValueError(f"rate for {base}{quote} must be positive, got {rate}")
+            quoted[(base, quote)] = float(rate)
+
+        # Rate of every currency against the pivot, from direct or inverse quotes
+        to_pivot = {pivot: 1.0}
+        for (base, quote), rate in quoted.items():
+            if quote == pivot:
+                to_pivot.setdefault(base, rate)
+            elif base == pivot:
+                to_pivot.setdefault(quote, 1.0 / rate)
+
+        # Crosses through the pivot first, then quoted rates and their inverses win
+        for base, base_rate in to_pivot.items():
+            for quote, quote_rate in to_pivot.items():
+                factors[(base, quote)] = _scaled(base_rate / quote_rate)
+        for (base, quote), rate in quoted.items():
+            factors[(quote, base)] = _scaled(1.0 / rate)
+        for (base, quote), rate in quoted.items():
+            factors[(base, quote)] = _scaled(rate)
+        for currency in {c for pair in factors for c in pair}:
+            factors[(currency, currency)] = RATE_SCALE
+
+        self.version = version
+        self.pivot = pivot
+        self._factors = factors
+
+    def __setattr__(self, name, value):
+        if hasattr(self, '_factors'):
+            raise AttributeError("RateSnapshot is immutable")
+        object.__setattr__(self, name, value)
+
+    def __len__(self):
+        return len(self._factors)
+
+    def rate(self, base: str, quote: str) -> float:
+        return self.factor(base, quote) / RATE_SCALE
+
+    def factor(self, base: str, quote: str) -> int:
+        """Fixed-point factor (scaled by RATE_SCALE) converting ``base`` into ``quote``."""
+        try:
+            return self._factors[(base, quote)]
+        except KeyError:
+            raise KeyError(f"no FX rate for {base}{quote} in version {self.version}") from None
+
+    def convert(self, amount: int, base: str, quote: str) -> int:
+        """Convert integer minor units of ``base`` into ``quote``, rounding half away from zero."""
+        product = amount * self.factor(base, quote)
+        if product >= 0:
+            return (product + _HALF) // RATE_SCALE
+        return -((-product + _HALF) // RATE_SCALE)
+
+    def convert_many(self, amounts, base: str, quote: str):
+        """Convert a sequence of minor-unit amounts of one pair in one vectorised step.
+
+        Returns an int64 array with numpy, a list otherwise; rounding matches convert().
+        """
+        factor = self.factor(base, quote)
+        if np is None:
+            return [self.convert(a, base, quote) for a in amounts]
+        amounts = np.asarray(amounts, dtype=np.int64)
+        if not len(amounts):
+            return amounts
+        # Stay in exact int64 arithmetic while the products cannot overflow
+        if int(np.abs(amounts).max()) * factor + _HALF >= 2 ** 63:
+            return np.array([self.convert(int(a), base, quote) for a in amounts], dtype=np.int64)
+        product = amounts * factor
+        magnitude = (np.abs(product) + _HALF) // RATE_SCALE
+        return np.where(product >= 0, magnitude, -magnitude)
+
+
+class FxEngine:
+    """Converts amounts with the latest snapshot; updates swap the snapshot atomically."""
+
+    def __init__(self, snapshot: RateSnapshot):
+        self._snapshot = snapshot
+        # Taken by updates only
+        self._update_lock = threading.Lock()
+
+    @property
+    def snapshot(self) -> RateSnapshot:
+        return self._snapshot
+
+    def update(self, snapshot: RateSnapshot) -> bool:
+        """Install ``snapshot`` if it is newer than the current one; True if installed."""
+        with self._update_lock:
+            if snapshot.version <= self._snapshot.version:
+                return False
+            # A single reference assignment: readers see either the old or the new table
+            self._snapshot = snapshot
+            return True
+
+    def convert(self, amount: int, base: str, quote: str):
+        """Return ``(converted_amount, rate_version)`` using one consistent snapshot."""
+        snapshot = self._snapshot
+        return snapshot.convert(amount, base, quote), snapshot.version
+
+    def convert_batch(self, batches: dict, quote: str):
+        """Convert ``{base: amounts}`` into ``quote``, every pair with the same snapshot.
+
+        Returns ``({base: converted}, rate_version)``.
+        """
+        snapshot = self._snapshot
+        return {base: snapshot.convert_many(amounts, base, quote)
+                for base, amounts in batches.items()}, snapshot.version
+
+
+def snapshot_payload(version: int, rates: dict, pivot: str = PIVOT) -> str:
+    """Encode a rate update for the ``/control/fx`` topic."""
+    return str({'version': version, 'pivot': pivot, 'rates': dict(rates)})
+
+
+def snapshot_from_payload(payload) -> RateSnapshot:
+    """Build a RateSnapshot from a ``/control/fx`` payload (str or bytes)."""
+    if not isinstance(payload, str):
+        payload = bytes(payload).decode('utf-8')
+    update = ast.literal_eval(payload.rstrip('\0'))
+    return RateSnapshot(int(update['version']), update['rates'], update.get('pivot', PIVOT))
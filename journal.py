@@ -0,0 +1,368 @@
+"""Append-only, group-committed journal of settled transactions.
+
+The journal is a directory of numbered segment files. A segment starts with a
+small header and holds a sequence of blocks, each a header followed by a body:
+
+    magic  2s  b'JB'
+    kind   B   ACCOUNTS, POSTINGS, CYCLE or IDS
+    pad    x
+    count  I   number of entries in the body; for CYCLE, the closed cycle number
+    crc    I   CRC-32 of the body
+
+* ACCOUNTS: ``count`` 12-byte account ids, numbered in order of first
+  appearance across the whole journal;
+* POSTINGS: ``count`` records of ``<IIq``: source number, target number,
+  amount in minor units;
+* CYCLE: no body, the settlement cycle ``count`` was closed here;
+* IDS: ``count`` ``<Q`` ids of the transactions posted in the POSTINGS block
+  that follows, those that have one (version 2 segments and later). Recovery
+  of the ledger skips them; ``ids()`` reads them back so the duplicate index
+  (see dedup.py) knows what was settled before a restart.
+
+Postings refer to accounts by number, so a posting is 16 bytes and recovery
+aggregates plain integer arrays instead of hashing account ids.
+
+Appends are buffered and written by a MicroBatcher: a group of up to
+``batch_size`` postings, or whatever arrived within ``fsync_interval`` seconds,
+is written with one ``write`` and made durable with one ``fsync``. A segment
+rolls over to the next file once it reaches ``segment_size`` bytes.
+
+Recovery maps each segment read-only and replays its blocks, stopping at the
+first torn or corrupt block, which is truncated away. With numpy, postings are
+applied a block at a time with vectorised scatter-adds.
+"""
+
+import mmap
+import os
+import struct
+import zlib
+
+import batching
+
+try:
+    import numpy as np
+except ImportError:  # recovery falls back to a Python loop
+    np = None
+
+SEGMENT_MAGIC = b'SJNL'
+SEGMENT_VERSION = 2
+# Versions recovery reads: version 1 segments have no IDS blocks
+SEGMENT_VERSIONS = (1, 2)
+SEGMENT_HEADER = struct.Struct('<4sHxx')
+SEGMENT_SUFFIX = ".journal"
+
+BLOCK_MAGIC = b'JB'
+BLOCK = struct.Struct('<2sBxII')
+
+ACCOUNTS = 1
+POSTINGS = 2
+CYCLE = 3
+IDS = 4
+
+ACCOUNT_SIZE = 12
+POSTING = struct.Struct('<IIq')
+ID = struct.Struct('<Q')
+
+_ENTRY_SIZE = {ACCOUNTS: ACCOUNT_SIZE, POSTINGS: POSTING.size, CYCLE: 0, IDS: ID.size}
+
+if np is not None:
+    POSTING_DTYPE = np.dtype([('source', '<u4'), ('target', '<u4'), ('amount', '<i8')])
+
+
+def _block(kind: int, count: int, body=b'') -> bytes:
+    return BLOCK.pack(BLOCK_MAGIC, kind, count, zlib.crc32(body)) + body
+
+
+class Journal:
+    def __init__(self, directory: str, fsync_interval: float = 0.01, batch_size: int = 1024,
+                 segment_size: int = 64 << 20, fsync: bool = True):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync = fsync
+        os.makedirs(directory, exist_ok=True)
+        self._accounts = {}
+        self._segments = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+                                if name.endswith(SEGMENT_SUFFIX))
+        self._next_segment = self._segments[-1] + 1 if self._segments else 1
+        # Account numbers continue the existing journal's, so it must be recovered first
+        self._recovered = not self._segments
+        self._fd = None
+        self._size = 0
+        self.written = 0
+        self.commits = 0
+        self._batcher = batching.MicroBatcher(self._commit, batch_size, fsync_interval)
+
+    def _path(self, number: int) -> str:
+        return os.path.join(self.directory, f"{number:08d}{SEGMENT_SUFFIX}")
+
+    # Writing
+
+    def append(self, source: str, target: str, amount: int, transaction_id: int = 0):
+        """Queue one posting, with its transaction's id if not 0; it is durable once its group is committed."""
+        if not self._recovered:
+            raise RuntimeError("recover() the existing journal before appending to it")
+        self._batcher.add((source, target, amount, transaction_id))
+
+    def append_many(self, postings):
+        """Queue ``(source, target, amount)`` postings of transactions without ids."""
+        if not self._recovered:
+            raise RuntimeError("recover() the existing journal before appending to it")
+        for source, target, amount in postings:
+            self._batcher.add((source, target, amount, 0))
+
+    def mark_cycle(self, number: int):
+        """Record that settlement cycle ``number`` closed after the postings queued so far."""
+        self._batcher.add((None, None, number, 0))
+
+    def commit(self):
+        """Write and sync everything queued now."""
+        self._batcher.flush()
+
+    def _commit(self, batch: list):
+        accounts = self._accounts
+        # Numbered here, and only taken into ``accounts`` once the block naming them is written
+        added = {}
+        out = bytearray()
+        new = bytearray()
+        postings = bytearray()
+        ids = bytearray()
+        pack = POSTING.pack
+        pack_id = ID.pack
+        count = 0
+
+        def emit():
+            if new:
+                out.extend(_block(ACCOUNTS, len(new) // ACCOUNT_SIZE, new))
+                new.clear()
+            if ids:
+                out.extend(_block(IDS, len(ids) // ID.size, ids))
+                ids.clear()
+            if postings:
+                out.extend(_block(POSTINGS, len(postings) // POSTING.size, postings))
+                postings.clear()
+
+        for source, target, amount, transaction_id in batch:
+            if source is None:
+                emit()
+                out.extend(_block(CYCLE, amount))
+                continue
+            numbers = []
+            for account in (source, target):
+                number = accounts.get(account)
+                if number is None:
+                    number = added.get(account)
+                if number is None:
+                    number = added[account] = len(accounts) + len(added)
+                    new.extend(account.encode('ascii').ljust(ACCOUNT_SIZE, b'\0'))
+                numbers.append(number)
+            postings.extend(pack(numbers[0], numbers[1], amount))
+            if transaction_id:
+                ids.extend(pack_id(transaction_id))
+            count += 1
+        emit()
+        self._write(out)
+        accounts.update(added)
+        self.written += count
+        self.commits += 1
+
+    def _write(self, data: bytes):
+        if self._fd is not None and self._size + len(data) > self.segment_size \
+                and self._size > SEGMENT_HEADER.size:
+            self._close_segment()
+        if self._fd is None:
+            self._open_segment()
+        try:
+            written = os.write(self._fd, data)
+            if written != len(data):
+                raise OSError(f"short write of {written} of {len(data)} bytes to the journal")
+            if self.fsync:
+                os.fsync(self._fd)
+        except OSError:
+            # Cut off whatever part of the group did get written, so later groups follow whole blocks
+            os.ftruncate(self._fd, self._size)
+            raise
+        self._size += len(data)
+
+    def _open_segment(self):
+        number = self._next_segment
+        self._next_segment += 1
+        self._fd = os.open(self._path(number), os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND, 0o644)
+        header = SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION)
+        os.write(self._fd, header)
+        self._size = len(header)
+        self._segments.append(number)
+
+    def _close_segment(self):
+        if self.fsync:
+            os.fsync(self._fd)
+        os.close(self._fd)
+        self._fd = None
+
+    def close(self):
+        """Commit what is queued and close the open segment."""
+        self._batcher.close()
+        if self._fd is not None:
+            self._close_segment()
+
+    # Recovery
+
+    def recover(self, ledger) -> int:
+        """Rebuild ``ledger`` from the journal and return the number of postings replayed.
+
+        Must be called before the first append: the journal then continues the
+        recovered account numbering, in a new segment.
+        """
+        replay = _ArrayReplay() if np is not None else _LoopReplay()
+        names = []
+        for number in list(self._segments):
+            path = self._path(number)
+            end = _replay_segment(path, replay, names)
+            if end is None:
+                continue
+            if number != self._segments[-1]:
+                raise ValueError(f"{path} is corrupt at offset {end}")
+            # A write torn by a crash: keep what was committed before it
+            if end < SEGMENT_HEADER.size:
+                os.remove(path)
+                self._segments.pop()
+            else:
+                with open(path, 'r+b') as f:
+                    f.truncate(end)
+
+        accounts = [name.rstrip(b'\0').decode('ascii') for name in names]
+        self._accounts = {account: i for i, account in enumerate(accounts)}
+        balances, nets = replay.result(len(accounts))
+        ledger.restore(dict(zip(accounts, balances)),
+                       {accounts[i]: n for i, n in enumerate(nets) if n},
+                       replay.cycle + 1, replay.open_transactions, replay.open_gross)
+        self._recovered = True
+        return replay.postings
+
+    def ids(self):
+        """Yield the id of every transaction posted in the journal, in order; call it after recover()."""
+        for number in list(self._segments):
+            with open(self._path(number), 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size <= SEGMENT_HEADER.size:
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    # Blocks were checked by recover(); the open segment may end in a group being written
+                    offset = SEGMENT_HEADER.size
+                    while offset + BLOCK.size <= size:
+                        magic, kind, count, _ = BLOCK.unpack_from(mm, offset)
+                        body = offset + BLOCK.size
+                        end = body + count * _ENTRY_SIZE.get(kind, 0)
+                        if magic != BLOCK_MAGIC or kind not in _ENTRY_SIZE or end > size:
+                            break
+                        if kind == IDS:
+                            for transaction_id, in ID.iter_unpack(mm[body:end]):
+                                yield transaction_id
+                        offset = end
+
+
+def _replay_segment(path: str, replay, names: list):
+    """Replay one segment; return the offset of the first bad block, or None if all is well."""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < SEGMENT_HEADER.size:
+            return 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            magic, version = SEGMENT_HEADER.unpack_from(mm)
+            if magic != SEGMENT_MAGIC or version not in SEGMENT_VERSIONS:
+                raise ValueError(f"{path} is not a journal segment of version {SEGMENT_VERSIONS}")
+            view = memoryview(mm)
+            try:
+                offset = SEGMENT_HEADER.size
+                while offset < size:
+                    if offset + BLOCK.size > size:
+                        return offset
+                    magic, kind, count, crc = BLOCK.unpack_from(mm, offset)
+                    body = offset + BLOCK.size
+                    end = body + count * _ENTRY_SIZE.get(kind, 0)
+                    if magic != BLOCK_MAGIC or kind not in _ENTRY_SIZE or end > size \
+                            or zlib.crc32(view[body:end]) != crc:
+                        return offset
+                    if kind == ACCOUNTS:
+                        names.extend(bytes(view[i:i + ACCOUNT_SIZE]) for i in range(body, end, ACCOUNT_SIZE))
+                    elif kind == POSTINGS:
+                        replay.postings_block(view[body:end], count, len(names))
+                    elif kind == CYCLE:
+                        replay.cycle_closed(count)
+                    offset = end
+            finally:
+                view.release()
+    return None
+
+
+class _ArrayReplay:
+    """Aggregates postings into numpy balance and open-cycle net arrays."""
+
+    def __init__(self):
+        self.balances = np.zeros(1024, dtype=np.int64)
+        self.nets = np.zeros(1024, dtype=np.int64)
+        self.cycle = 0
+        self.postings = 0
+        self.open_transactions = 0
+        self.open_gross = 0
+
+    def postings_block(self, body, count: int, accounts: int):
+        if accounts > len(self.balances):
+            size = max(accounts, 2 * len(self.balances))
+            self.balances = np.concatenate([self.balances, np.zeros(size - len(self.balances), np.int64)])
+            self.nets = np.concatenate([self.nets, np.zeros(size - len(self.nets), np.int64)])
+        block = np.frombuffer(body, dtype=POSTING_DTYPE, count=count)
+        amounts = block['amount']
+        for totals in (self.balances, self.nets):
+            np.subtract.at(totals, block['source'], amounts)
+            np.add.at(totals, block['target'], amounts)
+        self.postings += count
+        self.open_transactions += count
+        self.open_gross += int(amounts.sum())
+
+    def cycle_closed(self, number: int):
+        self.nets[:] = 0
+        self.cycle = number
+        self.open_transactions = 0
+        self.open_gross = 0
+
+    def result(self, accounts: int):
+        return self.balances[:accounts].tolist(), self.nets[:accounts].tolist()
+
+
+class _LoopReplay:
+    """Same as _ArrayReplay, one posting at a time, for when numpy is missing."""
+
+    def __init__(self):
+        self.balances = []
+        self.nets = []
+        self.cycle = 0
+        self.postings = 0
+        self.open_transactions = 0
+        self.open_gross = 0
+
+    def postings_block(self, body, count: int, accounts: int):
+        grow = accounts - len(self.balances)
+        if grow > 0:
+            self.balances.extend([0] * grow)
+            self.nets.extend([0] * grow)
+        balances, nets = self.balances, self.nets
+        gross = 0
+        for source, target, amount in POSTING.iter_unpack(body):
+            balances[source] -= amount
+            balances[target] += amount
+            nets[source] -= amount
+            nets[target] += amount
+            gross += amount
+        self.postings += count
+        self.open_transactions += count
+        self.open_gross += gross
+
+    def cycle_closed(self, number: int):
+        self.nets = [0] * len(self.nets)
+        self.cycle = number
+        self.open_transactions = 0
+        self.open_gross = 0
+
+    def result(self, accounts: int):
+        grow = accounts - len(self.balances)
+        return self.balances + [0] * grow, self.nets + [0] * grow
@@ -0,0 +1,167 @@
+"""Pipeline latency stamps and HDR-style latency histograms.
+
+Every stage adds a ``ts.<stage>`` message property holding ``time.monotonic_ns()``
+when it publishes, and copies the stamps it received, so the last stage sees
+when the transaction passed each hop. The monotonic clock is shared by all
+processes of a host, so stamps are comparable as long as the stages run on the
+same machine (or in one process on the loopback broker).
+
+A load generator may also set ``ts.intended``, the time the message was
+*scheduled* to be sent. End-to-end latency is then measured from that instant,
+which corrects for coordinated omission: when the generator falls behind, the
+wait is charged to latency instead of silently disappearing.
+"""
+
+import time
+from array import array
+
+STAMP_PREFIX = "ts."
+INTENDED = STAMP_PREFIX + "intended"
+
+# Stages in pipeline order, the stamp of each is STAMP_PREFIX + name
+STAGES = ("GenFinTX", "CalcFX", "FraudDetect", "ClearSettle")
+
+
+def now() -> int:
+    return time.monotonic_ns()
+
+
+def stamp_name(stage: str) -> str:
+    return STAMP_PREFIX + stage
+
+
+def stamps_of(message) -> dict:
+    """Return the latency stamps carried by an inbound message."""
+    properties = message.get_properties() or {}
+    return {k: v for k, v in properties.items() if k.startswith(STAMP_PREFIX)}
+
+
+class Histogram:
+    """Log-linear histogram of non-negative integer values, in the spirit of HdrHistogram.
+
+    Values below ``2 ** precision_bits`` are counted exactly; above that every
+    power-of-two range is split into ``2 ** (precision_bits - 1)`` buckets, so the
+    relative error stays under ``2 ** -(precision_bits - 1)``. The default (8 bits,
+    values up to about 4.9 hours in ns) is accurate to 0.8% in under 40 KB.
+    """
+
+    def __init__(self, precision_bits: int = 8, max_value_bits: int = 44):
+        self._bits = precision_bits
+        self._half = 1 << (precision_bits - 1)
+        self._max_value = (1 << max_value_bits) - 1
+        self._counts = array('Q', bytes(8 * (self._index(self._max_value) + 1)))
+        self.total_count = 0
+        self.min = None
+        self.max = 0
+        self._sum = 0
+
+    def _index(self, value: int) -> int:
+        shift = value.bit_length() - self._bits
+        if shift <= 0:
+            return value
+        return (shift << (self._bits - 1)) + (value >> shift)
+
+    def _lowest(self, index: int) -> int:
+        """Smallest value that falls into bucket ``index``."""
+        if index < (1 << self._bits):
+            return index
+        shift = (index >> (self._bits - 1)) - 1
+        return (index - (shift << (self._bits - 1))) << shift
+
+    def _highest(self, index: int) -> int:
+        return self._lowest(index + 1) - 1
+
+    def record(self, value: int, count: int = 1):
+        if value < 0:
+            value = 0
+        elif value > self._max_value:
+            value = self._max_value
+        self._counts[self._index(value)] += count
+        self.total_count += count
+        self._sum += value * count
+        if value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+
+    def merge(self, other: 'Histogram'):
+        if other._bits != self._bits or len(other._counts) != len(self._counts):
+            raise ValueError("can only merge histograms with the same layout")
+        counts = self._counts
+        for i, c in enumerate(other._counts):
+            if c:
+                counts[i] += c
+        self.total_count += other.total_count
+        self._sum += other._sum
+        self.max = max(self.max, other.max)
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+
+    def reset(self):
+        self._counts = array('Q', bytes(8 * len(self._counts)))
+        self.total_count = 0
+        self.min = None
+        self.max = 0
+        self._sum = 0
+
+    def mean(self) -> float:
+        return self._sum / self.total_count if self.total_count else 0.0
+
+    def value_at_percentile(self, percentile: float) -> int:
+        """Highest value, within bucket precision, below which ``percentile`` % of samples fall."""
+        if not self.total_count:
+            return 0
+        target = max(1, -(-self.total_count * percentile // 100))
+        seen = 0
+        for i, c in enumerate(self._counts):
+            if c:
+                seen += c
+                if seen >= target:
+                    return min(self._highest(i), self.max)
+        return self.max
+
+    def summary(self, percentiles=(50, 99, 99.9)) -> dict:
+        result = {f"p{p:g}": self.value_at_percentile(p) for p in percentiles}
+        result["max"] = self.max
+        result["count"] = self.total_count
+        return result
+
+
+class LatencyRecorder:
+    """Per-hop and end-to-end latency histograms fed from the stamps of arriving messages."""
+
+    def __init__(self, stage: str = STAGES[-1], stages=STAGES):
+        self.stage = stage
+        self.stages = tuple(stages[:stages.index(stage) + 1])
+        self.hops = {f"{a}->{b}": Histogram() for a, b in zip(self.stages, self.stages[1:])}
+        self.end_to_end = Histogram()
+
+    def record(self, stamps: dict, arrival: int = None):
+        """Record one message; ``stamps`` as returned by stamps_of()."""
+        arrival = now() if arrival is None else arrival
+        times = dict(stamps)
+        times[stamp_name(self.stage)] = arrival
+        previous = None
+        for stage in self.stages:
+            current = times.get(stamp_name(stage))
+            if current is not None and previous is not None:
+                self.hops[f"{previous[0]}->{stage}"].record(current - previous[1])
+            if current is not None:
+                previous = (stage, current)
+        origin = times.get(INTENDED, times.get(stamp_name(self.stages[0])))
+        if origin is not None:
+            self.end_to_end.record(arrival - origin)
+
+    def reset(self):
+        for histogram in self.hops.values():
+            histogram.reset()
+        self.end_to_end.reset()
+
+    def report(self) -> str:
+        lines = [f"{'latency (us)':<26}{'p50':>10}{'p99':>10}{'p99.9':>10}{'max':>10}{'count':>10}"]
+        rows = list(self.hops.items()) + [("end to end", self.end_to_end)]
+        for name, histogram in rows:
+            s = histogram.summary()
+            lines.append(f"{name:<26}{s['p50'] / 1000:>10.1f}{s['p99'] / 1000:>10.1f}"
+                         f"{s['p99.9'] / 1000:>10.1f}{s['max'] / 1000:>10.1f}{s['count']:>10}")
+        return "\n".join(lines)
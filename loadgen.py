@@ -0,0 +1,428 @@
+"""Open-loop load generation: publish transactions at a target rate, whatever the pipeline does with them.
+
+A closed-loop generator sends the next message when the previous one is done,
+so a slow pipeline quietly slows the generator down. Here every message has a
+due time fixed in advance by the arrival process, and is published at that
+time however long the previous publish took. Due times are offsets from one
+start instant, so errors in sleeping never add up. A message that could not be
+sent on time is sent as soon as possible after, and carries its due time as
+``ts.intended`` (see latency.py). Pipeline latency is then measured from when
+the message should have left.
+
+The rate follows a schedule of steps, written ``RATE:SECONDS`` for a constant
+rate or ``FROM-TO:SECONDS`` for a linear ramp, separated by commas. The
+seconds of the last step may be left out to run until stopped, e.g.
+``1000:30,1000-20000:60,20000``. Arrival processes:
+
+* constant: evenly spaced;
+* poisson: exponential gaps, as independent clients would send;
+* bursty: on/off. Each period of ``burst_on + burst_off`` seconds starts
+  with the messages of the whole period, the schedule's rate integrated over
+  it, sent evenly over ``burst_on`` seconds; nothing is sent for the rest of
+  it. The average rate still follows the schedule, ramps included.
+
+With several threads, each one sends its share of the rate: constant arrivals
+are interleaved, and Poisson ones stay Poisson once merged. Each thread has
+its own message builder and transaction stream.
+
+The report gives, per step, the rate offered and achieved and the send lag:
+how late messages left against their due time. A lag growing step after step
+means the generator, not the pipeline, is the bottleneck.
+"""
+
+import argparse
+import math
+import threading
+import time
+
+import latency
+from transactions import IdGenerator, iter_encoded_transactions, make_rng
+
+CONSTANT = "constant"
+POISSON = "poisson"
+BURSTY = "bursty"
+PROCESSES = (CONSTANT, POISSON, BURSTY)
+
+# Seconds on and off of the bursty process
+BURST_ON = 0.1
+BURST_OFF = 0.4
+
+# A step whose p99 send lag is over this many seconds was not held by the generator
+MAX_LAG = 0.01
+
+# Gaps of the Poisson process are drawn this many at a time
+_DRAWS = 4096
+# Transactions generated at a time by each thread
+_BATCH = 1024
+
+
+class Step:
+    """A part of a schedule: ``seconds`` at a rate going linearly from ``start_rate`` to ``end_rate``."""
+
+    __slots__ = ('start_rate', 'end_rate', 'seconds', 'begin')
+
+    def __init__(self, start_rate: float, end_rate: float, seconds: float = None, begin: float = 0.0):
+        if start_rate < 0 or end_rate < 0:
+            raise ValueError("rates cannot be negative")
+        if seconds is None and start_rate != end_rate:
+            raise ValueError("a ramp needs a duration")
+        self.start_rate = start_rate
+        self.end_rate = end_rate
+        self.seconds = seconds
+        # Offset of the step from the start of the schedule
+        self.begin = begin
+
+    @property
+    def end(self) -> float:
+        return float('inf') if self.seconds is None else self.begin + self.seconds
+
+    def rate_at(self, t: float) -> float:
+        if self.start_rate == self.end_rate:
+            return self.start_rate
+        return self.start_rate + (self.end_rate - self.start_rate) * (t - self.begin) / self.seconds
+
+    def __str__(self):
+        rate = f"{self.start_rate:g}" if self.start_rate == self.end_rate else f"{self.start_rate:g}-{self.end_rate:g}"
+        return rate if self.seconds is None else f"{rate}:{self.seconds:g}"
+
+
+class Schedule:
+    """Target rate over time, as consecutive steps."""
+
+    def __init__(self, steps: list):
+        if not steps:
+            raise ValueError("a schedule needs at least one step")
+        begin = 0.0
+        for i, step in enumerate(steps):
+            if step.seconds is None and i != len(steps) - 1:
+                raise ValueError("only the last step can run until stopped")
+            step.begin = begin
+            begin = step.end
+        self.steps = steps
+
+    @classmethod
+    def parse(cls, spec: str) -> 'Schedule':
+        """Schedule from ``RATE[:SECONDS]`` and ``FROM-TO:SECONDS`` steps separated by commas."""
+        steps = []
+        for part in spec.split(","):
+            rates, _, seconds = part.strip().partition(":")
+            first, _, last = rates.partition("-")
+            steps.append(Step(float(first), float(last or first), float(seconds) if seconds else None))
+        return cls(steps)
+
+    @property
+    def duration(self) -> float:
+        """Seconds the schedule lasts, infinite if its last step runs until stopped."""
+        return self.steps[-1].end
+
+    def messages(self, start: float, end: float) -> float:
+        """Messages the rate adds up to between ``start`` and ``end`` seconds."""
+        total = 0.0
+        for step in self.steps:
+            a, b = max(start, step.begin), min(end, step.end)
+            if a < b:
+                total += (step.rate_at(a) + step.rate_at(b)) / 2 * (b - a)
+        return total
+
+    def index(self, t: float, hint: int = 0) -> int:
+        """Index of the step ``t`` falls in, searching on from ``hint``; len(steps) past the end."""
+        steps = self.steps
+        while hint < len(steps) and t >= steps[hint].end:
+            hint += 1
+        return hint
+
+    def __str__(self):
+        return ",".join(str(step) for step in self.steps)
+
+
+def arrivals(schedule: Schedule, process: str = CONSTANT, share: int = 1, index: int = 0,
+             burst_on: float = BURST_ON, burst_off: float = BURST_OFF, rng=None):
+    """Yield due times, in seconds from the start, of the ``index``-th of ``share`` senders.
+
+    Each sender offers ``1 / share`` of the schedule's rate. Arrivals are
+    spaced in units of expected messages, 1 apart or exponential for Poisson,
+    and each unit is turned into time with the rate integrated over the steps
+    it spans, so ramps and boundaries are followed exactly.
+    """
+    if process not in PROCESSES:
+        raise ValueError(f"unknown arrival process {process!r}, expected one of {', '.join(PROCESSES)}")
+    if process == BURSTY:
+        yield from _bursts(schedule, share, index, burst_on, burst_off)
+        return
+    steps = schedule.steps
+    scale = 1.0 / share
+    draws = []
+    if process == POISSON:
+        rng = rng if rng is not None else make_rng()
+
+    def draw() -> float:
+        if not draws:
+            draws.extend(rng.exponential(1.0, _DRAWS).tolist())
+        return draws.pop()
+
+    t = 0.0
+    i = 0
+    # Expected messages to go before the next arrival; constant senders start a
+    # fraction of a gap apart, so that they interleave
+    pending = draw() if process == POISSON else (index + 1) / share
+    while True:
+        i = schedule.index(t, i)
+        if i == len(steps):
+            return
+        step = steps[i]
+        boundary = step.end
+        if pending <= 0:
+            yield t
+            pending = draw() if process == POISSON else 1.0
+            continue
+        rate = step.rate_at(t) * scale
+        slope = 0.0 if step.start_rate == step.end_rate \
+            else (step.end_rate - step.start_rate) / step.seconds * scale
+        # Time for the rate to add up to ``pending`` messages: rate * dt + slope * dt**2 / 2
+        if slope:
+            disc = rate * rate + 2 * slope * pending
+            dt = (math.sqrt(disc) - rate) / slope if disc >= 0 else math.inf
+        else:
+            dt = pending / rate if rate > 0 else math.inf
+        if t + dt < boundary:
+            t += dt
+            pending = 0.0
+        else:
+            span = boundary - t
+            pending -= rate * span + slope * span * span / 2
+            t = boundary
+            if t == math.inf:
+                return
+
+
+def _bursts(schedule: Schedule, share: int, index: int, burst_on: float, burst_off: float):
+    """Due times of the bursty process: each period's messages sent evenly over its first ``burst_on`` seconds."""
+    period = burst_on + burst_off
+    end = schedule.duration
+    # In messages from the start of the period; senders start a fraction of a gap apart, as constant ones do
+    pending = (index + 1) / share
+    window = 0
+    while window * period < end:
+        start = window * period
+        messages = schedule.messages(start, start + period) / share
+        if messages > 0:
+            # A burst cut short by the end of the schedule still sends what its period is owed
+            gap = min(burst_on, end - start) / messages
+            while pending <= messages:
+                yield start + pending * gap
+                pending += 1.0
+            pending -= messages
+        window += 1
+
+
+class StepReport:
+    """What happened during one step of the schedule."""
+
+    __slots__ = ('step', 'due', 'sent', 'lag')
+
+    def __init__(self, step: Step):
+        self.step = step
+        # Messages due in the step, and messages actually sent during it
+        self.due = 0
+        self.sent = 0
+        # Send lag, in ns
+        self.lag = latency.Histogram()
+
+    def merge(self, other: 'StepReport'):
+        self.due += other.due
+        self.sent += other.sent
+        self.lag.merge(other.lag)
+
+
+class Report:
+    """Per-step and overall outcome of a run."""
+
+    def __init__(self, schedule: Schedule, process: str, threads: int):
+        self.schedule = schedule
+        self.process = process
+        self.threads = threads
+        self.steps = [StepReport(step) for step in schedule.steps]
+        self.elapsed = 0.0
+
+    @property
+    def sent(self) -> int:
+        return sum(s.sent for s in self.steps)
+
+    def seconds_of(self, step: StepReport) -> float:
+        """Seconds of ``step`` that were run, the last one possibly cut short."""
+        return max(0.0, min(step.step.end, self.elapsed) - step.step.begin)
+
+    def saturated(self, max_lag: float = MAX_LAG):
+        """First step whose p99 send lag went over ``max_lag`` seconds, None if every step was held."""
+        for step in self.steps:
+            if step.due and step.lag.value_at_percentile(99) > max_lag * 1e9:
+                return step
+        return None
+
+    def __str__(self):
+        lines = [f"{self.process} arrivals, {self.threads} thread(s), schedule {self.schedule}",
+                 f"{'step':<16}{'offered/s':>11}{'achieved/s':>12}{'sent':>10}"
+                 f"{'lag p50 us':>12}{'lag p99 us':>12}{'lag max us':>12}"]
+        for step in self.steps:
+            seconds = self.seconds_of(step)
+            if not seconds:
+                continue
+            lag = step.lag.summary()
+            lines.append(f"{str(step.step):<16}{step.due / seconds:>11,.0f}{step.sent / seconds:>12,.0f}"
+                         f"{step.sent:>10,}{lag['p50'] / 1000:>12,.0f}{lag['p99'] / 1000:>12,.0f}"
+                         f"{lag['max'] / 1000:>12,.0f}")
+        sent = self.sent
+        lines.append(f"sent {sent:,} in {self.elapsed:.3f}s ({sent / self.elapsed if self.elapsed else 0:,.0f}/s)")
+        saturated = self.saturated()
+        if saturated is not None:
+            lines.append(f"generator fell behind from step {saturated.step} (p99 lag over {MAX_LAG * 1000:g} ms)")
+        return "\n".join(lines)
+
+
+class LoadGenerator:
+    """Publishes transactions on ``threads`` threads following ``schedule`` with an arrival process.
+
+    ``publisher(thread)`` is called once on each thread and returns the
+    ``publish(payload, stamps)`` that thread sends with, so each can have its
+    own message builder.
+    """
+
+    def __init__(self, schedule: Schedule, publisher, process: str = CONSTANT, threads: int = 1,
+                 burst_on: float = BURST_ON, burst_off: float = BURST_OFF, seed: int = None,
+                 ids: IdGenerator = None):
+        if threads < 1:
+            raise ValueError("threads must be at least 1")
+        if process not in PROCESSES:
+            raise ValueError(f"unknown arrival process {process!r}, expected one of {', '.join(PROCESSES)}")
+        self.schedule = schedule
+        self.publisher = publisher
+        self.process = process
+        self.threads = threads
+        self.burst_on = burst_on
+        self.burst_off = burst_off
+        self.seed = seed
+        self.ids = ids or IdGenerator()
+        self.report = Report(schedule, process, threads)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._start = None
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self, count: int = None) -> Report:
+        """Send until the schedule ends, stop() is called, or ``count`` messages were sent; returns the report."""
+        shares = [count // self.threads + (i < count % self.threads) for i in range(self.threads)] \
+            if count is not None else [None] * self.threads
+        # The clock starts once every thread has its publisher and first payload ready
+        self._start = None
+        ready = threading.Barrier(self.threads, action=self._begin)
+        workers = [threading.Thread(target=self._send, args=(i, ready, shares[i]), name=f"loadgen-{i}",
+                                    daemon=True)
+                   for i in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                while worker.is_alive():
+                    worker.join(0.2)
+        finally:
+            stopped = self._stop.is_set()
+            self._stop.set()
+            ready.abort()
+            for worker in workers:
+                worker.join()
+            if self._start is not None:
+                elapsed = (latency.now() - self._start) / 1e9
+                if count is None and not stopped:
+                    # The schedule ran out: its last arrivals may come before its end, e.g. when bursty
+                    elapsed = max(elapsed, self.schedule.duration)
+                self.report.elapsed = elapsed
+        return self.report
+
+    def _begin(self):
+        self._start = latency.now()
+
+    def _send(self, index: int, ready: threading.Barrier, count: int = None):
+        seed = None if self.seed is None else self.seed + index
+        rng = make_rng(seed)
+        # Small batches: generating one holds up the thread's next sends
+        payloads = iter_encoded_transactions(rng=rng, batch_size=_BATCH, ids=self.ids)
+        publish = self.publisher(index)
+        payload = next(payloads)
+        steps = [StepReport(step) for step in self.schedule.steps]
+        schedule, stop, sleep, now, intended = self.schedule, self._stop, time.sleep, latency.now, latency.INTENDED
+        due_step = sent_step = 0
+        try:
+            ready.wait()
+        except threading.BrokenBarrierError:
+            return
+        start = self._start
+        try:
+            for due in arrivals(schedule, self.process, self.threads, index, self.burst_on, self.burst_off, rng):
+                if stop.is_set() or count == 0:
+                    break
+                due_ns = start + int(due * 1e9)
+                delay = due_ns - now()
+                if delay > 0:
+                    sleep(delay / 1e9)
+                publish(payload, {intended: due_ns})
+                sent = now()
+                due_step = schedule.index(due, due_step)
+                sent_step = schedule.index((sent - start) / 1e9, sent_step)
+                report = steps[due_step]
+                report.due += 1
+                report.lag.record(max(0, sent - due_ns))
+                if sent_step < len(steps):
+                    steps[sent_step].sent += 1
+                else:
+                    report.sent += 1
+                if count is not None:
+                    count -= 1
+                # Made while there is time before the next send, not when it is due
+                payload = next(payloads)
+        finally:
+            with self._lock:
+                for total, mine in zip(self.report.steps, steps):
+                    total.merge(mine)
+
+
+def main():
+    import GenFinTX
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate", required=True, metavar="SCHEDULE",
+                        help="messages per second, or steps such as 1000:30,1000-20000:60")
+    parser.add_argument("--process", default=CONSTANT, choices=PROCESSES, help="arrival process")
+    parser.add_argument("--threads", type=int, default=1, help="publisher threads")
+    parser.add_argument("--duration", type=float, help="seconds to run an open-ended schedule for")
+    parser.add_argument("--count", type=int, help="stop after this many messages")
+    parser.add_argument("--burst-on", type=float, default=BURST_ON, help="seconds on, for bursty arrivals")
+    parser.add_argument("--burst-off", type=float, default=BURST_OFF, help="seconds off, for bursty arrivals")
+    parser.add_argument("--seed", type=int, help="seed of the transactions and arrival times")
+    args = parser.parse_args()
+
+    messaging_service = GenFinTX.connect()
+    try:
+        direct_publisher, _ = GenFinTX.start(messaging_service)
+        generator = LoadGenerator(Schedule.parse(args.rate),
+                                  GenFinTX.load_publisher(messaging_service, direct_publisher), args.process,
+                                  args.threads, args.burst_on, args.burst_off, args.seed,
+                                  IdGenerator(GenFinTX.GENERATOR_ID))
+        if args.duration:
+            timer = threading.Timer(args.duration, generator.stop)
+            timer.daemon = True
+            timer.start()
+        print("Send a KeyboardInterrupt to stop publishing")
+        try:
+            report = generator.run(args.count)
+        except KeyboardInterrupt:
+            report = generator.report
+        print(report)
+        direct_publisher.terminate()
+    finally:
+        messaging_service.disconnect()
+
+
+if __name__ == '__main__':
+    main()
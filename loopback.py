@@ -0,0 +1,693 @@
+"""In-process stand-in for the part of the Solace messaging API the stages use.
+
+The loopback broker routes messages between publishers and receivers of the same
+process, so the whole GenFinTX -> CalcFX -> FraudDetect -> ClearSettle chain can
+run, be benchmarked and profiled on one machine without Solace Cloud. It mirrors
+the builder style of ``MessagingService`` and supports ``*`` / ``>`` topic
+wildcards. Latency and message loss can be injected per broker, and so can a
+slowdown: with a ``rate``, the broker takes that many messages per second from
+each publisher and the rest wait in the publisher's buffer. A publisher built
+with ``on_back_pressure_reject`` then raises PublisherOverflowError when its
+buffer is full and calls its readiness listener once the buffer is down to
+half full, as the Solace API does. ``fail_rate`` reports publishes as failed to the
+publisher's failure listener.
+
+Select it for the stage scripts with ``SOLACE_TRANSPORT=loopback`` (environment
+or solace.properties), see transport.py.
+"""
+
+import queue
+import random
+import re
+import threading
+import time
+
+
+# Resources
+
+class Topic:
+    def __init__(self, name: str):
+        self._name = name
+
+    @staticmethod
+    def of(name: str) -> 'Topic':
+        return Topic(name)
+
+    def get_name(self) -> str:
+        return self._name
+
+    def __str__(self):
+        return self._name
+
+
+class TopicSubscription:
+    def __init__(self, expression: str):
+        self._expression = expression
+
+    @staticmethod
+    def of(expression: str) -> 'TopicSubscription':
+        return TopicSubscription(expression)
+
+    def get_name(self) -> str:
+        return self._expression
+
+    def __str__(self):
+        return self._expression
+
+
+def compile_subscription(expression: str):
+    """Compile a Solace subscription into a regex matching topic names.
+
+    ``*`` as a whole level matches exactly one level, ``abc*`` any level starting
+    with ``abc`` and a trailing ``>`` one or more further levels.
+    """
+    levels = expression.split('/')
+    parts = []
+    for i, level in enumerate(levels):
+        if level == '>' and i == len(levels) - 1:
+            parts.append('[^/]+(?:/[^/]+)*')
+        elif level.endswith('*'):
+            parts.append(re.escape(level[:-1]) + '[^/]*')
+        else:
+            parts.append(re.escape(level))
+    return re.compile('/'.join(parts) + r'\Z')
+
+
+def topic_matches(expression: str, topic: str) -> bool:
+    return compile_subscription(expression).match(topic) is not None
+
+
+SHARE_PREFIX = "#share/"
+
+
+def split_shared(expression: str):
+    """``(share group, topic expression)`` of a ``#share/<group>/<topic>`` subscription, group None if not shared."""
+    if expression.startswith(SHARE_PREFIX):
+        group, _, expression = expression[len(SHARE_PREFIX):].partition('/')
+        return group, expression
+    return None, expression
+
+
+# Listener interfaces, same method names as the Solace API
+
+class ServiceEvent:
+    def __init__(self, message: str = "", cause: Exception = None):
+        self._message = message
+        self._cause = cause
+        self._timestamp = time.time()
+
+    def get_cause(self):
+        return self._cause
+
+    def get_message(self) -> str:
+        return self._message
+
+    def get_time_stamp(self) -> float:
+        return self._timestamp
+
+
+class ReconnectionListener:
+    def on_reconnected(self, e: ServiceEvent):
+        pass
+
+
+class ReconnectionAttemptListener:
+    def on_reconnecting(self, e: ServiceEvent):
+        pass
+
+
+class ServiceInterruptionListener:
+    def on_service_interrupted(self, e: ServiceEvent):
+        pass
+
+
+class FailedPublishEvent:
+    def __init__(self, message, destination, exception):
+        self._message = message
+        self._destination = destination
+        self._exception = exception
+        self._timestamp = time.time()
+
+    def get_message(self):
+        return self._message
+
+    def get_destination(self):
+        return self._destination
+
+    def get_exception(self):
+        return self._exception
+
+    def get_timestamp(self) -> float:
+        return self._timestamp
+
+
+class PublishFailureListener:
+    def on_failed_publish(self, e: FailedPublishEvent):
+        pass
+
+
+class PublisherReadinessListener:
+    def ready(self):
+        pass
+
+
+class MessageHandler:
+    def on_message(self, message: 'InboundMessage'):
+        pass
+
+
+class PubSubPlusClientError(Exception):
+    pass
+
+
+class IllegalStateError(PubSubPlusClientError):
+    pass
+
+
+class PublisherOverflowError(PubSubPlusClientError):
+    pass
+
+
+class RetryStrategy:
+    def __init__(self, retries: int, interval: int):
+        self.retries = retries
+        self.interval = interval
+
+    @staticmethod
+    def parametrized_retry(retries: int, retry_interval: int) -> 'RetryStrategy':
+        return RetryStrategy(retries, retry_interval)
+
+    @staticmethod
+    def forever_retry(retry_interval: int = 3000) -> 'RetryStrategy':
+        return RetryStrategy(-1, retry_interval)
+
+    @staticmethod
+    def never_retry() -> 'RetryStrategy':
+        return RetryStrategy(0, 0)
+
+
+# Messages
+
+class OutboundMessage:
+    __slots__ = ('payload', 'properties', 'application_message_id')
+
+    def __init__(self, payload: bytes, properties: dict, application_message_id):
+        self.payload = payload
+        self.properties = properties
+        self.application_message_id = application_message_id
+
+    def get_payload_as_bytes(self) -> bytes:
+        return self.payload
+
+    def get_properties(self) -> dict:
+        return dict(self.properties)
+
+    def get_application_message_id(self):
+        return self.application_message_id
+
+
+class InboundMessage:
+    __slots__ = ('_payload', '_properties', '_application_message_id', '_destination_name')
+
+    def __init__(self, outbound: OutboundMessage, destination_name: str):
+        self._payload = outbound.payload
+        self._properties = outbound.properties
+        self._application_message_id = outbound.application_message_id
+        self._destination_name = destination_name
+
+    def get_payload_as_bytes(self) -> bytes:
+        return self._payload
+
+    def get_payload_as_string(self) -> str:
+        return self._payload.decode('utf-8')
+
+    def get_destination_name(self) -> str:
+        return self._destination_name
+
+    def get_properties(self) -> dict:
+        return dict(self._properties)
+
+    def has_property(self, name: str) -> bool:
+        return name in self._properties
+
+    def get_property(self, name: str):
+        return self._properties.get(name)
+
+    def get_application_message_id(self):
+        return self._application_message_id
+
+
+def _to_bytes(payload) -> bytes:
+    if isinstance(payload, str):
+        return payload.encode('utf-8')
+    return bytes(payload)
+
+
+class OutboundMessageBuilder:
+    def __init__(self):
+        self._properties = {}
+        self._application_message_id = None
+
+    def from_properties(self, configuration: dict) -> 'OutboundMessageBuilder':
+        self._properties.update(configuration)
+        return self
+
+    def with_property(self, property_key: str, value) -> 'OutboundMessageBuilder':
+        self._properties[property_key] = value
+        return self
+
+    def with_application_message_id(self, application_message_id: str) -> 'OutboundMessageBuilder':
+        self._application_message_id = application_message_id
+        return self
+
+    def build(self, payload, additional_message_properties: dict = None) -> OutboundMessage:
+        properties = dict(self._properties)
+        if additional_message_properties:
+            properties.update(additional_message_properties)
+        return OutboundMessage(_to_bytes(payload), properties, self._application_message_id)
+
+
+# Broker
+
+class LoopbackBroker:
+    """Routes published messages to every receiver with a matching subscription.
+
+    Receivers subscribed through the same shared subscription group
+    (``#share/<group>/<topic>``) count once: each message goes to one of the
+    group's matching members, taken in turn, as the Solace broker does.
+
+    ``latency`` is a delay in seconds added to every delivery, either a number or
+    a callable returning one per message (e.g. random jitter). ``drop_rate`` is
+    the probability a delivery is silently lost, as on direct messaging.
+    ``rate``, messages per second or None for no limit, is how fast the broker
+    takes messages from each publisher; lowering it simulates a slowdown.
+    ``fail_rate`` is the probability a publish is reported failed.
+    """
+
+    def __init__(self, latency=0.0, drop_rate: float = 0.0, seed=None, rate: float = None,
+                 fail_rate: float = 0.0):
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.rate = rate
+        self.fail_rate = fail_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._receivers = []
+        self._routes = {}
+        self._turn = 0
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    def _register(self, receiver: 'DirectMessageReceiver'):
+        with self._lock:
+            self._receivers.append(receiver)
+            self._routes = {}
+
+    def _unregister(self, receiver: 'DirectMessageReceiver'):
+        with self._lock:
+            if receiver in self._receivers:
+                self._receivers.remove(receiver)
+            self._routes = {}
+
+    def _subscriptions_changed(self):
+        with self._lock:
+            self._routes = {}
+
+    def _route(self, topic_name: str) -> tuple:
+        """Receivers of every message on ``topic_name``, and the members of each group taking turns."""
+        routes = self._routes
+        route = routes.get(topic_name)
+        if route is None:
+            with self._lock:
+                receivers = [r for r in self._receivers if r._matches(topic_name)]
+                groups = {}
+                for r in self._receivers:
+                    for group in r._shared_groups(topic_name):
+                        groups.setdefault(group, []).append(r)
+                route = self._routes[topic_name] = (receivers, list(groups.values()))
+        return route
+
+    def publish(self, topic_name: str, message: OutboundMessage, queued: float = 0.0):
+        """Route ``message``; ``queued`` is how long it waits in the publisher's buffer first, in seconds."""
+        self.published += 1
+        latency = self.latency
+        receivers, groups = self._route(topic_name)
+        if groups:
+            self._turn += 1
+            receivers = receivers + [members[self._turn % len(members)] for members in groups]
+        for receiver in receivers:
+            if self.drop_rate and self._random.random() < self.drop_rate:
+                self.dropped += 1
+                continue
+            delay = (latency() if callable(latency) else latency) + queued
+            deliver_at = time.perf_counter() + delay if delay else 0.0
+            receiver._enqueue(deliver_at, InboundMessage(message, topic_name))
+            self.delivered += 1
+
+
+_default_broker = None
+_default_broker_lock = threading.Lock()
+
+
+def default_broker() -> LoopbackBroker:
+    """The broker shared by every MessagingService of this process that is not given one."""
+    global _default_broker
+    with _default_broker_lock:
+        if _default_broker is None:
+            _default_broker = LoopbackBroker()
+        return _default_broker
+
+
+# Publisher and receiver
+
+class DirectMessagePublisher:
+    """Direct publisher; with a ``capacity``, publishes are rejected while that many messages wait to go out.
+
+    ``wait`` makes a full buffer block the publish instead of rejecting it.
+    """
+
+    def __init__(self, service: 'MessagingService', capacity: int = None, wait: bool = False):
+        self._service = service
+        self._running = False
+        self._failure_listener = None
+        self._readiness_listener = None
+        self._capacity = capacity
+        self._wait = wait
+        self._lock = threading.Lock()
+        # Messages waiting for the broker, as of _drained_at
+        self._backlog = 0.0
+        self._drained_at = time.perf_counter()
+
+    def start(self):
+        if not self._service.is_connected:
+            raise IllegalStateError("messaging service is not connected")
+        self._running = True
+        return self
+
+    def is_running(self) -> bool:
+        return self._running
+
+    def is_ready(self) -> bool:
+        return self._running and self._room() > 0
+
+    def set_publish_failure_listener(self, listener: PublishFailureListener):
+        self._failure_listener = listener
+
+    def set_publisher_readiness_listener(self, listener: PublisherReadinessListener):
+        self._readiness_listener = listener
+
+    def notify_when_ready(self):
+        """Call the readiness listener, on a timer thread, once the buffer is down to half full."""
+        if self._readiness_listener is None:
+            return
+        timer = threading.Timer(self._time_to_ready(), self._notify)
+        timer.daemon = True
+        timer.start()
+
+    def _notify(self):
+        # The broker may have slowed down further since the timer was set
+        if self._room() < 1:
+            self.notify_when_ready()
+        else:
+            self._readiness_listener.ready()
+
+    def _drain(self) -> float:
+        """Messages waiting for the broker now; call with the lock held."""
+        rate = self._service._broker.rate
+        now = time.perf_counter()
+        if rate is None:
+            self._backlog = 0.0
+        else:
+            self._backlog = max(0.0, self._backlog - (now - self._drained_at) * rate)
+        self._drained_at = now
+        return self._backlog
+
+    def _room(self) -> float:
+        with self._lock:
+            backlog = self._drain()
+        return float('inf') if self._capacity is None else self._capacity - backlog
+
+    def _time_to_room(self) -> float:
+        rate = self._service._broker.rate
+        room = self._room()
+        return 0.0 if room >= 1 or not rate else (1 - room) / rate
+
+    def _time_to_ready(self) -> float:
+        rate = self._service._broker.rate
+        excess = 0.0 if self._capacity is None else self._capacity / 2 - self._room()
+        return excess / rate if excess > 0 and rate else 0.0
+
+    def publish(self, message, destination: Topic, additional_message_properties: dict = None):
+        if not self._running:
+            raise IllegalStateError("publisher is not running")
+        if not isinstance(message, OutboundMessage):
+            message = OutboundMessage(_to_bytes(message), {}, None)
+        if additional_message_properties:
+            message = OutboundMessage(message.payload, {**message.properties, **additional_message_properties},
+                                      message.application_message_id)
+        broker = self._service._broker
+        queued = 0.0
+        if broker.rate is not None:
+            while True:
+                with self._lock:
+                    backlog = self._drain()
+                    if self._capacity is None or backlog + 1 <= self._capacity:
+                        self._backlog = backlog + 1
+                        queued = backlog / broker.rate
+                        break
+                if not self._wait:
+                    raise PublisherOverflowError("publisher buffer full")
+                time.sleep(self._time_to_room())
+        if broker.fail_rate and broker._random.random() < broker.fail_rate:
+            # Reported the way the API reports it, to the failure listener rather than by raising
+            if self._failure_listener is not None:
+                self._failure_listener.on_failed_publish(
+                    FailedPublishEvent(message, destination, PubSubPlusClientError("publish failed")))
+            return
+        broker.publish(destination.get_name(), message, queued)
+
+    def terminate(self, grace_period: int = 10000):
+        self._running = False
+
+
+class DirectMessageReceiver:
+    """Receiver with its own dispatch thread, like the Solace API callback thread."""
+
+    def __init__(self, service: 'MessagingService', subscriptions: list):
+        self._service = service
+        self._patterns = {}
+        # Shared subscriptions, expression -> (group, pattern)
+        self._shared = {}
+        for subscription in subscriptions:
+            self._subscribe(subscription.get_name())
+        self._queue = queue.SimpleQueue()
+        self._handler = None
+        self._thread = None
+        self._running = False
+
+    def _subscribe(self, expression: str):
+        group, topic = split_shared(expression)
+        if group is None:
+            self._patterns[expression] = compile_subscription(topic)
+        else:
+            self._shared[expression] = (group, compile_subscription(topic))
+
+    def _matches(self, topic_name: str) -> bool:
+        return any(p.match(topic_name) for p in self._patterns.values())
+
+    def _shared_groups(self, topic_name: str) -> set:
+        return {group for group, p in self._shared.values() if p.match(topic_name)}
+
+    def _enqueue(self, deliver_at: float, message: InboundMessage):
+        if self._running:
+            self._queue.put((deliver_at, message))
+
+    def start(self):
+        if not self._service.is_connected:
+            raise IllegalStateError("messaging service is not connected")
+        self._running = True
+        self._service._broker._register(self)
+        return self
+
+    def is_running(self) -> bool:
+        return self._running
+
+    def add_subscription(self, subscription: TopicSubscription):
+        self._subscribe(subscription.get_name())
+        self._service._broker._subscriptions_changed()
+
+    def remove_subscription(self, subscription: TopicSubscription):
+        self._patterns.pop(subscription.get_name(), None)
+        self._shared.pop(subscription.get_name(), None)
+        self._service._broker._subscriptions_changed()
+
+    def receive_message(self, timeout: int = None):
+        """Pull the next message, waiting up to ``timeout`` ms; None on timeout."""
+        try:
+            deliver_at, message = self._queue.get(timeout=None if timeout is None else timeout / 1000)
+        except queue.Empty:
+            return None
+        self._wait_until(deliver_at)
+        return message
+
+    def receive_async(self, message_handler: MessageHandler):
+        self._handler = message_handler
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._dispatch, name="loopback-dispatch", daemon=True)
+            self._thread.start()
+
+    @staticmethod
+    def _wait_until(deliver_at: float):
+        if deliver_at:
+            delay = deliver_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    def _dispatch(self):
+        get = self._queue.get
+        while True:
+            item = get()
+            if item is None:
+                return
+            deliver_at, message = item
+            self._wait_until(deliver_at)
+            try:
+                self._handler.on_message(message)
+            except Exception as exception:  # the real API logs and keeps dispatching too
+                print(f"loopback: message handler raised {exception!r}")
+
+    def terminate(self, grace_period: int = 10000):
+        if not self._running:
+            return
+        self._running = False
+        self._service._broker._unregister(self)
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(grace_period / 1000)
+            self._thread = None
+
+
+class DirectMessagePublisherBuilder:
+    def __init__(self, service: 'MessagingService'):
+        self._service = service
+        self._capacity = None
+        self._wait = False
+
+    def from_properties(self, configuration: dict) -> 'DirectMessagePublisherBuilder':
+        return self
+
+    def on_back_pressure_reject(self, buffer_capacity: int) -> 'DirectMessagePublisherBuilder':
+        self._capacity, self._wait = buffer_capacity, False
+        return self
+
+    def on_back_pressure_wait(self, buffer_capacity: int) -> 'DirectMessagePublisherBuilder':
+        self._capacity, self._wait = buffer_capacity, True
+        return self
+
+    def on_back_pressure_elastic(self) -> 'DirectMessagePublisherBuilder':
+        self._capacity, self._wait = None, False
+        return self
+
+    def build(self) -> DirectMessagePublisher:
+        return DirectMessagePublisher(self._service, self._capacity, self._wait)
+
+
+class DirectMessageReceiverBuilder:
+    def __init__(self, service: 'MessagingService'):
+        self._service = service
+        self._subscriptions = []
+
+    def from_properties(self, configuration: dict) -> 'DirectMessageReceiverBuilder':
+        return self
+
+    def with_subscriptions(self, subscriptions: list) -> 'DirectMessageReceiverBuilder':
+        self._subscriptions = list(subscriptions)
+        return self
+
+    def build(self, shared_subscription_group=None) -> DirectMessageReceiver:
+        """With ``shared_subscription_group`` (a name, or a ShareName), every subscription is shared by that group."""
+        subscriptions = self._subscriptions
+        if shared_subscription_group is not None:
+            group = shared_subscription_group
+            group = group.get_name() if hasattr(group, 'get_name') else group
+            subscriptions = [TopicSubscription.of(f"{SHARE_PREFIX}{group}/{s.get_name()}") for s in subscriptions]
+        return DirectMessageReceiver(self._service, subscriptions)
+
+
+# Messaging service
+
+LATENCY_PROPERTY = "loopback.latency"
+DROP_RATE_PROPERTY = "loopback.drop-rate"
+
+
+class MessagingServiceBuilder:
+    def __init__(self):
+        self._properties = {}
+        self._broker = None
+
+    def from_properties(self, configuration: dict) -> 'MessagingServiceBuilder':
+        self._properties.update(configuration)
+        return self
+
+    def with_reconnection_retry_strategy(self, strategy: RetryStrategy) -> 'MessagingServiceBuilder':
+        return self
+
+    def with_broker(self, broker: LoopbackBroker) -> 'MessagingServiceBuilder':
+        self._broker = broker
+        return self
+
+    def build(self, application_id: str = None) -> 'MessagingService':
+        broker = self._broker or default_broker()
+        # Injection settings given as properties apply to the broker being used
+        if self._properties.get(LATENCY_PROPERTY):
+            broker.latency = float(self._properties[LATENCY_PROPERTY])
+        if self._properties.get(DROP_RATE_PROPERTY):
+            broker.drop_rate = float(self._properties[DROP_RATE_PROPERTY])
+        return MessagingService(broker)
+
+
+class MessagingService:
+    def __init__(self, broker: LoopbackBroker):
+        self._broker = broker
+        self._connected = False
+        self._reconnection_listeners = []
+        self._reconnection_attempt_listeners = []
+        self._service_interruption_listeners = []
+
+    @staticmethod
+    def builder() -> MessagingServiceBuilder:
+        return MessagingServiceBuilder()
+
+    @property
+    def broker(self) -> LoopbackBroker:
+        return self._broker
+
+    @property
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def connect(self):
+        self._connected = True
+        return self
+
+    def disconnect(self):
+        self._connected = False
+
+    def add_reconnection_listener(self, listener: ReconnectionListener):
+        self._reconnection_listeners.append(listener)
+
+    def add_reconnection_attempt_listener(self, listener: ReconnectionAttemptListener):
+        self._reconnection_attempt_listeners.append(listener)
+
+    def add_service_interruption_listener(self, listener: ServiceInterruptionListener):
+        self._service_interruption_listeners.append(listener)
+
+    def message_builder(self) -> OutboundMessageBuilder:
+        return OutboundMessageBuilder()
+
+    def create_direct_message_publisher_builder(self) -> DirectMessagePublisherBuilder:
+        return DirectMessagePublisherBuilder(self)
+
+    def create_direct_message_receiver_builder(self) -> DirectMessageReceiverBuilder:
+        return DirectMessageReceiverBuilder(self)
@@ -0,0 +1,247 @@
+"""Per-stage metrics: counters, gauges and timing histograms, exposed to Prometheus.
+
+Every metric lives in a Registry under a name and a set of labels; the stages
+all use the process-wide REGISTRY and label their metrics with ``stage``, so
+the in-process pipeline reports the four stages side by side.
+
+Hot-path updates are kept cheap. Counters are a plain integer addition, with
+no lock: under the GIL an increment is only lost if a thread switch lands in
+the middle of it, which is acceptable for monitoring. Timings are sampled:
+only one message in ``sample`` reads the clock and records into a histogram,
+the others pay a counter check. ``StageMetrics.received`` counts a message in
+and makes the sampling decision in a single call. benchmarks/bench_metrics.py
+measures the cost against the pipeline's own time per message.
+
+The registry renders the Prometheus text exposition format, served over HTTP
+by ``serve``, and can print periodic JSON snapshots with ``start_snapshots``.
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import latency
+
+# One message in TIMING_SAMPLE has its decode, process and publish times recorded
+TIMING_SAMPLE = 64
+
+
+def _labels(labels: dict, extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in labels.items()]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    __slots__ = ('value',)
+    kind = "counter"
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+    def samples(self, name: str, labels: dict):
+        yield name, _labels(labels), self.value
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    """A value that is set, or read from ``fn`` when collected."""
+
+    kind = "gauge"
+
+    def __init__(self, fn=None):
+        self.value = 0
+        self._fn = fn
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        return self._fn() if self._fn is not None else self.value
+
+    def samples(self, name: str, labels: dict):
+        yield name, _labels(labels), self.snapshot()
+
+
+class Timing:
+    """Durations in nanoseconds, exposed in seconds as a Prometheus summary."""
+
+    kind = "summary"
+    QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+    def __init__(self):
+        self.histogram = latency.Histogram()
+
+    def record(self, ns: int):
+        self.histogram.record(ns)
+
+    def lap(self, start: int) -> int:
+        """Record the time since ``start`` and return now; does nothing if ``start`` is 0.
+
+        Chained laps time consecutive steps with one clock read each; a message
+        that is not sampled starts from 0 and never reads the clock. The stages
+        also test ``start`` before calling, to save the call itself.
+        """
+        if not start:
+            return 0
+        now = time.perf_counter_ns()
+        self.histogram.record(now - start)
+        return now
+
+    def samples(self, name: str, labels: dict):
+        histogram = self.histogram
+        for q in self.QUANTILES:
+            yield name, _labels(labels, f'quantile="{q}"'), histogram.value_at_percentile(q * 100) / 1e9
+        yield name + "_sum", _labels(labels), histogram._sum / 1e9
+        yield name + "_count", _labels(labels), histogram.total_count
+
+    def snapshot(self):
+        summary = self.histogram.summary()
+        summary['mean'] = self.histogram.mean()
+        return summary
+
+
+class Registry:
+    def __init__(self):
+        # name -> (kind, help, {label items: metric})
+        self._families = {}
+        self._lock = threading.Lock()
+        self._snapshots = None
+
+    def _get(self, cls, name: str, help: str, labels: dict, *args):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = (cls.kind, help, {})
+            elif family[0] != cls.kind:
+                raise ValueError(f"metric {name} is a {family[0]}, not a {cls.kind}")
+            metric = family[2].get(key)
+            if metric is None or args:
+                # Gauges read from a function are replaced, e.g. when a stage restarts
+                metric = family[2][key] = cls(*args)
+            return metric
+
+    def counter(self, name: str, help: str, **labels) -> Counter:
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str, fn=None, **labels) -> Gauge:
+        return self._get(Gauge, name, help, labels, *((fn,) if fn is not None else ()))
+
+    def timing(self, name: str, help: str, **labels) -> Timing:
+        return self._get(Timing, name, help, labels)
+
+    def _collect(self):
+        with self._lock:
+            return [(name, kind, help, list(metrics.items()))
+                    for name, (kind, help, metrics) in self._families.items()]
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, kind, help, metrics in self._collect():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, metric in metrics:
+                for sample, labels, value in metric.samples(name, dict(key)):
+                    lines.append(f"{sample}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """``{name: {labels: value}}``, labels rendered as ``k=v,k=v``."""
+        return {name: {",".join(f"{k}={v}" for k, v in key): metric.snapshot() for key, metric in metrics}
+                for name, _, _, metrics in self._collect()}
+
+    def start_snapshots(self, interval: float, sink=print):
+        """Hand a JSON snapshot line to ``sink`` every ``interval`` seconds, from a daemon thread."""
+        def run():
+            while True:
+                time.sleep(interval)
+                sink(json.dumps({'time': time.time(), 'metrics': self.snapshot()}))
+        self._snapshots = threading.Thread(target=run, name="metrics-snapshots", daemon=True)
+        self._snapshots.start()
+
+
+REGISTRY = Registry()
+
+
+def serve(port: int, registry: Registry = REGISTRY, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serve ``registry`` at ``http://host:port/metrics`` from a daemon thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+class StageMetrics:
+    """The standard metrics of one pipeline stage."""
+
+    __slots__ = ('stage', 'sample', '_tick', 'messages_in', 'messages_out', 'messages_failed', 'decode_time',
+                 'process_time', 'publish_time', 'reconnects', 'reconnect_attempts', 'interruptions',
+                 'publish_failures')
+
+    def __init__(self, stage: str, registry: Registry = REGISTRY, sample: int = TIMING_SAMPLE):
+        self.stage = stage
+        self.sample = sample
+        self._tick = 0
+        counter, timing = registry.counter, registry.timing
+        self.messages_in = counter("messages_in_total", "Messages received", stage=stage)
+        self.messages_out = counter("messages_out_total", "Messages published", stage=stage)
+        self.messages_failed = counter("messages_failed_total", "Messages whose processing raised", stage=stage)
+        self.decode_time = timing("decode_seconds", "Time to decode a payload (sampled)", stage=stage)
+        self.process_time = timing("process_seconds", "Time in the stage's own logic (sampled)", stage=stage)
+        self.publish_time = timing("publish_seconds", "Time to build and publish a message (sampled)",
+                                   stage=stage)
+        self.reconnects = counter("reconnects_total", "Reconnections to the broker", stage=stage)
+        self.reconnect_attempts = counter("reconnect_attempts_total", "Reconnection attempts", stage=stage)
+        self.interruptions = counter("service_interruptions_total", "Messaging service interruptions",
+                                     stage=stage)
+        self.publish_failures = counter("publish_failures_total", "Publishes reported failed by the API",
+                                        stage=stage)
+
+    def received(self) -> int:
+        """Count a message in and return ``start()``, in one call."""
+        self.messages_in.value += 1
+        self._tick += 1
+        if self._tick < self.sample:
+            return 0
+        self._tick = 0
+        return time.perf_counter_ns() if self.sample else 0
+
+    def start(self) -> int:
+        """Clock reading to time this message from, or 0 if it is not sampled."""
+        self._tick += 1
+        if self._tick < self.sample:
+            return 0
+        self._tick = 0
+        return time.perf_counter_ns() if self.sample else 0
+
+
+def expose(port: int = None, snapshot_interval: float = None, registry: Registry = REGISTRY):
+    """Start what a stage is configured with: the HTTP endpoint and/or periodic snapshots."""
+    if port:
+        serve(port, registry)
+    if snapshot_interval:
+        registry.start_snapshots(snapshot_interval)
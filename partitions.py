@@ -0,0 +1,107 @@
+"""Partitioned topics: the source account of a transaction picks the topic it is published on.
+
+Every stage publishes a transaction on ``<prefix>/python/<partition>``, with
+``partition = crc32(source account) % PARTITIONS``, the hash sharding.py uses
+for FraudDetect's workers. All of an account's transactions therefore travel
+on one topic, in order. PARTITIONS must be the same for every producer and
+consumer of a topic.
+
+A consumer stage scales out in one of two ways:
+
+* partition ranges: each instance subscribes to its own slice of the
+  partitions, e.g. ``0-7`` and ``8-15``. An account is always handled by the
+  same instance, so its transactions stay in order and its state, such as
+  FraudDetect's velocity features, stays in one place;
+* shared subscriptions: instances join a Solace shared subscription group
+  (``#share/<group>/<topic>``) and the broker hands each message to one
+  member. Instances can come and go without reassigning ranges, but the
+  broker balances message by message, so an account's transactions are
+  spread over the members. That suits stateless stages such as CalcFX.
+
+Topic objects are built once per partition and reused for every message.
+"""
+
+import zlib
+
+# Transport classes, Solace or loopback (see transport.py)
+from transport import Topic
+import codec
+
+# Partitions of every transaction topic; the same for every producer and consumer
+PARTITIONS = 16
+
+SHARE_PREFIX = "#share/"
+
+# The source account of a binary record, right after the header
+_SOURCE = slice(codec.HEADER.size, codec.HEADER.size + 12)
+
+
+def partition_of(source, partitions: int = PARTITIONS) -> int:
+    """Partition of the ``source`` account (str or ASCII bytes)."""
+    if isinstance(source, str):
+        source = source.encode('ascii')
+    return zlib.crc32(source) % partitions
+
+
+def partition_of_payload(payload, partitions: int = PARTITIONS) -> int:
+    """Partition of an encoded transaction, read from the record without decoding it."""
+    if codec.is_binary(payload):
+        return zlib.crc32(payload[_SOURCE]) % partitions
+    return partition_of(codec.decode(payload).source, partitions)
+
+
+def parse_range(spec: str, partitions: int = PARTITIONS) -> tuple:
+    """Partitions named by ``spec``, e.g. ``"3"``, ``"0-7"`` or ``"0-3,8-11"``, in order."""
+    selected = set()
+    for part in spec.split(','):
+        low, _, high = part.strip().partition('-')
+        try:
+            low = int(low)
+            high = int(high) if high else low
+        except ValueError:
+            raise ValueError(f"invalid partition range {spec!r}, expected e.g. 0-7 or 0-3,8-11") from None
+        if not 0 <= low <= high < partitions:
+            raise ValueError(f"partition range {part.strip()!r} is outside 0-{partitions - 1}")
+        selected.update(range(low, high + 1))
+    return tuple(sorted(selected))
+
+
+def split(instances: int, partitions: int = PARTITIONS) -> list:
+    """Range specs dividing the partitions between ``instances`` as evenly as possible."""
+    if not 0 < instances <= partitions:
+        raise ValueError(f"instances must be between 1 and {partitions}")
+    bounds = [partitions * i // instances for i in range(instances + 1)]
+    return [f"{low}-{high - 1}" for low, high in zip(bounds, bounds[1:])]
+
+
+def shared(expression: str, share_group: str) -> str:
+    """``expression`` as a subscription of the shared subscription group ``share_group``."""
+    return f"{SHARE_PREFIX}{share_group}/{expression}"
+
+
+class PartitionedTopics:
+    """The partition topics under ``prefix``, built once."""
+
+    def __init__(self, prefix: str, partitions: int = PARTITIONS):
+        self.prefix = prefix
+        self.partitions = partitions
+        self.topics = [Topic.of(self.name(p)) for p in range(partitions)]
+
+    def name(self, partition: int) -> str:
+        return f"{self.prefix}/python/{partition}"
+
+    def for_account(self, source) -> Topic:
+        return self.topics[partition_of(source, self.partitions)]
+
+    def for_payload(self, payload) -> Topic:
+        return self.topics[partition_of_payload(payload, self.partitions)]
+
+    def subscriptions(self, partition_range: str = None, share_group: str = None) -> list:
+        """Subscriptions to every partition, or to those in ``partition_range``, shared by ``share_group``."""
+        if partition_range is None:
+            expressions = [self.prefix + "/python/>"]
+        else:
+            expressions = [self.name(p) for p in parse_range(partition_range, self.partitions)]
+        if share_group:
+            expressions = [shared(e, share_group) for e in expressions]
+        return expressions
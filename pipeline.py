@@ -0,0 +1,223 @@
+"""Run GenFinTX -> CalcFX -> FraudDetect -> ClearSettle in one process on the loopback broker.
+
+Every stage is started on one in-process LoopbackBroker, so the whole chain can be
+driven at full speed, profiled and measured without Solace Cloud.
+
+Usage: python pipeline.py [--count N] [--latency SECONDS] [--drop-rate P] [--fraud-workers N]
+                          [--handoff-workers N] [--handoff-policy POLICY] [--journal DIR]
+                          [--replay FILE [--speed N]] [--load SCHEDULE [--process P] [--load-threads N]]
+                          [--metrics-port PORT] [--log-level LEVEL]
+                          [--log-sample N] [--fuse] [--quiet]
+"""
+
+import argparse
+import contextlib
+import os
+import sys
+import time
+
+# The stages pick their messaging classes at import time
+os.environ["SOLACE_TRANSPORT"] = "loopback"
+
+import capture
+import eventlog
+import latency
+import loadgen
+import loopback
+import metrics
+import runner
+from ledger import Ledger
+import executor
+import CalcFX
+import ClearSettle
+import FraudDetect
+import GenFinTX
+from transactions import iter_encoded_transactions
+
+
+class SettledRecorder(latency.LatencyRecorder):
+    """ClearSettle's latency recorder, also counting the transactions settled and when the last one was."""
+
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+        self.last_arrival = None
+
+    def record(self, stamps: dict, arrival: int = None):
+        super().record(stamps, arrival)
+        self.count += 1
+        self.last_arrival = time.perf_counter()
+
+
+class Pipeline:
+    """The four stages wired together on one loopback broker."""
+
+    def __init__(self, broker: loopback.LoopbackBroker = None, ledger: Ledger = None):
+        self.broker = broker or loopback.LoopbackBroker()
+        self.messaging_service = loopback.MessagingService.builder().with_broker(self.broker).build()
+        # Latency and settled counts are both taken as ClearSettle records each transaction
+        self.latency = self.settled = SettledRecorder()
+        self.ledger = ledger or Ledger()
+        self.runner = None
+        self._topics = capture.TopicCache()
+        self._replayed = 0
+
+    def start(self, calc_fx_options: dict = None, fraud_detect_options: dict = None,
+              clear_settle_options: dict = None, fuse: bool = False):
+        """Start every stage; the options are passed on to the stage's start().
+
+        With ``fuse``, CalcFX, FraudDetect and ClearSettle hand transactions to
+        each other in memory and only GenFinTX's messages go through the broker
+        (see runner.py).
+        """
+        self.messaging_service.connect()
+        options = {"CalcFX": calc_fx_options, "FraudDetect": fraud_detect_options,
+                   "ClearSettle": clear_settle_options}
+        self.runner = runner.Runner(self.messaging_service, runner.STAGES, fuse, self.latency, self.ledger,
+                                    options).start()
+        self.direct_publisher, self.outbound_msg_builder = GenFinTX.start(self.messaging_service)
+        return self
+
+    def publish_one(self, payload, seq: int, stamps: dict = None):
+        """Publish one payload through GenFinTX's publishing path, on its account's partition topic."""
+        GenFinTX.publish_transaction(self.direct_publisher, self.outbound_msg_builder, payload,
+                                     seq % GenFinTX.MSG_COUNT + 1, stamps)
+
+    def publish_to(self, topic: str, payload, stamps: dict = None):
+        """Publish one payload on ``topic`` through GenFinTX's publishing path, e.g. from a replay."""
+        self._replayed += 1
+        GenFinTX.publish_to(self.direct_publisher, self.outbound_msg_builder, payload, self._topics(topic),
+                            f'REPLAY {self._replayed}', stamps)
+
+    def load(self, schedule: loadgen.Schedule, process: str = loadgen.CONSTANT, threads: int = 1,
+             seed: int = None) -> loadgen.Report:
+        """Publish open loop following ``schedule`` through GenFinTX's publishing path (see loadgen.py)."""
+        publisher = GenFinTX.load_publisher(self.messaging_service, self.direct_publisher)
+        return loadgen.LoadGenerator(schedule, publisher, process, threads, seed=seed).run()
+
+    def publish(self, payloads):
+        count = 0
+        for count, payload in enumerate(payloads, 1):
+            self.publish_one(payload, count - 1)
+        return count
+
+    def drain(self, idle: float = 0.2, timeout: float = 60.0):
+        """Wait until no message has moved through the broker for ``idle`` seconds."""
+        deadline = time.monotonic() + timeout
+        last = (-1, -1)
+        while time.monotonic() < deadline:
+            current = (self.broker.delivered, self.settled.count)
+            retrying = self.direct_publisher.retry is not None and len(self.direct_publisher.retry)
+            if current == last and not retrying and all(r._queue.empty() for r in self.runner.receivers) \
+                    and not any(getattr(h, 'depth', 0) for h in self.runner.handlers):
+                return True
+            last = current
+            time.sleep(idle)
+        return False
+
+    def handoff_metrics(self) -> dict:
+        """Metrics of every stage running a handoff executor, by stage name."""
+        return {h.name: h.metrics() for h in self.runner.handlers if isinstance(h, executor.StageExecutor)}
+
+    def stop(self):
+        self.direct_publisher.terminate()
+        self.runner.stop()
+        self.messaging_service.disconnect()
+        if self.ledger.journal is not None:
+            self.ledger.journal.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=10000, help="transactions to publish")
+    parser.add_argument("--latency", type=float, default=0.0, help="per-delivery latency in seconds")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="probability a delivery is lost")
+    parser.add_argument("--fail-rate", type=float, default=0.0,
+                        help="probability a publish is reported failed, and retried")
+    parser.add_argument("--fraud-workers", type=int, default=FraudDetect.WORKERS,
+                        help="FraudDetect worker processes, 0 to check on the receiver thread")
+    parser.add_argument("--handoff-workers", type=int, default=0,
+                        help="worker threads behind each stage's receive callback, 0 to process on the callback")
+    parser.add_argument("--handoff-policy", default=executor.BLOCK, choices=executor.POLICIES,
+                        help="what a stage does when its handoff queue is full")
+    parser.add_argument("--watchlist", metavar="INDEX",
+                        help="screen accounts against this watchlist index (see watchlist.py)")
+    parser.add_argument("--journal", metavar="DIR", help="journal settled transactions to DIR, recovering it first")
+    parser.add_argument("--replay", metavar="FILE", help="publish the messages of a capture (see capture.py)")
+    parser.add_argument("--speed", type=float, default=0.0,
+                        help="replay speed, 1 for real time, 0 for as fast as possible")
+    parser.add_argument("--load", metavar="SCHEDULE",
+                        help="publish open loop at this rate, or steps such as 1000:10,1000-20000:30 (see loadgen.py)")
+    parser.add_argument("--process", default=loadgen.CONSTANT, choices=loadgen.PROCESSES,
+                        help="arrival process of --load")
+    parser.add_argument("--load-threads", type=int, default=1, help="publisher threads of --load")
+    parser.add_argument("--metrics-port", type=int, help="serve the stages' Prometheus metrics on PORT")
+    parser.add_argument("--log-level", choices=eventlog.LEVELS, help="level of the stages' event log")
+    parser.add_argument("--log-sample", type=int, help="log one in N per-message events")
+    parser.add_argument("--fuse", action="store_true",
+                        help="hand transactions from CalcFX to FraudDetect to ClearSettle in memory")
+    parser.add_argument("--quiet", action="store_true", help="discard the stages' console output")
+    args = parser.parse_args()
+
+    eventlog.LOG.configure(args.log_level, args.log_sample)
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    broker = loopback.LoopbackBroker(latency=args.latency, drop_rate=args.drop_rate, fail_rate=args.fail_rate)
+    handoff = {"handoff_workers": args.handoff_workers, "handoff_policy": args.handoff_policy}
+    clear_settle_handoff = dict(handoff)
+    if args.handoff_policy == executor.SHED:
+        # ClearSettle has nowhere to shed to
+        clear_settle_handoff["handoff_policy"] = executor.BLOCK
+    ledger = ClearSettle.open_ledger(args.journal) if args.journal else None
+    pipeline = Pipeline(broker, ledger).start(calc_fx_options=handoff,
+                                      fraud_detect_options=dict(handoff, workers=args.fraud_workers,
+                                                                watchlist_path=args.watchlist),
+                                      clear_settle_options=clear_settle_handoff, fuse=args.fuse)
+    output = open(os.devnull, "w") if args.quiet else sys.stdout
+    # Events logged while the stages stop come after the redirection below
+    eventlog.LOG.stream = output if args.quiet else None
+    load = None
+    try:
+        with contextlib.redirect_stdout(output):
+            started = time.perf_counter()
+            if args.replay:
+                with capture.Capture(args.replay) as replayed:
+                    published = capture.replay(replayed, pipeline.publish_to, args.speed)
+            elif args.load:
+                load = pipeline.load(loadgen.Schedule.parse(args.load), args.process, args.load_threads)
+                published = load.sent
+            else:
+                published = pipeline.publish(iter_encoded_transactions(args.count))
+            publish_done = time.perf_counter()
+            pipeline.drain()
+            cycle = pipeline.ledger.close_cycle()
+            eventlog.LOG.flush()
+        publisher = pipeline.direct_publisher.metrics()
+    finally:
+        pipeline.stop()
+
+    if load is not None:
+        print(load)
+    settled = pipeline.settled.count
+    elapsed = (pipeline.settled.last_arrival or publish_done) - started
+    print(f"published {published} in {publish_done - started:.3f}s ({published / (publish_done - started):,.0f} msg/s)")
+    print(f"settled   {settled} in {elapsed:.3f}s ({settled / elapsed:,.0f} msg/s)")
+    print(f"broker: delivered {broker.delivered}, dropped {broker.dropped}")
+    print(f"GenFinTX publisher: {publisher['stalls']} stalls ({publisher['stall_seconds']:.3f}s), "
+          f"deferred {publisher['deferred']}, "
+          f"retried {publisher.get('retried', 0)}, spilled {publisher.get('spilled', 0)}, "
+          f"lost {publisher.get('dropped', 0) + publisher.get('abandoned', 0)}")
+    print(pipeline.latency.report())
+    ClearSettle.print_cycle(cycle)
+    for module in (GenFinTX, CalcFX, FraudDetect, ClearSettle):
+        stage = module.METRICS
+        print(f"{stage.stage}: in {stage.messages_in.value}, out {stage.messages_out.value}, "
+              f"failed {stage.messages_failed.value}")
+    for stage, handoff_metrics in pipeline.handoff_metrics().items():
+        print(f"{stage} handoff: max depth {handoff_metrics['max_depth']}, "
+              f"wait p99 {handoff_metrics['wait_p99'] / 1000:,.0f} us, dropped {handoff_metrics['dropped']}, "
+              f"shed {handoff_metrics['shed']}, blocked {handoff_metrics['blocked']}")
+
+
+if __name__ == '__main__':
+    main()
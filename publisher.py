@@ -0,0 +1,266 @@
+"""Long-lived direct publisher shared by everything that publishes from one process.
+
+Publishers follow the API's back-pressure (see FlowControlledPublisher): a
+publish finding the API's buffer full waits until the publisher is ready again,
+and messages that fail are retried from a bounded buffer (see retry.py).
+"""
+
+import os
+import threading
+import time
+
+# Import Solace Python  API modules, or their loopback stand-ins (see transport.py)
+from transport import (MessagingService, PublishFailureListener, PublisherOverflowError,
+                       PublisherReadinessListener, Topic)
+import metrics
+import retry
+
+# Back-pressure: the API buffers at most PUBLISH_BUFFER messages per publisher (0 for its
+# unbounded elastic mode); a publish finding the buffer full waits for the publisher to
+# be ready again, at most STALL_TIMEOUT seconds before its message goes to the retry buffer
+PUBLISH_BUFFER = 10000
+STALL_TIMEOUT = 1.0
+
+# Failed publishes are retried from a buffer of RETRY_CAPACITY messages, 0 to lose them;
+# beyond that they spill to RETRY_SPILL_DIR/<publisher>.spill if set (see retry.py)
+RETRY_CAPACITY = retry.CAPACITY
+RETRY_SPILL_DIR = None
+
+
+class FlowControlledPublisher(PublisherReadinessListener, PublishFailureListener):
+    """Direct publisher that waits out the API's back-pressure and retries failed publishes.
+
+    The publisher is built to reject publishes once ``buffer`` messages wait in
+    the API. A rejected publish asks to be notified when the publisher is ready
+    again and waits for it, for as long as it takes without a retry buffer. With
+    one, a publish waits ``stall_timeout`` seconds at most: its message is then
+    deferred to the retry buffer, and so is every message published until the
+    publisher is ready, so a broker that stopped taking messages holds up the
+    caller for ``stall_timeout`` at a time rather than indefinitely. The waits
+    are counted as stall time. Publishes the API reports failed go to the retry
+    buffer too, after ``failure_listener`` has seen them.
+
+    It has the direct publisher's ``publish``, ``is_ready`` and ``terminate``,
+    so it stands in for one.
+    """
+
+    def __init__(self, messaging_service: MessagingService, failure_listener: PublishFailureListener = None,
+                 name: str = "publisher", buffer: int = PUBLISH_BUFFER, stall_timeout: float = STALL_TIMEOUT,
+                 retry_capacity: int = RETRY_CAPACITY, spill_dir: str = RETRY_SPILL_DIR):
+        self.name = name
+        self.stall_timeout = stall_timeout
+        self._failure_listener = failure_listener
+        builder = messaging_service.create_direct_message_publisher_builder()
+        builder = builder.on_back_pressure_reject(buffer) if buffer else builder.on_back_pressure_elastic()
+        self._publisher = builder.build()
+        self._publisher.set_publish_failure_listener(self)
+        self._publisher.set_publisher_readiness_listener(self)
+        self._ready = threading.Event()
+        self._ready.set()
+        # Set from a stall timeout until the publisher is ready: publishes go to the retry buffer
+        self._deferring = False
+        self._terminated = False
+        self.retry = None
+        if retry_capacity:
+            spill_path = os.path.join(spill_dir, f"{name}.spill") if spill_dir else None
+            self.retry = retry.RetryBuffer(self._republish, retry_capacity, spill_path=spill_path, name=name,
+                                           ready=self._accepting)
+            # Used by the retry thread only: builders are not thread-safe
+            self._retry_builder = messaging_service.message_builder()
+            self._topics = {}
+
+        # Metrics, updated under the lock: publishes and failure callbacks come from several threads
+        self._lock = threading.Lock()
+        self.stalls = 0
+        self.stall_ns = 0
+        self.deferred = 0
+        counter = metrics.REGISTRY.counter
+        self._stalls_total = counter("publish_stalls_total", "Publishes that found the publisher's buffer full",
+                                     stage=name)
+        self._stall_seconds_total = counter("publish_stall_seconds_total",
+                                            "Time publishes waited for the publisher to be ready again", stage=name)
+        self._deferred_total = counter("publish_deferred_total",
+                                       "Publishes handed to the retry buffer after a stall timed out", stage=name)
+
+    def start(self):
+        # Blocking Start thread
+        self._publisher.start()
+        if self.retry is not None:
+            self.retry.start()
+        return self
+
+    def is_ready(self) -> bool:
+        return self._publisher.is_ready()
+
+    def publish(self, message, destination: Topic) -> bool:
+        """Publish ``message``; False if it could not be sent in time and was left to the retry buffer."""
+        if self._deferring:
+            return self._defer(message, destination)
+        try:
+            self._publisher.publish(destination=destination, message=message)
+            return True
+        except PublisherOverflowError:
+            return self._stall(message, destination)
+
+    def _stall(self, message, destination: Topic) -> bool:
+        started = time.perf_counter_ns()
+        deadline = None
+        if self.retry is not None and self.stall_timeout is not None:
+            deadline = time.monotonic() + self.stall_timeout
+        try:
+            while not self._terminated:
+                # Cleared before asking, so that the notification cannot be missed
+                self._ready.clear()
+                self._publisher.notify_when_ready()
+                if not self._ready.wait(None if deadline is None else max(0.0, deadline - time.monotonic())):
+                    self._deferring = True
+                    # Unless it became ready meanwhile, ready() ends the deferring
+                    if self._ready.is_set():
+                        self._deferring = False
+                    return self._defer(message, destination)
+                try:
+                    self._publisher.publish(destination=destination, message=message)
+                    return True
+                except PublisherOverflowError:
+                    continue
+            # Terminated while waiting: let the publisher say so
+            self._publisher.publish(destination=destination, message=message)
+            return True
+        finally:
+            stalled = time.perf_counter_ns() - started
+            with self._lock:
+                self.stalls += 1
+                self.stall_ns += stalled
+                self._stalls_total.inc()
+                self._stall_seconds_total.inc(stalled / 1e9)
+
+    def _accepting(self) -> bool:
+        """Whether no publish is waiting for the publisher to be ready."""
+        return self._ready.is_set() and not self._deferring
+
+    def _defer(self, message, destination: Topic) -> bool:
+        with self._lock:
+            self.deferred += 1
+            self._deferred_total.inc()
+        self.retry.add(message.get_payload_as_bytes(), destination.get_name(), message.get_properties())
+        return False
+
+    def ready(self):
+        self._deferring = False
+        self._ready.set()
+
+    def on_failed_publish(self, e: "FailedPublishEvent"):
+        if self._failure_listener is not None:
+            self._failure_listener.on_failed_publish(e)
+        if self.retry is not None:
+            message, destination = e.get_message(), e.get_destination()
+            properties = message.get_properties() or {}
+            self.retry.add(message.get_payload_as_bytes(), getattr(destination, 'get_name', lambda: destination)(),
+                           properties, properties.get(retry.ATTEMPT_PROPERTY, 0))
+
+    def _republish(self, payload, topic: str, properties: dict):
+        destination = self._topics.get(topic)
+        if destination is None:
+            destination = self._topics[topic] = Topic.of(topic)
+        message = self._retry_builder.build(payload, additional_message_properties=properties)
+        self._publisher.publish(destination=destination, message=message)
+
+    def terminate(self, grace_period: int = 5000):
+        """Give the retry buffer up to ``grace_period`` ms to empty, then stop the publisher."""
+        if self.retry is not None:
+            self.retry.drain(grace_period / 1000)
+            self.retry.close()
+        self._terminated = True
+        self._ready.set()
+        self._publisher.terminate(grace_period)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            result = {'stalls': self.stalls, 'stall_seconds': self.stall_ns / 1e9, 'deferred': self.deferred}
+        if self.retry is not None:
+            result.update(self.retry.metrics())
+        return result
+
+
+class SharedPublisher:
+    """Direct publisher that is started once and reused for every outbound message.
+
+    Building and starting a publisher is a blocking round trip to the broker, so
+    doing it per message costs far more than the message itself. The publisher and
+    the outbound message builder are created on the first ``publish`` (or an
+    explicit ``start``) and kept until ``terminate``. ``publish`` may be called from
+    the receive callback thread as well as from the main thread.
+    """
+
+    def __init__(self, messaging_service: MessagingService, failure_listener: PublishFailureListener = None,
+                 name: str = "publisher"):
+        self._messaging_service = messaging_service
+        self._failure_listener = failure_listener
+        self.name = name
+        self._lock = threading.Lock()
+        self._publisher = None
+        self._msg_builder = None
+        self._terminated = False
+
+    def start(self):
+        """Create and start the underlying publisher if it is not running yet."""
+        with self._lock:
+            self._start_locked()
+        return self
+
+    def _start_locked(self):
+        if self._publisher is not None:
+            return
+        if self._terminated:
+            raise RuntimeError("SharedPublisher has been terminated")
+
+        # Blocking Start thread, done once per process
+        direct_publisher = FlowControlledPublisher(self._messaging_service, self._failure_listener,
+                                                   self.name).start()
+
+        self._msg_builder = self._messaging_service.message_builder() \
+                    .with_application_message_id("sample_id") \
+                    .with_property("application", "samples") \
+                    .with_property("language", "Python")
+        self._publisher = direct_publisher
+
+    def publish(self, payload, destination: Topic, properties: dict = None):
+        """Publish ``payload`` (str or bytearray) on ``destination`` with optional extra properties."""
+        with self._lock:
+            if self._publisher is None:
+                self._start_locked()
+            outbound_msg = self._msg_builder.build(payload, additional_message_properties=properties)
+            self._publisher.publish(destination=destination, message=outbound_msg)
+
+    def publish_burst(self, messages):
+        """Publish ``(payload, destination, properties)`` tuples back to back under one lock."""
+        with self._lock:
+            if self._publisher is None:
+                self._start_locked()
+            build = self._msg_builder.build
+            publish = self._publisher.publish
+            for payload, destination, properties in messages:
+                publish(destination=destination, message=build(payload, additional_message_properties=properties))
+
+    def is_ready(self) -> bool:
+        publisher = self._publisher
+        return publisher is not None and publisher.is_ready()
+
+    def metrics(self) -> dict:
+        """Stall and retry metrics of the underlying FlowControlledPublisher."""
+        publisher = self._publisher
+        return publisher.metrics() if publisher is not None else {}
+
+    def terminate(self, grace_period: int = 5000):
+        """Stop the publisher, waiting up to ``grace_period`` ms for buffered messages."""
+        with self._lock:
+            self._terminated = True
+            publisher, self._publisher = self._publisher, None
+            if publisher is not None:
+                publisher.terminate(grace_period)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.terminate()
@@ -0,0 +1,256 @@
+"""Bounded buffer of failed publishes, retried with exponential backoff and optionally spilled to disk.
+
+A message the API reports failed, or one that waited too long for a stalled
+publisher, is added with its topic and properties. A background thread
+publishes it again once its backoff has passed: ``base_delay`` after the first
+failure, then twice as long after each further failure up to ``max_delay``,
+with jitter so that messages failed together are not all retried together.
+After ``max_attempts`` a message is given up. Retries are held while
+``ready()``, if given, says the publisher cannot take messages, so that they
+do not use up their attempts against a full publisher. A retried message carries its
+attempt number in the ``retry.attempt`` property, so that a retry reported
+failed later, by the API's failure listener, is not counted as a first one.
+
+The buffer holds at most ``capacity`` messages. Beyond that, messages are
+appended to a spill file if ``spill_path`` is given, and dropped otherwise.
+Spilled messages are read back, oldest first, once the buffer is down to half
+full, and the file is emptied when all of them are back. The spill file
+outlives the process: ``start()`` picks up the records an earlier one left in
+it, dropping a last record cut short by a crash, and retries them. Records
+already read back when a process stopped are still in the file, so they may
+be published again: the spill file delivers at least once.
+"""
+
+import heapq
+import json
+import os
+import random
+import struct
+import threading
+import time
+
+import eventlog
+import metrics
+
+CAPACITY = 10000
+BASE_DELAY = 0.01
+MAX_DELAY = 2.0
+MAX_ATTEMPTS = 10
+
+# Message property holding how many times the message was retried
+ATTEMPT_PROPERTY = "retry.attempt"
+
+# Spill record: attempt, then the lengths of the topic, the payload and the JSON properties
+_SPILL_HEADER = struct.Struct('<BHII')
+
+LOG = eventlog.logger("retry")
+
+
+class RetryBuffer:
+    """Failed publishes awaiting another attempt; ``publish(payload, topic, properties)`` raises if it fails again."""
+
+    def __init__(self, publish, capacity: int = CAPACITY, base_delay: float = BASE_DELAY,
+                 max_delay: float = MAX_DELAY, max_attempts: int = MAX_ATTEMPTS, spill_path: str = None,
+                 name: str = "publisher", ready=None):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self._publish = publish
+        self.capacity = capacity
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.spill_path = spill_path
+        self.name = name
+        self._ready = ready
+        # (due, sequence, attempt, payload, topic, properties)
+        self._heap = []
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._random = random.Random()
+        self._spill = None
+        self._spill_read = 0
+        self._running = False
+        self._thread = None
+
+        # Metrics, updated under the lock
+        self.added = 0
+        self.retried = 0
+        self.spilled = 0
+        self.unspilled = 0
+        self.dropped = 0
+        self.abandoned = 0
+        self.spill_depth = 0
+        gauge = metrics.REGISTRY.gauge
+        gauge("retry_buffer_depth", "Failed publishes waiting to be retried, in memory", lambda: len(self._heap),
+              stage=name)
+        gauge("retry_spill_depth", "Failed publishes waiting to be retried, spilled to disk",
+              lambda: self.spill_depth, stage=name)
+        counter = metrics.REGISTRY.counter
+        self._retried_total = counter("publish_retried_total", "Failed publishes published again", stage=name)
+        self._spilled_total = counter("publish_spilled_total", "Failed publishes spilled to disk", stage=name)
+        self._lost_total = counter("publish_lost_total",
+                                   "Failed publishes given up: no room and no spill file, or out of attempts",
+                                   stage=name)
+
+    def __len__(self):
+        return len(self._heap) + self.spill_depth
+
+    def start(self):
+        if self.spill_path is not None:
+            with self._lock:
+                self._recover_spill_locked()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=f"{self.name}-retry", daemon=True)
+        self._thread.start()
+        return self
+
+    def _backoff(self, attempt: int) -> float:
+        delay = min(self.max_delay, self.base_delay * (1 << min(attempt, 32)))
+        return delay * (0.5 + self._random.random() / 2)
+
+    def add(self, payload, topic: str, properties: dict = None, attempt: int = 0):
+        """Queue a failed publish for its ``attempt``-th retry (0 for the first)."""
+        with self._lock:
+            self.added += 1
+            self._add_locked(bytes(payload), topic, properties, attempt)
+
+    def _add_locked(self, payload: bytes, topic: str, properties: dict, attempt: int):
+        if attempt >= self.max_attempts:
+            self.abandoned += 1
+            self._lost_total.inc()
+            LOG.error("publish_abandoned", topic=topic, attempts=attempt)
+            return
+        if len(self._heap) >= self.capacity or self.spill_depth:
+            # Once some are spilled, later ones go after them so the oldest come back first
+            if self.spill_path is not None:
+                self._spill_locked(payload, topic, properties, attempt)
+            else:
+                self.dropped += 1
+                self._lost_total.inc()
+                LOG.sampled(eventlog.ERROR, "retry_dropped", topic=topic)
+            return
+        self._sequence += 1
+        heapq.heappush(self._heap, (time.monotonic() + self._backoff(attempt), self._sequence, attempt,
+                                    payload, topic, properties))
+        self._changed.notify()
+
+    def _open_spill_locked(self):
+        if self._spill is None:
+            # Appended to, never truncated on opening: records may be left from an earlier process
+            self._spill = open(self.spill_path, 'a+b')
+            self._spill_read = 0
+
+    def _recover_spill_locked(self):
+        """Count the records an earlier process left in the spill file, so they are read back."""
+        if not os.path.exists(self.spill_path) or not os.path.getsize(self.spill_path):
+            return
+        self._open_spill_locked()
+        spill = self._spill
+        size = os.fstat(spill.fileno()).st_size
+        spill.seek(self._spill_read)
+        offset = self._spill_read
+        count = 0
+        while offset + _SPILL_HEADER.size <= size:
+            _, topic_length, payload_length, properties_length = _SPILL_HEADER.unpack(
+                spill.read(_SPILL_HEADER.size))
+            end = offset + _SPILL_HEADER.size + topic_length + payload_length + properties_length
+            if end > size:
+                break
+            spill.seek(end)
+            offset = end
+            count += 1
+        if offset < size:
+            # A record torn by a crash
+            spill.truncate(offset)
+        self.spill_depth += count
+        LOG.info("spill_recovered", path=self.spill_path, messages=count)
+
+    def _spill_locked(self, payload: bytes, topic: str, properties: dict, attempt: int):
+        self._open_spill_locked()
+        encoded_topic = topic.encode('utf-8')
+        encoded_properties = json.dumps(properties or {}).encode('utf-8')
+        self._spill.seek(0, os.SEEK_END)
+        self._spill.write(_SPILL_HEADER.pack(min(attempt, 255), len(encoded_topic), len(payload),
+                                             len(encoded_properties)) + encoded_topic + payload + encoded_properties)
+        self.spilled += 1
+        self._spilled_total.inc()
+        self.spill_depth += 1
+
+    def _unspill_locked(self):
+        """Read spilled messages back while the buffer is under half full."""
+        spill = self._spill
+        spill.flush()
+        spill.seek(self._spill_read)
+        now = time.monotonic()
+        while self.spill_depth and len(self._heap) < self.capacity // 2 + 1:
+            attempt, topic_length, payload_length, properties_length = _SPILL_HEADER.unpack(
+                spill.read(_SPILL_HEADER.size))
+            topic = spill.read(topic_length).decode('utf-8')
+            payload = spill.read(payload_length)
+            properties = json.loads(spill.read(properties_length))
+            self._sequence += 1
+            # Their backoff has passed while they were on disk
+            heapq.heappush(self._heap, (now, self._sequence, attempt, payload, topic, properties))
+            self.spill_depth -= 1
+            self.unspilled += 1
+        self._spill_read = spill.tell()
+        if not self.spill_depth:
+            spill.seek(0)
+            spill.truncate()
+            self._spill_read = 0
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while self._running:
+                    if self.spill_depth and len(self._heap) <= self.capacity // 2:
+                        self._unspill_locked()
+                    if self._heap and self._heap[0][0] <= time.monotonic():
+                        if self._ready is None or self._ready():
+                            break
+                        # Held: look again after the shortest backoff
+                        self._changed.wait(self.base_delay)
+                        continue
+                    self._changed.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                if not self._running:
+                    return
+                _, _, attempt, payload, topic, properties = heapq.heappop(self._heap)
+            try:
+                self._publish(payload, topic, dict(properties or {}, **{ATTEMPT_PROPERTY: attempt + 1}))
+            except Exception as exception:
+                with self._lock:
+                    self._add_locked(payload, topic, properties, attempt + 1)
+                LOG.sampled(eventlog.WARNING, "retry_failed", topic=topic, attempt=attempt + 1,
+                            cause=repr(exception))
+            else:
+                with self._lock:
+                    self.retried += 1
+                    self._retried_total.inc()
+
+    def drain(self, timeout: float = 5.0) -> bool:
+        """Wait until every message was retried or given up; False if some are left after ``timeout``."""
+        deadline = time.monotonic() + timeout
+        while len(self):
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def close(self):
+        """Stop retrying. Messages still waiting in memory are lost; spilled ones stay for the next start()."""
+        with self._lock:
+            self._running = False
+            self._changed.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {'depth': len(self._heap), 'spill_depth': self.spill_depth, 'added': self.added,
+                    'retried': self.retried, 'spilled': self.spilled, 'dropped': self.dropped,
+                    'abandoned': self.abandoned}
@@ -0,0 +1,138 @@
+"""Host several stages in one process, fusing adjacent ones so transactions are handed over in memory.
+
+Between two stages in separate processes a transaction is encoded, sent
+through the broker, received and decoded again. When CalcFX, FraudDetect and
+ClearSettle run in one process, each can instead hand the decoded
+transaction, with its latency stamps, straight to the next one's
+``on_transaction`` on the same thread (see stage.py). Only the first stage of
+a fused chain subscribes to its topic; a stage whose next stage is not hosted
+here still publishes to its topic as before, so the chain can be split across
+processes at any point.
+
+Several runners scale out by splitting the partitions of the input between
+them (see partitions.py). With the whole chain fused, each runner then owns
+its accounts from CalcFX to the ledger.
+
+Usage: python runner.py [--no-fuse] [--partitions RANGE | --share-group NAME] STAGE [STAGE ...]
+e.g.   python runner.py --partitions 0-7 CalcFX FraudDetect ClearSettle
+       python runner.py --partitions 8-15 CalcFX FraudDetect ClearSettle
+"""
+
+import argparse
+
+import CalcFX
+import ClearSettle
+import FraudDetect
+import latency
+import metrics
+import partitions
+import stage
+from ledger import Ledger
+
+# In pipeline order; each one can be fused with the next
+STAGES = ("CalcFX", "FraudDetect", "ClearSettle")
+MODULES = {"CalcFX": CalcFX, "FraudDetect": FraudDetect, "ClearSettle": ClearSettle}
+
+
+class Runner:
+    """The stages named in ``stages``, started on one messaging service.
+
+    ``options`` maps a stage name to keyword arguments for its start(), e.g.
+    handoff or batching settings. ClearSettle records latency into
+    ``recorder`` and settles into ``ledger``.
+    """
+
+    def __init__(self, messaging_service, stages=STAGES, fuse: bool = True,
+                 recorder: latency.LatencyRecorder = None, ledger: Ledger = None, options: dict = None):
+        unknown = set(stages) - set(STAGES)
+        if unknown:
+            raise ValueError(f"unknown stages {sorted(unknown)}, expected some of {STAGES}")
+        self.messaging_service = messaging_service
+        self.stages = [name for name in STAGES if name in stages]
+        self.fuse = fuse
+        self.recorder = recorder or latency.LatencyRecorder()
+        self.ledger = ledger or Ledger()
+        self.options = options or {}
+        self.receivers = []
+        self.publishers = []
+        # Upstream first
+        self.handlers = []
+
+    def fused(self, upstream: str, downstream: str) -> bool:
+        """Whether ``upstream`` hands its transactions to ``downstream`` in memory."""
+        return self.fuse and upstream in self.stages and downstream in self.stages \
+            and STAGES.index(downstream) == STAGES.index(upstream) + 1
+
+    def start(self):
+        # Downstream first, so nothing published or handed over upstream is lost while starting
+        handlers = []
+        following = None
+        for name in reversed(self.stages):
+            previous = STAGES[STAGES.index(name) - 1] if STAGES.index(name) else None
+            subscribe = not (previous is not None and self.fused(previous, name))
+            options = dict(self.options.get(name) or {})
+            if name == "ClearSettle":
+                receiver, handler = ClearSettle.start(self.messaging_service, self.recorder, self.ledger,
+                                                      subscribe=subscribe, **options)
+            else:
+                downstream = following.on_transaction if following is not None \
+                    and self.fused(name, STAGES[STAGES.index(name) + 1]) else None
+                receiver, publisher, handler = MODULES[name].start(self.messaging_service, downstream=downstream,
+                                                                   subscribe=subscribe, **options)
+                self.publishers.append(publisher)
+            if receiver is not None:
+                self.receivers.append(receiver)
+            handlers.append(handler)
+            following = handler
+        self.handlers = handlers[::-1]
+        return self
+
+    def stop(self):
+        """Stop receiving, then close the handlers upstream first so fused stages flush into the next."""
+        for receiver in self.receivers:
+            receiver.terminate()
+        for handler in self.handlers:
+            handler.close()
+        for publisher in self.publishers:
+            publisher.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("stages", nargs="+", choices=STAGES, help="stages to host in this process")
+    parser.add_argument("--no-fuse", dest="fuse", action="store_false",
+                        help="connect the stages through the broker even when they are adjacent")
+    scale_out = parser.add_mutually_exclusive_group()
+    scale_out.add_argument("--partitions", metavar="RANGE",
+                           help="consume only these input partitions, e.g. 0-7 (see partitions.py)")
+    scale_out.add_argument("--share-group", metavar="NAME",
+                           help="consume through a shared subscription of group NAME")
+    args = parser.parse_args()
+    if args.partitions:
+        partitions.parse_range(args.partitions)
+
+    stages = [name for name in STAGES if name in args.stages]
+    # Service events are counted and logged as the first stage's; one endpoint serves every stage's metrics
+    first = MODULES[stages[0]]
+    messaging_service = stage.connect(stage.ServiceEventHandler(first.METRICS, first.LOG))
+    metrics.expose(first.METRICS_PORT, first.METRICS_SNAPSHOT_INTERVAL)
+    ledger = ClearSettle.open_ledger() if "ClearSettle" in stages else None
+    options = {name: {"partition_range": args.partitions, "share_group": args.share_group} for name in stages}
+    runner = Runner(messaging_service, stages, args.fuse, ledger=ledger, options=options)
+    try:
+        runner.start()
+        print(f"Running {', '.join(runner.stages)}{', fused' if args.fuse else ''}, "
+              f"send a KeyboardInterrupt to stop\n")
+        stage.wait()
+    finally:
+        runner.stop()
+        if "ClearSettle" in runner.stages:
+            print(runner.recorder.report())
+            ClearSettle.print_cycle(runner.ledger.close_cycle())
+            if runner.ledger.journal is not None:
+                runner.ledger.journal.close()
+        messaging_service.disconnect()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+"""Run FraudDetect's checks in worker processes, sharded by source account.
+
+Each transaction goes to worker ``crc32(source) % workers``, so every account
+is owned by exactly one worker, which keeps that account's features and sees
+its transactions in arrival order. A worker only sees the target side of the
+transactions whose source it owns, so target features are partial when sharded.
+
+Payloads travel to the workers and verdicts come back through single-producer,
+single-consumer rings in shared memory: no pickling and no locks, only two
+counters per ring. The submitting side keeps, per worker, a FIFO of what it
+sent; verdicts come back in the same order, so they are matched to their
+transactions by position and per-account order is preserved end to end. A
+record a worker cannot decode or check gets an error verdict rather than
+stopping the worker, and waits on a worker that has exited raise instead of
+spinning.
+"""
+
+import multiprocessing
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from multiprocessing import shared_memory
+
+import codec
+import eventlog
+import fraud_features
+import watchlist
+
+# Idle waits: spin this many times, then sleep IDLE_SLEEP seconds between polls
+IDLE_SPINS = 200
+IDLE_SLEEP = 0.0001
+
+_LENGTH = struct.Struct('<H')
+
+LOG = eventlog.logger("sharding")
+
+# The source account of a binary record, right after the header
+_SOURCE = slice(codec.HEADER.size, codec.HEADER.size + 12)
+
+
+def shard_of(source, shards: int) -> int:
+    """Worker index owning the ``source`` account (str or ASCII bytes)."""
+    if isinstance(source, str):
+        source = source.encode('ascii')
+    return zlib.crc32(source) % shards
+
+
+def _backoff(idle: int) -> int:
+    if idle >= IDLE_SPINS:
+        time.sleep(IDLE_SLEEP)
+    return idle + 1
+
+
+class ShmRing:
+    """Single-producer, single-consumer ring of fixed-size slots in shared memory.
+
+    The consumer owns the head counter and the producer the tail counter; each
+    sits on its own cache line. A slot is written before the tail moves past it
+    and read before the head does, so neither side ever locks. The consumer
+    can ``shut`` the ring when it stops reading, so a producer waiting for room
+    gives up.
+    """
+
+    _HEADER_SIZE = 128
+    _HEAD = 0
+    _TAIL = 8  # in 8-byte words, 64 bytes after the head
+    _SHUT = 15  # last word of the tail's line, written once
+
+    def __init__(self, capacity: int = 4096, slot_size: int = 128, name: str = None):
+        """Create a ring, or attach to the one called ``name`` created by another process."""
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self._owner = name is None
+        size = self._HEADER_SIZE + capacity * slot_size
+        if self._owner:
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+        self.name = self._shm.name
+        self._counters = self._shm.buf[:self._HEADER_SIZE].cast('Q')
+        self._data = self._shm.buf[self._HEADER_SIZE:size]
+
+    def shut(self):
+        """Tell the producer nothing more will be read."""
+        self._counters[self._SHUT] = 1
+
+    def is_open(self) -> bool:
+        return not self._counters[self._SHUT]
+
+    def attach_args(self):
+        """Arguments recreating this ring in another process."""
+        return self.capacity, self.slot_size, self.name
+
+    def __len__(self):
+        return self._counters[self._TAIL] - self._counters[self._HEAD]
+
+    def put(self, data) -> bool:
+        """Append ``data``; False if the ring is full."""
+        counters = self._counters
+        tail = counters[self._TAIL]
+        if tail - counters[self._HEAD] >= self.capacity:
+            return False
+        n = len(data)
+        if n > self.slot_size - _LENGTH.size:
+            raise ValueError(f"record of {n} bytes does not fit a {self.slot_size} byte slot")
+        offset = (tail % self.capacity) * self.slot_size
+        _LENGTH.pack_into(self._data, offset, n)
+        offset += _LENGTH.size
+        self._data[offset:offset + n] = data
+        counters[self._TAIL] = tail + 1
+        return True
+
+    def put_wait(self, data, alive=None):
+        """Append ``data``, waiting for room; raises RuntimeError if ``alive()`` turns False meanwhile."""
+        idle = 0
+        while not self.put(data):
+            if alive is not None and idle >= IDLE_SPINS and not alive():
+                raise RuntimeError("the ring's consumer has exited")
+            idle = _backoff(idle)
+
+    def get(self):
+        """Remove and return the oldest record as bytes; None if the ring is empty."""
+        counters = self._counters
+        head = counters[self._HEAD]
+        if head == counters[self._TAIL]:
+            return None
+        offset = (head % self.capacity) * self.slot_size
+        n, = _LENGTH.unpack_from(self._data, offset)
+        offset += _LENGTH.size
+        data = bytes(self._data[offset:offset + n])
+        counters[self._HEAD] = head + 1
+        return data
+
+    def close(self):
+        """Detach from the ring; the creating side also frees it."""
+        self._counters.release()
+        self._data.release()
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+# Verdicts are one byte: the index of the reason in fraud_features.REASONS
+_CODES = {reason: code for code, reason in enumerate(fraud_features.REASONS)}
+_WATCHLIST = bytes((_CODES[watchlist.REASON],))
+# The verdict of a record the worker could not decode or check
+_ERROR = bytes((255,))
+
+
+def _work(inbox_args, outbox_args, max_accounts: int, check, watchlist_path: str = None):
+    """Worker process: check every transaction of the accounts this worker owns.
+
+    With ``watchlist_path``, transactions of listed accounts are held first; the
+    worker maps the index itself, sharing it with the other workers through the
+    page cache, and follows its replacements (see watchlist.py).
+    """
+    inbox = ShmRing(*inbox_args)
+    outbox = ShmRing(*outbox_args)
+    features = fraud_features.FeatureEngine(max_accounts)
+    screening = watchlist.Watchlist(watchlist_path) if watchlist_path else None
+    idle = 0
+    try:
+        while True:
+            payload = inbox.get()
+            if payload is None:
+                idle = _backoff(idle)
+                continue
+            idle = 0
+            # An empty record asks the worker to stop
+            if not payload:
+                return
+            try:
+                transaction = codec.decode_binary(payload)
+                if screening is not None and screening.screen(transaction.source, transaction.target):
+                    verdict = _WATCHLIST
+                else:
+                    amount = transaction.amount
+                    reason = check(amount, features.update(transaction.source, transaction.target, amount))
+                    verdict = bytes((_CODES[reason],))
+            except Exception:  # one bad record must not stop the shard
+                verdict = _ERROR
+            # Raises once the collector has stopped, rather than wait for it forever
+            outbox.put_wait(verdict, outbox.is_open)
+    finally:
+        inbox.close()
+        outbox.close()
+
+
+class ShardedFraudDetector:
+    """Spreads fraud checks over worker processes, one shard of accounts each.
+
+    ``on_result(payload, context, reason)`` is called on the detector's collector
+    thread for every submitted transaction, in submission order per account;
+    ``reason`` is None when no fraud was found. A transaction the worker could
+    not decode or check goes to ``on_error(payload, context)`` instead, and is
+    counted in ``failed``. A callback that raises is logged and counted in
+    ``callback_errors``; the collector goes on with the next verdict. With
+    ``watchlist_path``, the workers first screen both accounts against that
+    index (see watchlist.py).
+    """
+
+    def __init__(self, workers: int, on_result, max_accounts: int = 1_000_000,
+                 check=fraud_features.check_fraud, capacity: int = 4096, watchlist_path: str = None,
+                 on_error=None):
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        self.workers = workers
+        self._on_result = on_result
+        self._on_error = on_error
+        self._inboxes = [ShmRing(capacity, codec.RECORD_SIZE + _LENGTH.size) for _ in range(workers)]
+        self._outboxes = [ShmRing(capacity, 8) for _ in range(workers)]
+        # What was sent to each worker, in order, awaiting its verdict
+        self._pending = [deque() for _ in range(workers)]
+        # Worker max_accounts: each one owns a share of the accounts
+        share = max(2, -(-max_accounts // workers))
+        self._processes = [
+            multiprocessing.Process(target=_work, name=f"fraud-worker-{i}", daemon=True,
+                                    args=(inbox.attach_args(), outbox.attach_args(), share, check,
+                                          watchlist_path))
+            for i, (inbox, outbox) in enumerate(zip(self._inboxes, self._outboxes))
+        ]
+        self._running = False
+        self._collector = threading.Thread(target=self._collect, name="fraud-collector", daemon=True)
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.callback_errors = 0
+
+    def start(self):
+        self._running = True
+        for process in self._processes:
+            process.start()
+        self._collector.start()
+        return self
+
+    def submit(self, payload, context=None):
+        """Queue one transaction payload (either wire format) for its account's worker."""
+        if codec.is_binary(payload):
+            source = bytes(payload[_SOURCE])
+        else:
+            transaction = codec.decode_legacy(payload)
+            payload = codec.encode(transaction)
+            source = transaction.source
+        if len(payload) > self._inboxes[0].slot_size - _LENGTH.size:
+            raise ValueError(f"transaction record of {len(payload)} bytes is larger than any known version")
+        shard = shard_of(source, self.workers)
+        # Pending first: the verdict may come back before put_wait returns
+        pending = self._pending[shard]
+        pending.append((payload, context))
+        try:
+            self._inboxes[shard].put_wait(payload, self._processes[shard].is_alive)
+        except BaseException:
+            # Not in the ring, so no verdict will come for it: it is still the newest entry
+            pending.pop()
+            raise
+        self.submitted += 1
+
+    def _collect(self):
+        outboxes = list(enumerate(self._outboxes))
+        idle = 0
+        try:
+            while True:
+                found = False
+                for shard, outbox in outboxes:
+                    verdict = outbox.get()
+                    while verdict is not None:
+                        found = True
+                        payload, context = self._pending[shard].popleft()
+                        self.completed += 1
+                        self._deliver(payload, context, verdict)
+                        verdict = outbox.get()
+                if found:
+                    idle = 0
+                elif not self._running:
+                    # Workers have exited, so every verdict was already in the rings
+                    return
+                else:
+                    idle = _backoff(idle)
+        finally:
+            # Workers waiting to hand in a verdict give up instead of waiting for nobody
+            for _, outbox in outboxes:
+                outbox.shut()
+
+    def _deliver(self, payload, context, verdict: bytes):
+        try:
+            if verdict == _ERROR:
+                self.failed += 1
+                if self._on_error is not None:
+                    self._on_error(payload, context)
+            else:
+                self._on_result(payload, context, fraud_features.REASONS[verdict[0]])
+        except Exception as exception:  # one failed forward must not stop the collector
+            self.callback_errors += 1
+            LOG.sampled(eventlog.ERROR, "verdict_failed", cause=repr(exception))
+
+    def close(self):
+        """Wait for every submitted transaction's verdict, then stop the workers.
+
+        Raises RuntimeError, once everything is released, if a worker had
+        exited early; the verdicts it still owed are lost.
+        """
+        exited = []
+        for i, (inbox, process) in enumerate(zip(self._inboxes, self._processes)):
+            try:
+                inbox.put_wait(b'', process.is_alive)
+            except RuntimeError:
+                exited.append(i)
+        for process in self._processes:
+            process.join()
+        self._running = False
+        self._collector.join()
+        for ring in self._inboxes + self._outboxes:
+            ring.close()
+        exited += [i for i, process in enumerate(self._processes) if process.exitcode and i not in exited]
+        if exited:
+            lost = sum(len(self._pending[i]) for i in exited)
+            raise RuntimeError(f"fraud workers {sorted(exited)} exited early, {lost} verdicts lost")
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,112 @@
+"""Scaffolding shared by the stages: configuration, connection, service events, subscribing and the main loop.
+
+Every stage connects the same way: broker properties from solace.properties,
+a messaging service with a reconnection strategy, and listeners that count
+service events into the stage's metrics and log them. They subscribe a
+handler to their topics the same way, and their main thread just waits for
+an interrupt. A stage module passes its own METRICS and LOG to these helpers.
+
+A stage's handler also takes decoded transactions through
+``on_transaction(transaction, stamps)``, and passes on what it does not drop
+to a ``downstream`` callable with the same signature when it has one, or
+publishes it on its topic otherwise. That is what lets runner.py host
+adjacent stages in one process and hand transactions from one to the next in
+memory.
+"""
+
+import time
+
+# Import Solace Python  API modules, or their loopback stand-ins (see transport.py)
+from transport import MessagingService, ReconnectionListener, ReconnectionAttemptListener, ServiceInterruptionListener, RetryStrategy, ServiceEvent
+from transport import PubSubPlusClientError, PublishFailureListener, TopicSubscription
+from jproperties import Properties
+
+PROPERTIES_FILE = 'solace.properties'
+
+
+def load_properties(path: str = PROPERTIES_FILE) -> Properties:
+    solace_configs = Properties()
+    with open(path, 'rb') as read_prop:
+        solace_configs.load(read_prop)
+    return solace_configs
+
+
+def broker_properties(solace_configs: Properties) -> dict:
+    """Messaging service properties from the SOLACE_* entries of solace.properties."""
+    return {
+        "solace.messaging.transport.host": solace_configs.get("SOLACE_HOST").data,
+        "solace.messaging.service.vpn-name": solace_configs.get('SOLACE_VPN').data,
+        "solace.messaging.authentication.scheme.basic.username": solace_configs.get("SOLACE_USERNAME").data,
+        "solace.messaging.authentication.scheme.basic.password": solace_configs.get("SOLACE_PASSWORD").data
+        }
+
+
+class ServiceEventHandler(ReconnectionListener, ReconnectionAttemptListener, ServiceInterruptionListener):
+    """Counts reconnections and interruptions into a stage's metrics and logs them."""
+
+    def __init__(self, metrics, log):
+        self.metrics = metrics
+        self.log = log
+
+    def on_reconnected(self, e: ServiceEvent):
+        self.metrics.reconnects.inc()
+        self.log.warning("reconnected", cause=e.get_cause(), message=e.get_message())
+
+    def on_reconnecting(self, e: "ServiceEvent"):
+        self.metrics.reconnect_attempts.inc()
+        self.log.warning("reconnecting", cause=e.get_cause(), message=e.get_message())
+
+    def on_service_interrupted(self, e: "ServiceEvent"):
+        self.metrics.interruptions.inc()
+        self.log.warning("service_interrupted", cause=e.get_cause(), message=e.get_message())
+
+
+class PublisherErrorHandling(PublishFailureListener):
+    def __init__(self, metrics, log):
+        self.metrics = metrics
+        self.log = log
+
+    def on_failed_publish(self, e: "FailedPublishEvent"):
+        self.metrics.publish_failures.inc()
+        self.log.error("publish_failed", destination=e.get_destination(), cause=e.get_exception())
+
+
+def connect(service_handler: ServiceEventHandler, path: str = PROPERTIES_FILE) -> MessagingService:
+    """Build and connect the messaging service configured in ``path``."""
+    # Build A messaging service with a reconnection strategy of 20 retries over an interval of 3 seconds
+    # Note: The reconnections strategy could also be configured using the broker properties object
+    messaging_service = MessagingService.builder().from_properties(broker_properties(load_properties(path)))\
+                        .with_reconnection_retry_strategy(RetryStrategy.parametrized_retry(20,3))\
+                        .build()
+
+    # Blocking connect thread
+    messaging_service.connect()
+
+    # Error Handeling for the messaging service
+    messaging_service.add_reconnection_listener(service_handler)
+    messaging_service.add_reconnection_attempt_listener(service_handler)
+    messaging_service.add_service_interruption_listener(service_handler)
+
+    return messaging_service
+
+
+def subscribe(messaging_service: MessagingService, topics: list, handler):
+    """Start a direct receiver on ``topics`` delivering to ``handler`` and return it."""
+    direct_receiver = messaging_service.create_direct_message_receiver_builder()\
+                            .with_subscriptions([TopicSubscription.of(t) for t in topics])\
+                            .build()
+    direct_receiver.start()
+    # Callback for received messages
+    direct_receiver.receive_async(handler)
+    return direct_receiver
+
+
+def wait(shutdown=None, interval: float = 0.1):
+    """Block the main thread until a KeyboardInterrupt, or until ``shutdown()`` returns true."""
+    try:
+        while not (shutdown is not None and shutdown()):
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print('\nDisconnecting Messaging Service')
+    except PubSubPlusClientError as exception:
+        print(f'Received a PubSubPlusClientException: {exception}')
@@ -0,0 +1,32 @@
+import dedup
+import transactions
+
+
+def transaction_id(at_ms: int, sequence: int) -> int:
+    return (at_ms - transactions.ID_EPOCH_MS) << (transactions.ID_GENERATOR_BITS + transactions.ID_SEQUENCE_BITS) \
+        | sequence
+
+
+def test_seeded_ids_are_duplicates():
+    now = 1_800_000_000.0
+    index = dedup.DedupIndex(window=60, retention=3600, bucket=600, capacity=1000, clock=lambda: now)
+    recent = transaction_id(int(now * 1000) - 1000, 1)
+    older = transaction_id(int(now * 1000) - 600_000, 2)
+    expired = transaction_id(int(now * 1000) - 7_200_000, 3)
+    assert index.seed([recent, older, expired, 0]) == 2
+
+    assert index.check(recent) == dedup.DUPLICATE
+    assert index.check(older) == dedup.SUSPECTED
+    assert index.check(expired) == dedup.UNCHECKED
+    assert index.check(transaction_id(int(now * 1000), 4)) == dedup.NEW
+    assert index.counts[dedup.NEW] == 1
+
+
+def test_unremembered_ids_stay_new():
+    now = 1_800_000_000.0
+    index = dedup.DedupIndex(window=60, retention=3600, bucket=600, capacity=1000, clock=lambda: now)
+    settled = transaction_id(int(now * 1000), 1)
+    assert index.check(settled, remember=False) == dedup.NEW
+    assert index.check(settled, remember=False) == dedup.NEW
+    index.remember(settled)
+    assert index.check(settled) == dedup.DUPLICATE
@@ -0,0 +1,106 @@
+import errno
+import os
+
+import pytest
+
+import journal
+from journal import Journal
+from ledger import Ledger
+
+
+def open_journal(directory) -> Journal:
+    # Groups are committed by the tests, not by the timer
+    return Journal(str(directory), fsync_interval=60, batch_size=1 << 20, fsync=False)
+
+
+def recovered(directory) -> Ledger:
+    j = open_journal(directory)
+    ledger = Ledger(j)
+    j.recover(ledger)
+    j.close()
+    return ledger
+
+
+def test_round_trip(tmp_path):
+    j = open_journal(tmp_path)
+    live = Ledger(j)
+    live.post("A", "B", 100)
+    live.post("B", "C", 30)
+    j.commit()
+    live.close_cycle()
+    live.post_many([("C", "A", 5), ("D", "B", 7)])
+    j.close()
+
+    ledger = recovered(tmp_path)
+    assert ledger.balances == live.balances
+    assert ledger.cycle == live.cycle == 2
+    assert {a: ledger.net(a) for a in "ABCD"} == {a: live.net(a) for a in "ABCD"}
+
+
+def test_recovered_journal_continues_numbering(tmp_path):
+    j = open_journal(tmp_path)
+    j.append("A", "B", 10)
+    j.close()
+
+    j = open_journal(tmp_path)
+    with pytest.raises(RuntimeError):
+        j.append("A", "C", 1)
+    live = Ledger(j)
+    j.recover(live)
+    live.post("C", "A", 4)
+    j.close()
+
+    assert recovered(tmp_path).balances == {"A": -6, "B": 10, "C": -4}
+
+
+def test_failed_write_leaves_no_account_numbers_behind(tmp_path, monkeypatch):
+    j = open_journal(tmp_path)
+    j.append("A", "B", 10)
+    j.commit()
+
+    write = os.write
+
+    def full(fd, data):
+        # Part of the group reaches the file before the disk fills up
+        write(fd, data[:len(data) // 2])
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    monkeypatch.setattr(journal.os, "write", full)
+    j.append("C", "D", 20)
+    with pytest.raises(OSError):
+        j.commit()
+    monkeypatch.setattr(journal.os, "write", write)
+
+    j.append("C", "E", 30)
+    j.append("E", "D", 0)
+    j.close()
+
+    assert recovered(tmp_path).balances == {"A": -10, "B": 10, "C": -30, "D": 0, "E": 30}
+
+
+def test_torn_tail_is_truncated(tmp_path):
+    j = open_journal(tmp_path)
+    j.append("A", "B", 10)
+    j.close()
+    segment, = (tmp_path / name for name in os.listdir(tmp_path))
+    committed = segment.stat().st_size
+    with open(segment, "ab") as f:
+        f.write(journal.BLOCK.pack(journal.BLOCK_MAGIC, journal.POSTINGS, 1, 0) + b"\0" * 5)
+
+    assert recovered(tmp_path).balances == {"A": -10, "B": 10}
+    assert segment.stat().st_size == committed
+
+
+def test_ids_round_trip(tmp_path):
+    j = open_journal(tmp_path)
+    live = Ledger(j)
+    live.post("A", "B", 10, 7)
+    live.post("B", "C", 5)
+    live.close_cycle()
+    live.post("C", "A", 1, 1 << 63)
+    j.close()
+
+    j = open_journal(tmp_path)
+    j.recover(Ledger(j))
+    assert list(j.ids()) == [7, 1 << 63]
+    j.close()
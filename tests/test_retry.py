@@ -0,0 +1,44 @@
+import retry
+
+
+def test_spilled_messages_are_retried_after_a_restart(tmp_path):
+    spill_path = str(tmp_path / "publisher.spill")
+
+    def broker_down(payload, topic, properties):
+        raise ConnectionError("broker down")
+
+    # Never started: the first message stays in memory and is lost with the process, the rest spill
+    first = retry.RetryBuffer(broker_down, capacity=1, spill_path=spill_path, name="test-before")
+    for i in range(4):
+        first.add(b"payload %d" % i, f"topic/{i}", {"n": i})
+    assert first.spilled == 3
+    first.close()
+
+    published = []
+    second = retry.RetryBuffer(lambda *message: published.append(message), capacity=1, base_delay=0.001,
+                               spill_path=spill_path, name="test-after").start()
+    try:
+        assert second.drain(5.0)
+    finally:
+        second.close()
+    assert published == [(b"payload %d" % i, f"topic/{i}", {"n": i, retry.ATTEMPT_PROPERTY: 1}) for i in (1, 2, 3)]
+    assert second.unspilled == 3
+
+
+def test_torn_spill_record_is_dropped(tmp_path):
+    spill_path = str(tmp_path / "publisher.spill")
+    first = retry.RetryBuffer(lambda *message: None, capacity=1, spill_path=spill_path, name="test-torn")
+    for i in range(3):
+        first.add(b"payload", "topic", None)
+    first.close()
+    with open(spill_path, "ab") as spill:
+        spill.write(retry._SPILL_HEADER.pack(0, 5, 100, 2) + b"top")
+
+    published = []
+    second = retry.RetryBuffer(lambda *message: published.append(message), capacity=10, base_delay=0.001,
+                               spill_path=spill_path, name="test-torn-after").start()
+    try:
+        assert second.drain(5.0)
+    finally:
+        second.close()
+    assert len(published) == 2
@@ -1,11 +1,129 @@
 """Utilities to model money transactions."""
 
 
+import secrets
+import threading
+import time
+from sys import intern
 from random import choices, randint
 from string import ascii_letters, digits
 
+import codec
+
+try:
+    import numpy as np
+except ImportError:  # batch generation needs numpy, single transactions do not
+    np = None
+
 account_chars: str = digits + ascii_letters
 
+ACCOUNT_ID_LEN = 12
+
+# Transaction ids are 64 bits: milliseconds since ID_EPOCH_MS in the top 42, then the
+# number of the generator and a sequence within the millisecond. An id therefore tells
+# when it was assigned, which ClearSettle's duplicate index buckets ids by (see dedup.py)
+ID_EPOCH_MS = 1_577_836_800_000  # 2020-01-01T00:00:00Z
+ID_GENERATOR_BITS = 10
+ID_SEQUENCE_BITS = 12
+_ID_TIME_SHIFT = ID_GENERATOR_BITS + ID_SEQUENCE_BITS
+_ID_SEQUENCE_MASK = (1 << ID_SEQUENCE_BITS) - 1
+
+
+class IdGenerator:
+    """Unique, time-ordered transaction ids.
+
+    Up to 4096 ids are handed out per millisecond; asked for more, the
+    generator runs ahead of the clock rather than repeat one. ``generator``
+    (0-1023) tells apart processes generating at the same time; a random one
+    is drawn if it is not given.
+    """
+
+    def __init__(self, generator: int = None):
+        if generator is None:
+            generator = secrets.randbelow(1 << ID_GENERATOR_BITS)
+        if not 0 <= generator < 1 << ID_GENERATOR_BITS:
+            raise ValueError(f"generator must be between 0 and {(1 << ID_GENERATOR_BITS) - 1}")
+        self.generator = generator
+        # Milliseconds and sequence of the next id, as one number
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _reserve(self, n: int) -> int:
+        now = (time.time_ns() // 1_000_000 - ID_EPOCH_MS) << ID_SEQUENCE_BITS
+        with self._lock:
+            first = max(self._next, now)
+            self._next = first + n
+        return first
+
+    def next_id(self) -> int:
+        tick = self._reserve(1)
+        return (tick >> ID_SEQUENCE_BITS) << _ID_TIME_SHIFT | self.generator << ID_SEQUENCE_BITS \
+            | tick & _ID_SEQUENCE_MASK
+
+    def next_ids(self, n: int):
+        """``n`` consecutive ids as a uint64 array."""
+        _require_numpy()
+        first = self._reserve(n)
+        ticks = np.arange(first, first + n, dtype=np.uint64)
+        return (ticks >> np.uint64(ID_SEQUENCE_BITS)) << np.uint64(_ID_TIME_SHIFT) \
+            | np.uint64(self.generator << ID_SEQUENCE_BITS) | ticks & np.uint64(_ID_SEQUENCE_MASK)
+
+
+def id_time_ms(transaction_id: int) -> int:
+    """Unix time in milliseconds at which ``transaction_id`` was assigned."""
+    return (transaction_id >> _ID_TIME_SHIFT) + ID_EPOCH_MS
+
+
+# Ids of the transactions created without an explicit generator
+IDS = IdGenerator()
+
+
+class Transaction:
+    """One money transaction, as it travels through the stages.
+
+    ``amount`` is in integer minor units (cents), like on the wire. Account ids
+    and the currency code are interned, so the many transactions of an account
+    held at once (micro-batches, fraud windows, captures) share one string, and
+    dict lookups by account compare them by identity. Account ids are kept as
+    strings: 12 characters of 62 do not fit in 64 bits.
+    """
+
+    __slots__ = ('id', 'source', 'target', 'amount', 'currency', 'fx_version')
+
+    def __init__(self, source: str, target: str, amount: int, currency: str, id: int = 0, fx_version: int = 0):
+        self.id = id
+        self.source = intern(source)
+        self.target = intern(target)
+        self.amount = amount
+        self.currency = intern(currency)
+        # Version of the FX rates the amount was converted with, 0 when not converted
+        self.fx_version = fx_version
+
+    @classmethod
+    def from_dict(cls, transaction: dict):
+        """Transaction from the original dict layout, amount in currency units."""
+        return cls(transaction['source'], transaction['target'], codec.to_minor(transaction['amount']),
+                   transaction['currency'], transaction.get('id', 0), transaction.get('fx_version', 0))
+
+    def to_dict(self) -> dict:
+        """The original dict layout, amount in currency units; used by the legacy format and the event log."""
+        return {
+            'id': self.id,
+            'source': self.source,
+            'target': self.target,
+            'amount': codec.from_minor(self.amount),
+            'currency': self.currency,
+            'fx_version': self.fx_version,
+        }
+
+    def __eq__(self, other):
+        if not isinstance(other, Transaction):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        return (f"Transaction(id={self.id}, {self.source} -> {self.target}, {self.amount} {self.currency}"
+                f", fx_version={self.fx_version})")
 
 
 def _random_account_id() -> str:
@@ -18,15 +136,121 @@ def _random_amount() -> float:
     return randint(100, 100000) / 100
 
 
-def create_random_transaction() -> dict:
-    """Create a fake, randomised transaction."""
+def create_random_transaction(ids: IdGenerator = None) -> Transaction:
+    """Create a fake, randomised transaction, with an id from ``ids`` or the module's IDS."""
 
-    return {
-        #'source'.to_string(): rand_cust["customer"],
-        'source': _random_account_id(),
-        'target': _random_account_id(),
-        'amount': _random_amount(),
-        #'amount': rand_cust["amount"],
+    return Transaction(
+        #source: rand_cust["customer"],
+        _random_account_id(),
+        _random_account_id(),
+        codec.to_minor(_random_amount()),
+        #amount: rand_cust["amount"],
         # Keep it simple: it's all euros
-        'currency': 'EUR',
-    }
+        'EUR',
+        (ids or IDS).next_id(),
+    )
+
+
+# Bulk generation. Everything below draws whole batches with one vectorised call
+# per field instead of one Python call per transaction.
+
+if np is not None:
+    _ACCOUNT_ALPHABET = np.frombuffer(account_chars.encode('ascii'), dtype=np.uint8)
+
+    # Columnar batch of transactions, amounts in integer cents
+    TRANSACTION_DTYPE = np.dtype([
+        ('id', '<u8'),
+        ('source', f'S{ACCOUNT_ID_LEN}'),
+        ('target', f'S{ACCOUNT_ID_LEN}'),
+        ('currency', 'S3'),
+        ('amount', '<i8'),
+    ])
+
+    # Same bytes as codec.RECORD, one row per wire payload
+    RECORD_DTYPE = np.dtype([
+        ('magic', 'S2'),
+        ('version', 'u1'),
+        ('flags', 'u1'),
+        ('source', f'S{ACCOUNT_ID_LEN}'),
+        ('target', f'S{ACCOUNT_ID_LEN}'),
+        ('currency', 'S3'),
+        ('pad', 'V1'),
+        ('amount', '<i8'),
+        ('fx_version', '<u4'),
+        ('id', '<u8'),
+    ])
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("bulk transaction generation requires numpy")
+
+
+def make_rng(seed=None):
+    """Return a NumPy generator; pass a seed for a reproducible stream."""
+    _require_numpy()
+    return np.random.default_rng(seed)
+
+
+def _random_account_ids(rng, n: int):
+    idx = rng.integers(0, len(_ACCOUNT_ALPHABET), size=(n, ACCOUNT_ID_LEN), dtype=np.uint8)
+    return _ACCOUNT_ALPHABET[idx].view(f'S{ACCOUNT_ID_LEN}').ravel()
+
+
+def _fill(batch, rng, n: int, ids: IdGenerator = None):
+    batch['id'] = (ids or IDS).next_ids(n)
+    batch['source'] = _random_account_ids(rng, n)
+    batch['target'] = _random_account_ids(rng, n)
+    batch['currency'] = b'EUR'
+    # Between 1.00 and 1000.00, like _random_amount()
+    batch['amount'] = rng.integers(100, 100001, size=n, dtype=np.int64)
+    return batch
+
+
+def create_random_transactions(n: int, rng=None, ids: IdGenerator = None):
+    """Create ``n`` random transactions as a columnar array of TRANSACTION_DTYPE."""
+    rng = rng if rng is not None else make_rng()
+    return _fill(np.empty(n, dtype=TRANSACTION_DTYPE), rng, n, ids)
+
+
+def create_encoded_transactions(n: int, rng=None, ids: IdGenerator = None):
+    """Create ``n`` random transactions already laid out as codec records.
+
+    Returns an array of RECORD_DTYPE; ``records[i].tobytes()`` is the wire
+    payload of transaction ``i`` and ``records.tobytes()`` the whole batch.
+    """
+    # Checked here, not at import: codec imports this module
+    assert RECORD_DTYPE.itemsize == codec.RECORD_SIZE
+    rng = rng if rng is not None else make_rng()
+    records = np.zeros(n, dtype=RECORD_DTYPE)
+    records['magic'] = codec.MAGIC
+    records['version'] = codec.VERSION
+    return _fill(records, rng, n, ids)
+
+
+def iter_encoded_transactions(count: int = None, rng=None, batch_size: int = 65536, ids: IdGenerator = None):
+    """Yield encoded transaction payloads, ``count`` of them or forever.
+
+    Transactions are generated ``batch_size`` at a time; each payload is a
+    bytearray ready to be handed to the message builder. Without numpy this
+    falls back to encoding one create_random_transaction() at a time. Ids
+    come from ``ids``, or the module's IDS; a seeded ``rng`` does not make
+    them repeat.
+    """
+    remaining = count
+    if np is None:
+        while remaining is None or remaining > 0:
+            yield codec.encode(create_random_transaction(ids))
+            if remaining is not None:
+                remaining -= 1
+        return
+
+    rng = rng if rng is not None else make_rng()
+    size = codec.RECORD_SIZE
+    while remaining is None or remaining > 0:
+        n = batch_size if remaining is None else min(batch_size, remaining)
+        buf = memoryview(create_encoded_transactions(n, rng, ids).tobytes())
+        for offset in range(0, n * size, size):
+            yield bytearray(buf[offset:offset + size])
+        if remaining is not None:
+            remaining -= n
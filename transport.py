@@ -0,0 +1,44 @@
+"""Messaging API used by the stages: Solace PubSub+ or the in-process loopback broker.
+
+The transport is chosen by the ``SOLACE_TRANSPORT`` environment variable, or the
+``SOLACE_TRANSPORT`` entry of solace.properties, and defaults to ``solace``. The
+stages import every messaging class from here instead of from ``solace``
+directly, so ``SOLACE_TRANSPORT=loopback`` runs them without a broker.
+"""
+
+import os
+
+from jproperties import Properties
+
+SOLACE = "solace"
+LOOPBACK = "loopback"
+
+
+def _configured_transport() -> str:
+    transport = os.environ.get("SOLACE_TRANSPORT")
+    if not transport and os.path.exists('solace.properties'):
+        solace_configs = Properties()
+        with open('solace.properties', 'rb') as read_prop:
+            solace_configs.load(read_prop)
+        entry = solace_configs.get("SOLACE_TRANSPORT")
+        transport = entry.data if entry else None
+    return (transport or SOLACE).strip().lower()
+
+
+TRANSPORT = _configured_transport()
+
+if TRANSPORT == LOOPBACK:
+    from loopback import (MessagingService, ReconnectionListener, ReconnectionAttemptListener,
+                          ServiceInterruptionListener, RetryStrategy, ServiceEvent, PubSubPlusClientError,
+                          PublisherOverflowError, PublishFailureListener, PublisherReadinessListener,
+                          TopicSubscription, MessageHandler, InboundMessage, Topic)
+elif TRANSPORT == SOLACE:
+    from solace.messaging.messaging_service import MessagingService, ReconnectionListener, ReconnectionAttemptListener, ServiceInterruptionListener, RetryStrategy, ServiceEvent
+    from solace.messaging.errors.pubsubplus_client_error import PubSubPlusClientError, PublisherOverflowError
+    from solace.messaging.publisher.direct_message_publisher import PublishFailureListener
+    from solace.messaging.publisher.publisher_health_check import PublisherReadinessListener
+    from solace.messaging.resources.topic_subscription import TopicSubscription
+    from solace.messaging.receiver.message_receiver import MessageHandler, InboundMessage
+    from solace.messaging.resources.topic import Topic
+else:
+    raise ValueError(f"Unknown SOLACE_TRANSPORT {TRANSPORT!r}, expected {SOLACE!r} or {LOOPBACK!r}")
@@ -0,0 +1,326 @@
+"""Screen accounts against sanctions and watchlists from a memory-mapped, sorted index file.
+
+An index file holds every listed account once, in fixed-width columns,
+little endian::
+
+    header  4s magic b'SWLI', H version, B account id length, B bucket bits,
+            Q entry count, Q list version
+    starts  Q per bucket, then one more: the first entry of the bucket
+    keys    Q per entry: the first 8 bytes of the account id as a big-endian number
+    tails   I per entry: the last 4 bytes of the account id as a big-endian number
+    lists   I per entry: bit i set if the account is on LISTS[i]
+
+An account id's bucket is the top ``bucket bits`` bits of its CRC-32, so
+buckets hold about BUCKET_LOAD entries each. Entries are sorted by bucket, then by account id.
+Opening an index maps the file and casts the columns in place: nothing is read
+or copied, so opening takes the same time for ten entries or ten million, and
+every process mapping the same file shares one copy of it in the page cache.
+A lookup reads its bucket's range from ``starts`` and compares the few
+entries in it, so it never slices or copies the index. A binary search over
+ids sorted throughout would take over 20 probes for millions of entries, each
+one an interpreted memoryview read.
+
+Watchlist holds the current index of a path. An index is replaced by writing
+the new one next to it and renaming it over the old one, as ``build`` does;
+every process screening with that path maps the new file within
+``reload_interval`` seconds, on the next lookup, and keeps screening with the
+old one until then. Lookups already running finish on the old index, which is
+unmapped once nothing uses it.
+
+Usage:
+    python watchlist.py build INPUT INDEX --version N [--list NAME]
+    python watchlist.py info INDEX
+    python watchlist.py lookup INDEX ACCOUNT...
+INPUT has one account id per line, optionally followed by the comma-separated
+names of its lists; accounts without names are put on --list.
+"""
+
+import argparse
+import math
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from transactions import ACCOUNT_ID_LEN
+import eventlog
+
+try:
+    import numpy as np
+except ImportError:  # only building an index needs numpy
+    np = None
+
+MAGIC = b'SWLI'
+VERSION = 1
+HEADER = struct.Struct('<4sHBBQQ')
+
+# List of each bit of an entry's lists
+LISTS = ("sanctions", "pep", "internal")
+
+# Reason FraudDetect holds a transaction for when either account is listed
+REASON = "watchlist"
+
+# Seconds between checks for a replaced index file
+RELOAD_INTERVAL = 1.0
+# Seconds a replaced index is kept mapped for lookups already running on it
+RETIRE_DELAY = 1.0
+
+# Entries per bucket, on average
+BUCKET_LOAD = 2
+
+# A 12-byte account id as its key and tail
+_ID = struct.Struct('>QI')
+
+LOG = eventlog.logger("watchlist")
+
+
+def list_mask(names) -> int:
+    """Bitmask of the lists called ``names``."""
+    mask = 0
+    for name in names:
+        if name not in LISTS:
+            raise ValueError(f"unknown list {name!r}, expected one of {', '.join(LISTS)}")
+        mask |= 1 << LISTS.index(name)
+    return mask
+
+
+def list_names(mask: int) -> list:
+    """Names of the lists set in ``mask``."""
+    return [name for i, name in enumerate(LISTS) if mask >> i & 1]
+
+
+class WatchlistIndex:
+    """Read-only, memory-mapped view of an index file."""
+
+    def __init__(self, path: str):
+        if sys.byteorder != 'little':
+            raise ValueError("watchlist indexes are little endian and are mapped as they are")
+        self.path = path
+        with open(path, 'rb') as file:
+            stat = os.fstat(file.fileno())
+            self.signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            self._mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, account_length, bits, count, self.version = HEADER.unpack_from(self._mm)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a watchlist index")
+        if version != VERSION:
+            raise ValueError(f"unsupported watchlist index version {version}")
+        if account_length != ACCOUNT_ID_LEN:
+            raise ValueError(f"{path} holds {account_length}-byte account ids, not {ACCOUNT_ID_LEN}")
+        self._shift = 32 - bits
+        keys = HEADER.size + 8 * ((1 << bits) + 1)
+        tails = keys + 8 * count
+        lists = tails + 4 * count
+        if len(self._mm) < lists + 4 * count:
+            raise ValueError(f"{path} is truncated")
+        self.count = count
+        view = memoryview(self._mm)
+        self._starts = view[HEADER.size:keys].cast('Q')
+        self._keys = view[keys:tails].cast('Q')
+        self._tails = view[tails:lists].cast('I')
+        self._lists = view[lists:lists + 4 * count].cast('I')
+        view.release()
+
+    def __len__(self):
+        return self.count
+
+    def lookup(self, account) -> int:
+        """Bitmask of the lists ``account`` (str or ASCII bytes) is on, 0 if it is on none."""
+        if isinstance(account, str):
+            account = account.encode('ascii', 'replace')
+        if len(account) != ACCOUNT_ID_LEN:
+            if len(account) > ACCOUNT_ID_LEN:
+                return 0
+            # Shorter ids travel NUL-padded, and are indexed that way
+            account = account.ljust(ACCOUNT_ID_LEN, b'\0')
+        bucket = zlib.crc32(account) >> self._shift
+        key, tail = _ID.unpack(account)
+        keys = self._keys
+        i = self._starts[bucket]
+        end = self._starts[bucket + 1]
+        while i < end:
+            if keys[i] == key and self._tails[i] == tail:
+                return self._lists[i]
+            i += 1
+        return 0
+
+    def __contains__(self, account) -> bool:
+        return self.lookup(account) != 0
+
+    def close(self):
+        for view in (self._starts, self._keys, self._tails, self._lists):
+            view.release()
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _retire(index: WatchlistIndex, delay: float):
+    # The thread's last reference to ``index`` goes when this returns, unmapping it here
+    time.sleep(delay)
+
+
+class Watchlist:
+    """The current index of ``path``, mapped again within ``reload_interval`` seconds of the file being replaced.
+
+    A replacement whose list version is older than the current one is ignored.
+    Not locked: a reload swaps the index with one reference assignment, and
+    two threads reloading at once only map the same file twice. The replaced
+    index is unmapped RETIRE_DELAY seconds later on a thread of its own.
+    """
+
+    def __init__(self, path: str, reload_interval: float = RELOAD_INTERVAL):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.index = WatchlistIndex(path)
+        # Signature of the last file looked at, installed or not
+        self._seen = self.index.signature
+        self._next_check = time.monotonic() + reload_interval
+        self.reloads = 0
+
+    @property
+    def version(self) -> int:
+        return self.index.version
+
+    def reload(self) -> bool:
+        """Map the file at the path if it was replaced; True if a new index was installed."""
+        try:
+            stat = os.stat(self.path)
+        except OSError as e:
+            LOG.error("watchlist_missing", path=self.path, cause=repr(e))
+            return False
+        if (stat.st_ino, stat.st_mtime_ns, stat.st_size) == self._seen:
+            return False
+        try:
+            index = WatchlistIndex(self.path)
+        except (OSError, ValueError) as e:
+            LOG.error("watchlist_reload_failed", path=self.path, cause=repr(e))
+            return False
+        self._seen = index.signature
+        if index.version < self.index.version:
+            LOG.warning("watchlist_stale", version=index.version, current=self.index.version)
+            return False
+        retired = self.index
+        # A single reference assignment: lookups see either the old or the new index
+        self.index = index
+        # Unmapping the replaced file frees its pages, milliseconds of work for a large index,
+        # so the old index is let go on a thread of its own, once lookups running on it are done
+        threading.Thread(target=_retire, args=(retired, RETIRE_DELAY), name="watchlist-retire",
+                         daemon=True).start()
+        self.reloads += 1
+        LOG.info("watchlist_loaded", path=self.path, version=index.version, entries=len(index))
+        return True
+
+    def screen(self, source, target) -> int:
+        """Bitmask of the lists ``source`` or ``target`` is on, 0 if neither is listed."""
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + self.reload_interval
+            self.reload()
+        index = self.index
+        return index.lookup(source) | index.lookup(target)
+
+
+def build(path: str, accounts, lists=None, version: int = 1) -> int:
+    """Write the index of ``accounts`` to ``path``, replacing any index there in one rename.
+
+    ``accounts`` is a sequence or numpy array of account ids, str or ASCII
+    bytes, and ``lists`` the bitmask of the lists each one is on, every one on
+    LISTS[0] if None. An account given more than once is on all of its lists.
+    Returns the number of entries written.
+    """
+    if np is None:
+        raise ImportError("building a watchlist index requires numpy")
+    ids = np.asarray(accounts)
+    if ids.dtype.kind == 'U':
+        ids = np.char.encode(ids, 'ascii')
+    if ids.size and (ids.dtype.kind != 'S' or np.char.str_len(ids).max() > ACCOUNT_ID_LEN):
+        raise ValueError(f"account ids must be at most {ACCOUNT_ID_LEN} ASCII characters")
+    ids = ids.astype(f'S{ACCOUNT_ID_LEN}').ravel()
+    masks = np.full(len(ids), 1, dtype='<u4') if lists is None else np.asarray(lists, dtype='<u4').ravel()
+    if len(masks) != len(ids):
+        raise ValueError("lists must give one bitmask per account")
+    raw = ids.view(np.uint8).reshape(-1, ACCOUNT_ID_LEN)
+    keys = np.ascontiguousarray(raw[:, :8]).view('>u8').ravel()
+    tails = np.ascontiguousarray(raw[:, 8:]).view('>u4').ravel()
+    bits = min(32, max(1, math.ceil(math.log2(max(len(ids), 1) / BUCKET_LOAD))))
+    # Of the NUL-padded ids, as lookup() hashes them
+    data, crc32 = raw.tobytes(), zlib.crc32
+    buckets = np.fromiter((crc32(data[i:i + ACCOUNT_ID_LEN]) for i in range(0, len(data), ACCOUNT_ID_LEN)),
+                          np.uint32, len(ids)) >> np.uint32(32 - bits)
+    order = np.lexsort((tails, keys, buckets))
+    keys, tails, masks, buckets = keys[order], tails[order], masks[order], buckets[order]
+    if len(keys):
+        # One entry per account, with the lists of all its occurrences
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = (keys[1:] != keys[:-1]) | (tails[1:] != tails[:-1])
+        starts = np.flatnonzero(first)
+        keys, tails, buckets = keys[starts], tails[starts], buckets[starts]
+        masks = np.bitwise_or.reduceat(masks, starts)
+    starts = np.searchsorted(buckets, np.arange((1 << bits) + 1, dtype=np.uint64))
+
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, VERSION, ACCOUNT_ID_LEN, bits, len(keys), version))
+        file.write(starts.astype('<u8').tobytes())
+        file.write(keys.astype('<u8').tobytes())
+        file.write(tails.astype('<u4').tobytes())
+        file.write(masks.astype('<u4').tobytes())
+    # Readers mapping the old file keep it until they let go
+    os.replace(temporary, path)
+    return len(keys)
+
+
+def read_accounts(path: str, default_list: str = LISTS[0]):
+    """Account ids and list bitmasks of a text file of ``ACCOUNT[,LIST...]`` lines."""
+    default = list_mask([default_list])
+    accounts, masks = [], []
+    with open(path, encoding='ascii') as file:
+        for line in file:
+            account, *names = [field.strip() for field in line.split(',')]
+            if account:
+                accounts.append(account)
+                masks.append(list_mask(names) if names else default)
+    return accounts, masks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    building = commands.add_parser("build", help="index the accounts of INPUT into INDEX")
+    building.add_argument("input")
+    building.add_argument("index")
+    building.add_argument("--version", type=int, required=True, help="version of the lists")
+    building.add_argument("--list", default=LISTS[0], choices=LISTS, help="list of accounts given without one")
+    info = commands.add_parser("info", help="describe INDEX")
+    info.add_argument("index")
+    looking_up = commands.add_parser("lookup", help="print the lists of each ACCOUNT")
+    looking_up.add_argument("index")
+    looking_up.add_argument("accounts", nargs="+", metavar="ACCOUNT")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        accounts, masks = read_accounts(args.input, args.list)
+        count = build(args.index, accounts, masks, args.version)
+        print(f"{count:,} accounts indexed, {os.path.getsize(args.index):,} bytes")
+        return
+    started = time.perf_counter()
+    with WatchlistIndex(args.index) as index:
+        opened = time.perf_counter() - started
+        if args.command == "info":
+            print(f"version {index.version}, {len(index):,} accounts, {os.path.getsize(args.index):,} bytes, "
+                  f"opened in {opened * 1000:.3f} ms")
+        else:
+            for account in args.accounts:
+                print(f"{account}: {', '.join(list_names(index.lookup(account))) or 'not listed'}")
+
+
+if __name__ == '__main__':
+    main()